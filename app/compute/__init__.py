@@ -1,3 +1,5 @@
-from app.compute.graph import build_song_adjacency_matrix, approximate_shp
-from app.compute.features import create_feature_vector, standardize, principal_component_analysis
+from app.compute.graph import build_song_adjacency_matrix, build_knn_song_graph, build_radius_song_graph, \
+    approximate_shp, extend_shp, cached_song_adjacency_matrix, TransitionDistances
+from app.compute.features import create_feature_vector, standardize, principal_component_analysis, \
+    PlaylistFeatureMatrix, standardize_feature_matrix
 from app.compute.cluster import cluster_k_means, cluster_dbscan
@@ -1,2 +1,3 @@
-from app.compute.cluster.k_means import find_optimal_k_means_clusters as cluster_k_means
+from app.compute.cluster.k_means import find_optimal_k_means_clusters as cluster_k_means, k_means
 from app.compute.cluster.dbscan import dbscan as cluster_dbscan
+from app.compute.cluster.mini_batch_k_means import fit_library_clusters, LibraryClusterModel
@@ -1,45 +1,81 @@
+from collections import deque
+from typing import Union
+
 import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+from app.compute.graph.tiled_matrix import iter_row_tiles
+
+
+def eps_neighbourhoods(adjacency_matrix: Union[np.array, csr_matrix], eps: float) -> csr_matrix:
+    """
+    Find the neighbours within eps of all points at once
+    :param adjacency_matrix: dense distance matrix, may be memory mapped, or sparse graph in CSR format
+    :param eps: the maximum distance
+    :return: boolean CSR matrix, row i holds the neighbours of point i
+    """
+    n = adjacency_matrix.shape[0]
+    if issparse(adjacency_matrix):
+        graph = csr_matrix(adjacency_matrix)
+        within = graph.data < eps
+        rows = np.repeat(np.arange(n), np.diff(graph.indptr))
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows[within], minlength=n))))
+        return csr_matrix((np.ones(indptr[-1], dtype=bool), graph.indices[within], indptr), shape=(n, n))
 
+    indices, row_lengths = [], []
+    for row, tile in iter_row_tiles(adjacency_matrix):
+        tile_rows, tile_columns = np.nonzero(np.asarray(tile) < eps)
+        indices.append(tile_columns)
+        row_lengths.append(np.bincount(tile_rows, minlength=len(tile)))
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=int)
+    indptr = np.concatenate(([0], np.cumsum(np.concatenate(row_lengths)))) if row_lengths else np.zeros(1, dtype=int)
+    return csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=(n, n))
 
-def expand_cluster(point: int, neighbours: list[int], cluster: int,
-                   eps: float, min_pts: int,
-                   adjacency_matrix: np.array, labels: np.array, visited: np.array):
+
+def expand_cluster(point: int, cluster: int, neighbourhoods: csr_matrix, core: np.array,
+                   labels: np.array, visited: np.array):
     """
     Expand the cluster to include all points that are density-reachable from the core points
     """
+    indptr, indices = neighbourhoods.indptr, neighbourhoods.indices
     labels[point] = cluster
-    while len(neighbours) > 0:
-        neighbour = neighbours.pop(0)
-        if not visited[neighbour]:
-            visited[neighbour] = True
-            new_neighbours = list(np.where(adjacency_matrix[neighbour] < eps)[0])
-            if len(new_neighbours) >= min_pts:
-                neighbours.extend(new_neighbours)
-        if labels[neighbour] in [0, -1]:
+    frontier = deque(indices[indptr[point]:indptr[point + 1]])
+    while frontier:
+        neighbour = frontier.popleft()
+        if labels[neighbour] in (0, -1):
             labels[neighbour] = cluster
+        if visited[neighbour]:
+            continue
+        visited[neighbour] = True
+        if core[neighbour]:
+            new_neighbours = indices[indptr[neighbour]:indptr[neighbour + 1]]
+            # visited points are only queued again if they are unclaimed noise that becomes a border point
+            frontier.extend(new_neighbours[~visited[new_neighbours] | (labels[new_neighbours] <= 0)])
 
 
-def dbscan(adjacency_matrix: np.array, eps: float, min_pts: int) -> np.array:
+def dbscan(adjacency_matrix: Union[np.array, csr_matrix], eps: float, min_pts: int) -> np.array:
     """
-    Perform DBSCAN clustering on the given data
-    :param adjacency_matrix: the data to cluster
+    Perform DBSCAN clustering on the given data.
+    The eps-neighbourhoods are computed once up front, so every point is expanded in time linear in its neighbours,
+    with a sparse graph (e.g. build_radius_song_graph) the whole clustering stays sub-quadratic.
+    :param adjacency_matrix: the data to cluster, either a dense distance matrix or a sparse graph in CSR format
     :param eps: the maximum distance between two samples for one to be considered as in the neighborhood of the other
     :param min_pts: the number of samples in a neighborhood for a point to be considered as a core point
-    :return: an array of labels where -1 indicates noise, and 0 to n-1 are the cluster labels
+    :return: an array of labels where -1 indicates noise, and 1 to the number of clusters are the cluster labels
     """
-    n = len(adjacency_matrix)
+    n = adjacency_matrix.shape[0]
+    neighbourhoods = eps_neighbourhoods(adjacency_matrix, eps)
+    core = np.diff(neighbourhoods.indptr) >= min_pts
     labels = np.zeros(n, dtype=int)
     visited = np.zeros(n, dtype=bool)
     cluster = 0
-    while np.where(visited == False)[0].size > 0:
-        # pick a random point
-        point = np.random.choice(np.where(visited == False)[0])
+    for point in range(n):
+        if visited[point]:
+            continue
         visited[point] = True
-
-        neighbours = list(np.where(adjacency_matrix[point] < eps)[0])
-        if len(neighbours) < min_pts:
+        if not core[point]:
             labels[point] = -1
         else:
             cluster += 1
-            expand_cluster(point, neighbours, cluster, eps, min_pts, adjacency_matrix, labels, visited)
+            expand_cluster(point, cluster, neighbourhoods, core, labels, visited)
     return labels
@@ -1,64 +1,197 @@
+import os
+from concurrent.futures import Executor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional, Tuple
+
 import numpy as np
 
+from app.compute.compute_queue import compute_queue
+
+# Centroids moving less than this, relative to the variance of the data, count as converged
+DEFAULT_TOLERANCE = 1e-4
+# Number of values of k past the best silhouette score after which the sweep stops
+DEFAULT_PATIENCE = 8
 
-def k_means(data: np.array, k, max_iter=1000):
+
+def k_means(data: np.array, k, max_iter=1000, tol: float = DEFAULT_TOLERANCE, seed: Optional[int] = None):
+    """
+    Lloyd's k-means with k-means++ seeding, all distances of an iteration are computed at once
+    :param data: the data to cluster, one row per point
+    :param k: the number of clusters
+    :param max_iter: the maximum number of iterations
+    :param tol: stop once no centroid moved further than tol times the mean variance of the features
+    :param seed: seed of the random generator, for reproducible clusterings
+    :return: tuple of (centroids, labels)
+    """
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float64)
     # dimensions of data
     n, m = data.shape
-    # create random centroids
-    centroids = data[np.random.choice(n, k, replace=False)]
-    # create labels
-    labels = np.zeros(n, dtype=int)
-    prev_labels = np.zeros(n)
+    k = min(k, n)
+    squared_norms = np.einsum("ij,ij->i", data, data)
+    threshold = tol * np.mean(np.var(data, axis=0))
 
+    centroids = k_means_plus_plus(data, squared_norms, k, rng)
+    labels = np.full(n, -1)
     for _ in range(max_iter):
         # assign each data point to the closest centroid
-        for i in range(n):
-            labels[i] = np.argmin(np.linalg.norm(centroids - data[i], axis=1))
-
+        distances = squared_distances(data, squared_norms, centroids)
+        prev_labels, labels = labels, np.argmin(distances, axis=1)
         # if labels haven't changed, break
-        if np.all(labels == prev_labels):
+        if np.array_equal(labels, prev_labels):
             break
-        prev_labels = labels.copy()
 
         # update centroids
-        for i in range(k):
-            centroids[i] = np.mean(data[labels == i], axis=0)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros((k, m))
+        np.add.at(sums, labels, data)
+        new_centroids = centroids.copy()
+        filled = counts > 0
+        new_centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+        # an empty cluster takes over the points that are farthest from their centroids
+        empty = np.flatnonzero(~filled)
+        if len(empty) > 0:
+            farthest = np.argsort(distances[np.arange(n), labels])[::-1][:len(empty)]
+            new_centroids[empty] = data[farthest]
+            labels[farthest] = empty
+
+        shift = np.max(np.sum((new_centroids - centroids) ** 2, axis=1))
+        centroids = new_centroids
+        if shift <= threshold:
+            break
 
     return centroids, labels
 
 
-def calculate_silhouette_score(data: np.array, labels: np.array, centroids: np.array) -> float:
-    average_intra_cluster_distances = np.zeros(len(centroids))
-    for i in range(len(centroids)):
-        average_intra_cluster_distances[i] = np.mean(np.linalg.norm(data[labels == i] - centroids[i], axis=1))
+def squared_distances(data: np.array, squared_norms: np.array, centroids: np.array) -> np.array:
+    """
+    :return: squared euclidean distance between every point and every centroid, as one matrix product
+    """
+    distances = squared_norms[:, np.newaxis] - 2 * data @ centroids.T \
+        + np.einsum("ij,ij->i", centroids, centroids)[np.newaxis, :]
+    return np.maximum(distances, 0)
+
+
+def k_means_plus_plus(data: np.array, squared_norms: np.array, k: int, rng: np.random.Generator) -> np.array:
+    """
+    Choose the initial centroids one after another, every point with a probability proportional to its squared
+    distance to the closest centroid chosen so far
+    :return: the initial centroids
+    """
+    n = data.shape[0]
+    centroids = np.empty((k, data.shape[1]))
+    centroids[0] = data[rng.integers(n)]
+    closest = squared_distances(data, squared_norms, centroids[:1])[:, 0]
+    for c in range(1, k):
+        total = closest.sum()
+        # all remaining points coincide with a centroid
+        chosen = rng.choice(n, p=closest / total) if total > 0 else rng.integers(n)
+        centroids[c] = data[chosen]
+        np.minimum(closest, squared_distances(data, squared_norms, centroids[c:c + 1])[:, 0], out=closest)
+    return centroids
+
 
-    average_inter_cluster_distances = np.zeros(len(centroids))
-    for i in range(len(centroids)):
-        other_centroids = np.delete(centroids, i, axis=0)
-        average_inter_cluster_distances[i] = np.mean(np.linalg.norm(other_centroids - centroids[i], axis=1))
+def silhouette_score(distances: np.array, labels: np.array) -> float:
+    """
+    Mean silhouette of all points, s = (b - a) / max(a, b) with a the mean distance of a point to the other points of
+    its cluster and b the mean distance to the points of the closest other cluster, points alone in their cluster
+    count as 0. The distances to all clusters are summed with one matrix product.
+    :param distances: pairwise distances between all points
+    :param labels: the cluster label of every point
+    :return: the silhouette score in [-1, 1], -1 if there are less than two clusters
+    """
+    clusters, labels = np.unique(labels, return_inverse=True)
+    k = len(clusters)
+    if k < 2:
+        return -1.0
+    n = len(labels)
+    membership = np.zeros((n, k), dtype=distances.dtype)
+    membership[np.arange(n), labels] = 1
+    sizes = membership.sum(axis=0).astype(np.float64)
+    cluster_distances = np.asarray(distances @ membership, dtype=np.float64)
 
-    _average_inter_cluster_distance = b = np.mean(average_inter_cluster_distances)
-    _average_intra_cluster_distances = a = np.mean(average_intra_cluster_distances)
-    score = (b - a) / max(a, b)
-    return score
+    own_size = sizes[labels]
+    a = cluster_distances[np.arange(n), labels] / np.maximum(own_size - 1, 1)
+    cluster_distances /= sizes[np.newaxis, :]
+    cluster_distances[np.arange(n), labels] = np.inf
+    b = cluster_distances.min(axis=1)
+    largest = np.maximum(a, b)
+    scores = np.where((own_size > 1) & (largest > 0), (b - a) / np.where(largest > 0, largest, 1), 0.0)
+    return float(scores.mean())
 
 
-def find_optimal_k_means_clusters(data: np.array, max_clusters=10) -> (np.array, np.array):
+def pairwise_distances(data: np.array) -> np.array:
     """
-    Find the optimal number of clusters using the silhouette score
+    :return: euclidean distances between all rows of data, as float32
+    """
+    data = np.asarray(data, dtype=np.float64)
+    squared_norms = np.einsum("ij,ij->i", data, data)
+    return np.sqrt(squared_distances(data, squared_norms, data)).astype(np.float32)
+
+
+def find_optimal_k_means_clusters(data: np.array, max_clusters=10, pool: Optional[Executor] = None,
+                                  patience: int = DEFAULT_PATIENCE, seed: Optional[int] = None,
+                                  workers: Optional[int] = None) -> (np.array, np.array):
+    """
+    Find the optimal number of clusters using the silhouette score.
+    The values of k are tried in parallel in waves of one k per worker, the pairwise distances the silhouette is
+    computed from are placed in shared memory once. The sweep stops once patience values of k after the best one did
+    not improve on it.
     :param data: the data to cluster
     :param max_clusters: the maximum number of clusters to try
-    :return the labels of a clustering with the optimal number of clusters
+    :param pool: process pool to run the clusterings in, defaults to the pool of the compute queue
+    :param patience: number of values of k without improvement after which the sweep stops
+    :param seed: seed for the clusterings
+    :param workers: number of values of k tried at once, defaults to the number of workers of the pool
+    :return the centroids and labels of a clustering with the optimal number of clusters
+    """
+    pool = compute_queue.pool if pool is None else pool
+    ks = list(range(2, min(max_clusters, len(data)) + 1))
+    if len(ks) == 0:
+        return k_means(data, 1, seed=seed)
+    seeds = dict(zip(ks, np.random.SeedSequence(seed).spawn(len(ks))))
+    # Executors do not expose their size publicly, ProcessPoolExecutor and ThreadPoolExecutor keep it in _max_workers
+    wave_size = max(1, workers or getattr(pool, "_max_workers", None) or os.cpu_count() or 1)
+
+    distances = pairwise_distances(data)
+    shared_distances = SharedMemory(create=True, size=max(1, distances.nbytes))
+    try:
+        np.ndarray(distances.shape, dtype=distances.dtype, buffer=shared_distances.buf)[:] = distances
+        best_score, best_k = -np.inf, None
+        best_centroids, best_labels = None, None
+        for wave in range(0, len(ks), wave_size):
+            wave_ks = ks[wave:wave + wave_size]
+            print(f"Trying {wave_ks[0]} to {wave_ks[-1]} clusters" if len(wave_ks) > 1
+                  else f"Trying {wave_ks[0]} clusters")
+            futures = [(k, pool.submit(_sweep_worker, shared_distances.name, distances.shape, distances.dtype.str,
+                                       data, k, seeds[k]))
+                       for k in wave_ks]
+            for k, future in futures:
+                centroids, labels, score = future.result()
+                if score > best_score:
+                    best_score, best_k = score, k
+                    best_centroids, best_labels = centroids, labels
+            if wave_ks[-1] - best_k >= patience:
+                print(f"Silhouette score peaked at {best_k} clusters")
+                break
+        return best_centroids, best_labels
+    finally:
+        shared_distances.close()
+        shared_distances.unlink()
+
+
+def _sweep_worker(shared_distances_name: str, shape: Tuple[int, int], dtype: str, data: np.array, k: int,
+                  seed: np.random.SeedSequence) -> Tuple[np.array, np.array, float]:
+    """
+    Clusters the data into k clusters and scores the clustering on the distances in shared memory,
+    executed in a worker process
     """
-    best_score = -1
-    best_centroids = None
-    best_labels = None
-    for k in range(2, max_clusters+1):
-        print(f"Trying {k} clusters")
-        centroids, labels = k_means(data, k)
-        score = calculate_silhouette_score(data, labels, centroids)
-        if score > best_score:
-            best_score = score
-            best_centroids = centroids
-            best_labels = labels
-    return best_centroids, best_labels
+    shared_distances = SharedMemory(name=shared_distances_name)
+    try:
+        distances = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shared_distances.buf)
+        centroids, labels = k_means(data, k, seed=np.random.default_rng(seed).integers(2 ** 32))
+        score = silhouette_score(distances, labels)
+        del distances
+        return centroids, labels, score
+    finally:
+        shared_distances.close()
@@ -0,0 +1,146 @@
+"""
+Mini-batch k-means over the whole track library. The feature rows are streamed from the database in chunks,
+every chunk moves the centroids towards the points assigned to them with a per centroid learning rate of
+1 / number of points seen, so the library never has to be held in memory.
+The fitted model is persisted and labels playlists in O(n*k) without refitting.
+"""
+from __future__ import annotations
+
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+from app.compute.cluster.k_means import k_means_plus_plus, squared_distances, DEFAULT_TOLERANCE
+from app.compute.config import COMPUTE_CONFIG
+from app.compute.features import PlaylistFeatureMatrix, StandardizationStatistics, standardize_feature_matrix, \
+    library_statistics
+from app.compute.persistence import atomic_save
+from app.spotify.database import Database
+
+DEFAULT_EPOCHS = 3
+
+
+class LibraryClusterModel:
+    """
+    Centroids of the standardized end vectors of all library tracks, together with the statistics they were
+    standardized with and the number of tracks every centroid has absorbed
+    """
+    centroids: np.ndarray
+    counts: np.ndarray
+    statistics: StandardizationStatistics
+
+    def __init__(self, centroids: np.ndarray, counts: np.ndarray, statistics: StandardizationStatistics):
+        self.centroids = centroids
+        self.counts = counts
+        self.statistics = statistics
+
+    def label(self, feature_matrix: PlaylistFeatureMatrix) -> np.ndarray:
+        """
+        Assign every track of a playlist to its closest library centroid
+        :param feature_matrix: the unstandardized feature matrix of the playlist
+        :return: the label of every track
+        """
+        vectors = _library_vectors(feature_matrix, self.statistics)
+        squared_norms = np.einsum("ij,ij->i", vectors, vectors)
+        return np.argmin(squared_distances(vectors, squared_norms, self.centroids), axis=1)
+
+    def save(self, path: Optional[str] = None):
+        """
+        Persist the model, replacing a previously saved one atomically
+        :param path: the file to save to, defaults to the configured library_cluster_model
+        """
+        path = COMPUTE_CONFIG["library_cluster_model"] if path is None else path
+        atomic_save(path, lambda model_file: np.savez(model_file, centroids=self.centroids, counts=self.counts,
+                                                      **self.statistics.as_arrays()))
+
+    @staticmethod
+    def load(path: Optional[str] = None) -> Optional[LibraryClusterModel]:
+        """
+        :param path: the file to load from, defaults to the configured library_cluster_model
+        :return: the persisted model, or None if there is none
+        """
+        path = COMPUTE_CONFIG["library_cluster_model"] if path is None else path
+        try:
+            with np.load(path, allow_pickle=False) as model:
+                return LibraryClusterModel(model["centroids"], model["counts"],
+                                           StandardizationStatistics.from_arrays(model))
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+
+def mini_batch_k_means(batches: Callable[[], Iterable[np.ndarray]], k: int, epochs: int = DEFAULT_EPOCHS,
+                       tol: float = DEFAULT_TOLERANCE, seed: Optional[int] = None) -> (np.ndarray, np.ndarray):
+    """
+    Mini-batch k-means, the centroids are seeded with k-means++ on the first batch and every batch moves them
+    towards the mean of the points assigned to them
+    :param batches: returns a new iterator over the batches of points for every epoch
+    :param k: the number of clusters
+    :param epochs: the maximum number of passes over all batches
+    :param tol: stop once no centroid moved further than tol times the mean variance of the first batch in an epoch
+    :param seed: seed of the random generator, for reproducible clusterings
+    :return: tuple of (centroids, number of points every centroid has absorbed)
+    """
+    rng = np.random.default_rng(seed)
+    centroids, counts, threshold = None, None, 0.0
+    for _ in range(epochs):
+        previous_centroids = None if centroids is None else centroids.copy()
+        for batch in batches():
+            batch = np.asarray(batch, dtype=np.float64)
+            if len(batch) == 0:
+                continue
+            squared_norms = np.einsum("ij,ij->i", batch, batch)
+            if centroids is None:
+                k = min(k, len(batch))
+                centroids = k_means_plus_plus(batch, squared_norms, k, rng)
+                counts = np.zeros(k, dtype=np.int64)
+                threshold = tol * np.mean(np.var(batch, axis=0))
+
+            labels = np.argmin(squared_distances(batch, squared_norms, centroids), axis=1)
+            batch_counts = np.bincount(labels, minlength=k)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, batch)
+            counts += batch_counts
+            # the mean of a batch counts as much as the points it consists of
+            assigned = batch_counts > 0
+            learning_rate = batch_counts[assigned] / counts[assigned]
+            batch_means = sums[assigned] / batch_counts[assigned, np.newaxis]
+            centroids[assigned] += learning_rate[:, np.newaxis] * (batch_means - centroids[assigned])
+
+        if centroids is None:
+            raise ValueError("Cannot cluster without any points")
+        if previous_centroids is not None \
+                and np.max(np.sum((centroids - previous_centroids) ** 2, axis=1)) <= threshold:
+            break
+    return centroids, counts
+
+
+def fit_library_clusters(database: Database, k: Optional[int] = None, chunk_size: Optional[int] = None,
+                         epochs: int = DEFAULT_EPOCHS, seed: Optional[int] = None) -> LibraryClusterModel:
+    """
+    Cluster every track cached in the database, standardized with the library statistics,
+    every pass streams the chunks into mini-batch k-means
+    :param database: the track cache
+    :param k: the number of clusters, defaults to the configured library_clusters
+    :param chunk_size: number of tracks per batch, defaults to the configured library_chunk_rows
+    :param epochs: the maximum number of passes of mini-batch k-means
+    :param seed: seed for the clustering
+    :return: the fitted model
+    """
+    k = COMPUTE_CONFIG["library_clusters"] if k is None else k
+    chunk_size = COMPUTE_CONFIG["library_chunk_rows"] if chunk_size is None else chunk_size
+
+    statistics = library_statistics(database)
+
+    def batches() -> Iterable[np.ndarray]:
+        return (_library_vectors(chunk, statistics)
+                for chunk in PlaylistFeatureMatrix.stream_library(database, chunk_size))
+
+    centroids, counts = mini_batch_k_means(batches, k, epochs, seed=seed)
+    return LibraryClusterModel(centroids, counts, statistics)
+
+
+def _library_vectors(feature_matrix: PlaylistFeatureMatrix, statistics: StandardizationStatistics) -> np.ndarray:
+    """
+    :return: the end vectors the library is clustered on, standardized with the library statistics
+    """
+    return standardize_feature_matrix(feature_matrix, statistics).end_vectors().astype(np.float64)
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+import time
+import uuid
 from concurrent.futures import ProcessPoolExecutor
 from typing import Callable, List, Dict, Optional
 
+from app.compute.config import COMPUTE_CONFIG
+
 
 class ComputeQueue:
     queue: Dict[str, ComputeTask]
@@ -12,22 +16,44 @@ class ComputeQueue:
         self.queue = {}
         self.pool = ProcessPoolExecutor()
 
-    def queue_task(self, task: ComputeTask) -> str:
+    def queue_task(self, task: ComputeTask, task_id: Optional[str] = None) -> str:
         """
-        Queue a task and return the task id
+        Queue a task and return the task id, tasks that finished longer than the configured finished_task_ttl ago
+        are dropped
         :param task: The task to be queued
+        :param task_id: id chosen by the caller, e.g. so a client can poll progress of a task it is waiting for
         :return: The task id
         """
-        task_id = self.generate_task_id()
+        self.remove_expired_tasks()
+        task_id = self.generate_task_id() if task_id is None else task_id
         self.queue[task_id] = task
         return task_id
 
     def generate_task_id(self):
         """
-        Generate a unique task id
+        Generate a unique task id, random so it never collides with an id chosen by a client
         :return: The task id
         """
-        return str(len(self.queue) + 1)
+        return uuid.uuid4().hex
+
+    def remove_task(self, task_id: str):
+        """
+        Forget a task, e.g. once its result has been reported
+        :param task_id: The task id
+        """
+        self.queue.pop(task_id, None)
+
+    def remove_expired_tasks(self, ttl: Optional[float] = None):
+        """
+        Forget all tasks that finished more than ttl seconds ago
+        :param ttl: seconds a finished task is kept, defaults to the configured finished_task_ttl
+        """
+        ttl = COMPUTE_CONFIG["finished_task_ttl"] if ttl is None else ttl
+        now = time.monotonic()
+        expired = [task_id for task_id, task in list(self.queue.items())
+                   if task.progress.finished is not None and now - task.progress.finished > ttl]
+        for task_id in expired:
+            self.remove_task(task_id)
 
     def get_task(self, task_id: str) -> Optional[ComputeTask]:
         """
@@ -47,6 +73,10 @@ class ComputeTask:
     steps: List[ComputeStep]
     progress: TaskProgress
 
+    def __init__(self, steps: Optional[List[ComputeStep]] = None, time_budget: Optional[float] = None):
+        self.steps = [] if steps is None else steps
+        self.progress = TaskProgress(time_budget)
+
 
 class ComputeStep:
     name: str
@@ -67,4 +97,68 @@ class Argument:
 
 
 class TaskProgress:
+    # Statuses after which the progress no longer changes
+    FINAL_STATUSES = ("done", "failed")
+
     status: str
+    iteration: int
+    best_cost: Optional[float]
+    improvement_rate: float
+    time_budget: Optional[float]
+    started: Optional[float]
+    finished: Optional[float]
+
+    def __init__(self, time_budget: Optional[float] = None):
+        self.status = "queued"
+        self.iteration = 0
+        self.best_cost = None
+        self.improvement_rate = 0.0
+        self.time_budget = time_budget
+        self.started = None
+        self.finished = None
+
+    @property
+    def is_final(self) -> bool:
+        return self.status in self.FINAL_STATUSES
+
+    def start(self):
+        self.status = "running"
+        self.started = time.monotonic()
+
+    def finish(self):
+        self.status = "done"
+        self.finished = time.monotonic()
+
+    def fail(self):
+        self.status = "failed"
+        self.finished = time.monotonic()
+
+    def update(self, iteration: int, best_cost: float, improvement_rate: float):
+        """
+        Record the state of a running solver, matches the ProgressCallback of the solvers
+        """
+        if self.started is None:
+            self.start()
+        self.iteration = iteration
+        self.best_cost = best_cost
+        self.improvement_rate = improvement_rate
+
+    def fraction(self) -> float:
+        """
+        :return: estimated progress between 0 and 1, the share of the time budget used up while running
+        """
+        if self.status == "done":
+            return 1.0
+        if self.started is None or not self.time_budget:
+            return 0.0
+        return min(1.0, (time.monotonic() - self.started) / self.time_budget)
+
+    def as_dict(self) -> Dict:
+        return {"status": self.status,
+                "progress": self.fraction(),
+                "iteration": self.iteration,
+                "best_cost": self.best_cost,
+                "improvement_rate": self.improvement_rate}
+
+
+compute_queue = ComputeQueue()
@@ -0,0 +1,63 @@
+"""
+Configuration of the compute package, values missing from conf/compute_config.json fall back to the defaults below
+"""
+import json
+import os
+
+COMPUTE_CONFIG_PATH = "conf/compute_config.json"
+
+DEFAULT_COMPUTE_CONFIG = {
+    # Directory for memory mapped matrices and other temporary compute files
+    "scratch_dir": "../scratch/",
+    # Playlists with at least this many tracks get their distance matrix computed into a memory mapped file
+    "out_of_core_threshold": 4000,
+    # Number of matrix rows computed and read at once when working out of core
+    "tile_rows": 256,
+    # Directory and size limit of the persistent song adjacency matrix cache
+    "matrix_cache_dir": "../cache/matrices/",
+    "matrix_cache_max_bytes": 1024 ** 3,
+    # Seconds the playlist optimization may search before the best path found so far is used
+    "solver_time_budget": 20,
+    # Seconds the progress of a finished optimization stays available to clients that did not collect it
+    "finished_task_ttl": 600,
+    # Previously optimized orders are only extended if at most this share of the playlist was added or removed
+    "incremental_max_change": 0.25,
+    # Number of rows and columns of the distance heatmap shown at once
+    "heatmap_page_size": 100,
+    # Average number of tracks per cluster for the hierarchical solver strategy
+    "hierarchical_cluster_size": 64,
+    # Automatic solver selection: exact up to the first size, full local search up to the second and
+    # hierarchical or candidate list search beyond, the exact solver is capped at MAX_EXACT_TRACKS (see held_karp)
+    "exact_max_tracks": 16,
+    "local_search_max_tracks": 2000,
+    # Transitions longer than the mean plus this many standard deviations are avoided by the bottleneck strategy
+    "bottleneck_sigma": 1.0,
+    # Persisted mini-batch k-means model of the whole track library, its number of clusters and the number of tracks
+    # streamed from the database per batch
+    "library_cluster_model": "../cache/library_clusters.npz",
+    "library_clusters": 64,
+    "library_chunk_rows": 10000,
+    # Persisted principal components of the whole track library and the fraction of the variance they have to explain
+    "library_pca_model": "../cache/library_pca.npz",
+    "pca_explained_variance": 0.9,
+    # "playlist" standardizes every playlist with its own statistics, "library" with those of all cached tracks,
+    # which are only refreshed once they drifted further than the tolerance
+    "standardization_mode": "playlist",
+    "library_statistics_drift_tolerance": 0.05,
+}
+
+
+def load_compute_config(path: str = COMPUTE_CONFIG_PATH) -> dict:
+    """
+    Read the compute configuration
+    :param path: path of the json config file
+    :return: the configuration, with defaults for every key not present in the file
+    """
+    config = dict(DEFAULT_COMPUTE_CONFIG)
+    if os.path.exists(path):
+        with open(path, "r") as config_file:
+            config.update(json.load(config_file))
+    return config
+
+
+COMPUTE_CONFIG = load_compute_config()
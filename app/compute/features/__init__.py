@@ -1,3 +1,6 @@
+from app.compute.features.feature_matrix import PlaylistFeatureMatrix
 from app.compute.features.vector_creation import create_feature_vector
-from app.compute.features.standardization import standardize
-from app.compute.features.pca import run_pca_and_reduce_dimensions as principal_component_analysis
+from app.compute.features.standardization import standardize, standardize_feature_matrix, \
+    StandardizationStatistics, library_statistics, statistics_for_mode
+from app.compute.features.pca import run_pca_and_reduce_dimensions as principal_component_analysis, PCAModel, \
+    fit_library_pca
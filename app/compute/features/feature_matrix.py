@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+from typing import Dict, Iterator, List, Sequence
+
+import numpy as np
+
+from app.spotify.model import Track
+
+FEATURE_COLUMNS = 5
+SECTION_COLUMNS = 2
+TOTAL_COLUMNS = FEATURE_COLUMNS + 2 * SECTION_COLUMNS
+
+
+class PlaylistFeatureMatrix:
+    """
+    Struct-of-arrays representation of the analysis of all tracks in a playlist.
+    All values live in one contiguous float32 block of shape (n, 9), laid out as
+    [features (5) | start section (2) | end section (2)], the named attributes are views into that block.
+    """
+    track_ids: List[str]
+    index: Dict[str, int]
+    data: np.ndarray
+    features: np.ndarray
+    start_sections: np.ndarray
+    end_sections: np.ndarray
+
+    def __init__(self, track_ids: Sequence[str], data: np.ndarray):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        if data.shape != (len(track_ids), TOTAL_COLUMNS):
+            raise ValueError(f"Feature block of shape {data.shape} does not fit {len(track_ids)} tracks")
+        self.track_ids = list(track_ids)
+        self.index = {track_id: i for i, track_id in enumerate(self.track_ids)}
+        self.data = data
+        self.features = data[:, :FEATURE_COLUMNS]
+        self.start_sections = data[:, FEATURE_COLUMNS:FEATURE_COLUMNS + SECTION_COLUMNS]
+        self.end_sections = data[:, FEATURE_COLUMNS + SECTION_COLUMNS:]
+
+    def __len__(self) -> int:
+        return len(self.track_ids)
+
+    @staticmethod
+    def from_tracks(tracks: List[Track]) -> PlaylistFeatureMatrix:
+        """
+        Builds the feature matrix from tracks that have their features and section analysis initialized
+        :param tracks: the tracks of the playlist
+        :return: the feature matrix, rows are ordered like the given tracks
+        """
+        data = np.empty((len(tracks), TOTAL_COLUMNS), dtype=np.float32)
+        for i, track in enumerate(tracks):
+            if track.features is None:
+                raise ValueError(f"Track {track.id} has no features")
+            if track.section_analysis is None:
+                raise ValueError(f"Track {track.id} has no section analysis")
+            data[i] = track.features.as_list() + track.section_analysis[0].as_list() \
+                + track.section_analysis[1].as_list()
+        return PlaylistFeatureMatrix([track.id for track in tracks], data)
+
+    @staticmethod
+    def from_database(database, track_ids: List[str]) -> PlaylistFeatureMatrix:
+        """
+        Builds the feature matrix from the vectors stored in the track cache, without building Track objects
+        :param database: the track cache, see Database.get_track_vectors
+        :param track_ids: the ids of the tracks of the playlist, all of them have to be cached
+        :return: the feature matrix, rows are ordered like the given ids
+        """
+        return PlaylistFeatureMatrix(track_ids, database.get_track_vectors(track_ids))
+
+    @staticmethod
+    def stream_library(database, chunk_size: int) -> Iterator[PlaylistFeatureMatrix]:
+        """
+        Builds feature matrices of all tracks cached in the database, chunk by chunk
+        :param database: the track cache, see Database.iter_track_vectors
+        :param chunk_size: number of tracks per feature matrix
+        :return: iterator over the feature matrices
+        """
+        return (PlaylistFeatureMatrix(track_ids, vectors)
+                for track_ids, vectors in database.iter_track_vectors(chunk_size))
+
+    def start_vectors(self) -> np.ndarray:
+        """
+        :return: matrix of shape (n, 7) containing the features and start section of every track
+        """
+        return np.concatenate((self.features, self.start_sections), axis=1)
+
+    def end_vectors(self) -> np.ndarray:
+        """
+        :return: matrix of shape (n, 7) containing the features and end section of every track
+        """
+        return np.concatenate((self.features, self.end_sections), axis=1)
@@ -1,5 +1,20 @@
+from __future__ import annotations
+
+from typing import Iterable, Optional
+
 import numpy as np
 
+from app.compute.config import COMPUTE_CONFIG
+from app.compute.persistence import atomic_save
+from app.compute.features.feature_matrix import PlaylistFeatureMatrix
+from app.compute.features.standardization import StandardizationStatistics, standardize_feature_matrix, \
+    library_statistics
+
+PCA_SOLVERS = ("auto", "eigh", "randomized")
+# Passes of the randomized range finder over the data and number of extra dimensions it samples
+RANDOMIZED_POWER_ITERATIONS = 4
+RANDOMIZED_OVERSAMPLES = 10
+
 
 def run_pca_and_reduce_dimensions(data: np.array, n_components: int) -> np.array:
     """
@@ -22,8 +37,8 @@ def pca(data: np.array) -> np.array:
     data = data - np.mean(data, axis=0)
     # Calculate the covariance matrix
     covariance_matrix = np.cov(data, rowvar=False)
-    # Calculate the eigenvectors and eigenvalues of the covariance matrix
-    eigenvalues, eigenvectors = np.linalg.eig(covariance_matrix)
+    # Calculate the eigenvectors and eigenvalues of the covariance matrix, which is symmetric
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance_matrix)
     # Sort the eigenvectors by eigenvalue
     sorted_indices = np.argsort(eigenvalues)[::-1]
     eigenvectors = eigenvectors[:, sorted_indices]
@@ -42,3 +57,176 @@ def reduce_dimensions(data: np.array, components: np.array, n_components: int) -
     eigenvector_subset = components[:, 0:n_components]
     return np.dot(eigenvector_subset.transpose(), data.transpose()).transpose()
 
+
+class PCAModel:
+    """
+    Fitted principal component analysis, the mean of the data it was fitted on and its principal components,
+    so that further data can be projected without refitting.
+    Models fitted on standardized features also hold the statistics the features were standardized with,
+    data has to be standardized with the same statistics before it is transformed.
+    """
+    mean: np.ndarray
+    components: np.ndarray
+    explained_variance: np.ndarray
+    statistics: Optional[StandardizationStatistics]
+
+    def __init__(self, mean: np.ndarray, components: np.ndarray, explained_variance: np.ndarray,
+                 statistics: Optional[StandardizationStatistics] = None):
+        self.mean = mean
+        self.components = components
+        self.explained_variance = explained_variance
+        self.statistics = statistics
+
+    @property
+    def n_components(self) -> int:
+        return self.components.shape[1]
+
+    @staticmethod
+    def fit(data: np.array, n_components: Optional[int] = None, explained_variance: Optional[float] = None,
+            solver: str = "auto", seed: Optional[int] = None) -> PCAModel:
+        """
+        Fit the principal components of the given data
+        :param data: the data to fit, one row per point
+        :param n_components: the number of components to keep, if none the fewest components that explain
+                             explained_variance of the variance
+        :param explained_variance: fraction of the variance to keep, defaults to the configured pca_explained_variance
+        :param solver: "eigh" for the eigen decomposition of the covariance matrix, "randomized" for a randomized SVD
+                       of the data that only computes n_components components, "auto" picks randomized if
+                       n_components is given and the covariance matrix would cost more than the power iterations
+        :param seed: seed of the randomized solver
+        :return: the fitted model
+        """
+        data = np.asarray(data, dtype=np.float64)
+        n, m = data.shape
+        mean = data.mean(axis=0)
+        centered = data - mean
+        if solver == "auto":
+            # the covariance matrix costs O(n*m^2), the randomized solver two products of O(n*m*sketch size) plus
+            # about as much again for orthogonalizing them, per power iteration
+            randomized_cost = 4 * (RANDOMIZED_POWER_ITERATIONS + 1) * ((n_components or m) + RANDOMIZED_OVERSAMPLES)
+            solver = "randomized" if n_components is not None and m > randomized_cost else "eigh"
+        if solver == "eigh":
+            return PCAModel._of_covariance(mean, centered.T @ centered / max(n - 1, 1), n_components,
+                                           explained_variance)
+        if solver == "randomized":
+            if n_components is None:
+                raise ValueError("The randomized solver requires n_components")
+            components, singular_values = _randomized_svd(centered, n_components, np.random.default_rng(seed))
+            return PCAModel(mean, components, singular_values ** 2 / max(n - 1, 1))
+        raise ValueError(f"Unknown PCA solver {solver}, expected one of {PCA_SOLVERS}")
+
+    @staticmethod
+    def fit_chunks(chunks: Iterable[np.array], n_components: Optional[int] = None,
+                   explained_variance: Optional[float] = None) -> PCAModel:
+        """
+        Fit the principal components of data that is only available in chunks, reading every chunk once.
+        The covariance matrix is accumulated from the chunks and decomposed with eigh.
+        :param chunks: the chunks of the data, all with the same number of columns
+        :param n_components: see fit
+        :param explained_variance: see fit
+        :return: the fitted model
+        """
+        count, total, outer = 0, None, None
+        for chunk in chunks:
+            chunk = np.asarray(chunk, dtype=np.float64)
+            if total is None:
+                total, outer = np.zeros(chunk.shape[1]), np.zeros((chunk.shape[1], chunk.shape[1]))
+            count += len(chunk)
+            total += chunk.sum(axis=0)
+            outer += chunk.T @ chunk
+        if count == 0:
+            raise ValueError("Cannot fit PCA without any data")
+        mean = total / count
+        covariance = (outer - count * np.outer(mean, mean)) / max(count - 1, 1)
+        return PCAModel._of_covariance(mean, covariance, n_components, explained_variance)
+
+    def transform(self, data: np.array) -> np.array:
+        """
+        :return: the data projected onto the principal components
+        """
+        return (np.asarray(data, dtype=np.float64) - self.mean) @ self.components
+
+    def save(self, path: Optional[str] = None):
+        """
+        Persist the model, replacing a previously saved one atomically
+        :param path: the file to save to, defaults to the configured library_pca_model
+        """
+        path = COMPUTE_CONFIG["library_pca_model"] if path is None else path
+        arrays = {} if self.statistics is None else self.statistics.as_arrays()
+        atomic_save(path, lambda model_file: np.savez(model_file, mean=self.mean, components=self.components,
+                                                      explained_variance=self.explained_variance, **arrays))
+
+    @staticmethod
+    def load(path: Optional[str] = None) -> Optional[PCAModel]:
+        """
+        :param path: the file to load from, defaults to the configured library_pca_model
+        :return: the persisted model, or None if there is none
+        """
+        path = COMPUTE_CONFIG["library_pca_model"] if path is None else path
+        try:
+            with np.load(path, allow_pickle=False) as model:
+                statistics = StandardizationStatistics.from_arrays(model) if "feature_mean" in model.files else None
+                return PCAModel(model["mean"], model["components"], model["explained_variance"], statistics)
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def _of_covariance(mean: np.ndarray, covariance: np.ndarray, n_components: Optional[int],
+                       explained_variance: Optional[float]) -> PCAModel:
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        # eigh returns the eigenvalues in ascending order, rounding may make the smallest ones slightly negative
+        eigenvalues = np.maximum(eigenvalues[::-1], 0)
+        eigenvectors = eigenvectors[:, ::-1]
+        if n_components is None:
+            n_components = components_for_variance(eigenvalues, explained_variance)
+        return PCAModel(mean, eigenvectors[:, :n_components], eigenvalues[:n_components])
+
+
+def components_for_variance(eigenvalues: np.ndarray, explained_variance: Optional[float] = None) -> int:
+    """
+    :param eigenvalues: the variance along every principal component, in descending order
+    :param explained_variance: fraction of the variance to keep, defaults to the configured pca_explained_variance
+    :return: the fewest components that together explain at least the given fraction of the variance
+    """
+    explained_variance = COMPUTE_CONFIG["pca_explained_variance"] if explained_variance is None \
+        else explained_variance
+    total = eigenvalues.sum()
+    if total <= 0:
+        return 1
+    ratios = np.cumsum(eigenvalues) / total
+    return int(min(np.searchsorted(ratios, explained_variance - 1e-12) + 1, len(eigenvalues)))
+
+
+def fit_library_pca(database, chunk_size: Optional[int] = None,
+                    statistics: Optional[StandardizationStatistics] = None) -> PCAModel:
+    """
+    Fit the principal components of the standardized end vectors of every track cached in the database
+    :param database: the track cache
+    :param chunk_size: number of tracks read at once, defaults to the configured library_chunk_rows
+    :param statistics: the statistics to standardize with, defaults to the library statistics
+    :return: the fitted model, with as many components as the configured pca_explained_variance requires,
+             holding the statistics it was standardized with
+    """
+    chunk_size = COMPUTE_CONFIG["library_chunk_rows"] if chunk_size is None else chunk_size
+    statistics = library_statistics(database) if statistics is None else statistics
+    model = PCAModel.fit_chunks(standardize_feature_matrix(chunk, statistics).end_vectors()
+                                for chunk in PlaylistFeatureMatrix.stream_library(database, chunk_size))
+    model.statistics = statistics
+    return model
+
+
+def _randomized_svd(centered: np.ndarray, n_components: int, rng: np.random.Generator) -> (np.ndarray, np.ndarray):
+    """
+    Randomized SVD (Halko et al.), the range of the data is approximated from a random projection refined by a few
+    power iterations and only the small projected matrix is decomposed exactly
+    :return: tuple of (the right singular vectors as columns, the singular values)
+    """
+    n, m = centered.shape
+    n_components = min(n_components, n, m)
+    sketch_size = min(n_components + RANDOMIZED_OVERSAMPLES, n, m)
+    basis, _ = np.linalg.qr(centered @ rng.standard_normal((m, sketch_size)))
+    for _ in range(RANDOMIZED_POWER_ITERATIONS):
+        basis, _ = np.linalg.qr(centered.T @ basis)
+        basis, _ = np.linalg.qr(centered @ basis)
+    _, singular_values, right_vectors = np.linalg.svd(basis.T @ centered, full_matrices=False)
+    return right_vectors[:n_components].T, singular_values[:n_components]
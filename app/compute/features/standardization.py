@@ -1,6 +1,10 @@
-from typing import List
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Tuple
 import numpy as np
 
+from app.compute.config import COMPUTE_CONFIG
+from app.compute.features.feature_matrix import PlaylistFeatureMatrix, FEATURE_COLUMNS
 from app.spotify.model import Track, TrackFeatures
 from app.spotify.model.track import TrackSection
 
@@ -39,3 +43,133 @@ def standardize_track_sections(playlist: List[Track]):
     for i in range(0, len(playlist)):
         playlist[i].section_analysis = (TrackSection(*section_matrix[i]),
                                         TrackSection(*section_matrix[i + len(playlist)]))
+
+
+class StandardizationStatistics:
+    """
+    Column means and standard deviations used to standardize a feature matrix,
+    start- and end-sections share the same section statistics
+    """
+    feature_mean: np.ndarray
+    feature_std: np.ndarray
+    section_mean: np.ndarray
+    section_std: np.ndarray
+
+    def __init__(self, feature_mean: np.ndarray, feature_std: np.ndarray,
+                 section_mean: np.ndarray, section_std: np.ndarray):
+        self.feature_mean = np.asarray(feature_mean, dtype=np.float64)
+        self.section_mean = np.asarray(section_mean, dtype=np.float64)
+        # Columns without variance are only centered
+        self.feature_std = np.where(feature_std == 0, 1, feature_std).astype(np.float64)
+        self.section_std = np.where(section_std == 0, 1, section_std).astype(np.float64)
+
+    @staticmethod
+    def of(feature_matrix: PlaylistFeatureMatrix) -> StandardizationStatistics:
+        """
+        Calculate the statistics of the given feature matrix
+        """
+        features = feature_matrix.features.astype(np.float64)
+        sections = np.concatenate((feature_matrix.start_sections, feature_matrix.end_sections)).astype(np.float64)
+        return StandardizationStatistics(features.mean(axis=0), features.std(axis=0),
+                                         sections.mean(axis=0), sections.std(axis=0))
+
+    def column_mean_and_std(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: mean and standard deviation for every column of a PlaylistFeatureMatrix block
+        """
+        mean = np.concatenate((self.feature_mean, self.section_mean, self.section_mean))
+        std = np.concatenate((self.feature_std, self.section_std, self.section_std))
+        return mean, std
+
+    def as_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        :return: the statistics by name, to be persisted with np.savez next to what was standardized with them
+        """
+        return {"feature_mean": self.feature_mean, "feature_std": self.feature_std,
+                "section_mean": self.section_mean, "section_std": self.section_std}
+
+    @staticmethod
+    def from_arrays(arrays) -> StandardizationStatistics:
+        """
+        :param arrays: mapping holding the arrays returned by as_arrays, e.g. a loaded .npz file
+        :return: the statistics, raises KeyError if any of them is missing
+        """
+        return StandardizationStatistics(arrays["feature_mean"], arrays["feature_std"],
+                                         arrays["section_mean"], arrays["section_std"])
+
+    def drift(self, other: StandardizationStatistics) -> float:
+        """
+        How far the other statistics have moved away from these ones
+        :param other: the statistics to compare with
+        :return: the largest shift of a column mean measured in standard deviations of these statistics,
+                 or the largest relative change of a standard deviation, whichever is bigger
+        """
+        mean, std = self.column_mean_and_std()
+        other_mean, other_std = other.column_mean_and_std()
+        mean_shift = np.abs(other_mean - mean) / std
+        std_change = np.abs(other_std / std - 1)
+        return float(max(mean_shift.max(), std_change.max()))
+
+
+def standardize_feature_matrix(feature_matrix: PlaylistFeatureMatrix,
+                               statistics: Optional[StandardizationStatistics] = None) -> PlaylistFeatureMatrix:
+    """
+    Standardizes a playlist feature matrix the same way standardize does for a list of tracks,
+    start- and end-sections share their statistics. The given matrix is left untouched.
+    :param feature_matrix: the feature matrix of the playlist
+    :param statistics: the statistics to standardize with, if none the statistics of the feature matrix itself are used
+    :return: a new, standardized feature matrix
+    """
+    statistics = StandardizationStatistics.of(feature_matrix) if statistics is None else statistics
+    mean, std = statistics.column_mean_and_std()
+    standardized = (feature_matrix.data.astype(np.float64) - mean) / std
+    return PlaylistFeatureMatrix(feature_matrix.track_ids, standardized)
+
+
+def library_statistics(database, drift_tolerance: Optional[float] = None) -> StandardizationStatistics:
+    """
+    The statistics of all tracks in the track cache, kept as running statistics by Database.insert_track.
+    Standardizing with them gives every track the same coordinates in every playlist. So that vectors and matrices
+    standardized with them stay valid, a snapshot is returned that is only replaced once the running statistics
+    drifted further than drift_tolerance away from it (see StandardizationStatistics.drift).
+    :param database: the track cache
+    :param drift_tolerance: largest tolerated drift, defaults to the configured library_statistics_drift_tolerance
+    :return: the current snapshot of the library statistics
+    """
+    drift_tolerance = COMPUTE_CONFIG["library_statistics_drift_tolerance"] if drift_tolerance is None \
+        else drift_tolerance
+    count, mean, m2 = database.get_library_statistics()
+    if np.any(count == 0):
+        raise ValueError("Statistics of an empty library are undefined")
+    std = np.sqrt(m2 / count)
+    running = StandardizationStatistics(mean[:FEATURE_COLUMNS], std[:FEATURE_COLUMNS],
+                                        mean[FEATURE_COLUMNS:], std[FEATURE_COLUMNS:])
+
+    snapshot = database.get_statistics_snapshot()
+    if snapshot is not None:
+        snapshot_mean, snapshot_std = snapshot
+        snapshot = StandardizationStatistics(snapshot_mean[:FEATURE_COLUMNS], snapshot_std[:FEATURE_COLUMNS],
+                                             snapshot_mean[FEATURE_COLUMNS:], snapshot_std[FEATURE_COLUMNS:])
+        if snapshot.drift(running) <= drift_tolerance:
+            return snapshot
+    database.put_statistics_snapshot(np.concatenate((running.feature_mean, running.section_mean)),
+                                     np.concatenate((running.feature_std, running.section_std)))
+    return running
+
+
+def statistics_for_mode(standardization_mode: str, database=None) -> Optional[StandardizationStatistics]:
+    """
+    The fixed statistics a standardization mode standardizes every playlist with
+    :param standardization_mode: "playlist" to standardize every playlist with its own statistics,
+                                 "library" with the statistics of all cached tracks (see library_statistics)
+    :param database: the track cache, required by the library standardization mode
+    :return: the statistics, or None if every playlist is standardized with its own statistics
+    """
+    if standardization_mode == "playlist":
+        return None
+    if standardization_mode == "library":
+        if database is None:
+            raise ValueError("The library standardization mode requires the track database")
+        return library_statistics(database)
+    raise ValueError(f"Unknown standardization mode {standardization_mode}")
+
@@ -1,2 +1,6 @@
 from app.compute.graph.graph_builder import build_song_adjacency_matrix
-from app.compute.graph.shortest_hamiltonian_path import approximate_shp
+from app.compute.graph.knn_graph import build_knn_song_graph, build_radius_song_graph, TransitionDistances
+from app.compute.graph.incremental import update_song_adjacency_matrix
+from app.compute.graph.shortest_hamiltonian_path import approximate_shp, extend_shp
+from app.compute.graph.tiled_matrix import iter_row_tiles
+from app.compute.graph.matrix_cache import cached_song_adjacency_matrix, get_matrix_cache, DistanceMatrixCache
@@ -0,0 +1,173 @@
+"""
+Bottleneck aware ordering, finds a path whose largest transition stays below a threshold before minimizing its total cost.
+Transitions above the threshold are pruned by giving them a penalty larger than any path could save, the candidate lists
+of the search then only hold transitions of the pruned graph.
+"""
+import time
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+from app.compute.config import COMPUTE_CONFIG
+from app.compute.graph.candidate_search import build_candidate_lists, solve_shp_candidate_search
+from app.compute.graph.local_search import nearest_neighbour_path, path_cost
+from app.compute.graph.tiled_matrix import iter_row_tiles
+
+# Number of bisection steps between the lower bound of the threshold and the target
+BISECTION_STEPS = 8
+
+
+class BottleneckResult:
+    path: np.ndarray
+    cost: float
+    threshold: float
+    target: float
+    exceeding_transitions: int
+
+    def __init__(self, path: np.ndarray, cost: float, threshold: float, target: float, exceeding_transitions: int):
+        self.path = path
+        self.cost = cost
+        self.threshold = threshold
+        self.target = target
+        self.exceeding_transitions = exceeding_transitions
+
+    @property
+    def feasible(self) -> bool:
+        """
+        :return: whether no transition of the path exceeds the target
+        """
+        return self.exceeding_transitions == 0
+
+
+def solve_shp_bottleneck(song_adj_matrix: np.ndarray, max_transition: Optional[float] = None,
+                         sigma: Optional[float] = None, time_budget: Optional[float] = None) -> BottleneckResult:
+    """
+    Find a path without transitions above max_transition, then bisect towards the smallest threshold for which such a
+    path is still found and return the cheapest path found within it.
+    Whether a threshold is feasible is decided by the search, so the result is the smallest threshold the heuristic
+    could satisfy rather than a proven optimum.
+    If even the target can not be met, the path with the fewest transitions above it is returned.
+    :param song_adj_matrix: the song adjacency matrix
+    :param max_transition: largest acceptable transition, if none mean + sigma * standard deviation of all transitions
+    :param sigma: number of standard deviations above the mean the target lies at, if max_transition is not given,
+                  defaults to the configured bottleneck_sigma
+    :param time_budget: wall clock time in seconds for all searches together
+    :return: the path together with the threshold it satisfies and the number of transitions exceeding the target
+    """
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    sigma = COMPUTE_CONFIG["bottleneck_sigma"] if sigma is None else sigma
+    mean, std = transition_statistics(song_adj_matrix)
+    target = mean + sigma * std if max_transition is None else max_transition
+
+    # Penalizing transitions keeps the order of every row, so the nearest neighbour path of the original matrix is the
+    # one of every penalized matrix and the candidate lists only have to be filtered by the threshold
+    candidates = _ThresholdCandidateLists(song_adj_matrix)
+    path, exceeding = _search_within(song_adj_matrix, target, nearest_neighbour_path(song_adj_matrix), deadline,
+                                     candidates)
+    result = BottleneckResult(path, path_cost(song_adj_matrix, path), target, target, exceeding)
+    if exceeding > 0:
+        print(f"{exceeding} transitions exceed the target distance of {target}")
+        return result
+
+    lower, upper = bottleneck_lower_bound(song_adj_matrix), target
+    for _ in range(BISECTION_STEPS):
+        if lower >= upper or (deadline is not None and time.monotonic() > deadline):
+            break
+        threshold = (lower + upper) / 2
+        path, exceeding = _search_within(song_adj_matrix, threshold, result.path, deadline, candidates)
+        if exceeding == 0:
+            upper = threshold
+            result = BottleneckResult(path, path_cost(song_adj_matrix, path), threshold, target, 0)
+        else:
+            lower = threshold
+    return result
+
+
+def transition_statistics(song_adj_matrix: np.ndarray) -> Tuple[float, float]:
+    """
+    :return: mean and standard deviation of all transitions between different tracks
+    """
+    n = song_adj_matrix.shape[0]
+    total, total_squares = 0.0, 0.0
+    for row, tile in iter_row_tiles(song_adj_matrix):
+        tile = np.array(tile, dtype=np.float64)
+        tile[np.arange(len(tile)), np.arange(row, row + len(tile))] = 0
+        total += tile.sum()
+        total_squares += np.square(tile).sum()
+    count = max(n * (n - 1), 1)
+    mean = total / count
+    return mean, float(np.sqrt(max(total_squares / count - mean ** 2, 0.0)))
+
+
+def bottleneck_lower_bound(song_adj_matrix: np.ndarray) -> float:
+    """
+    Every track but the last has to be left and every track but the first has to be entered,
+    so no path can have a smaller largest transition than the second largest shortest outgoing or incoming transition
+    :return: lower bound of the largest transition of any hamiltonian path
+    """
+    n = song_adj_matrix.shape[0]
+    if n < 3:
+        return 0.0
+    shortest_outgoing = np.empty(n)
+    shortest_incoming = np.full(n, np.inf)
+    for row, tile in iter_row_tiles(song_adj_matrix):
+        tile = np.array(tile, dtype=np.float64)
+        tile[np.arange(len(tile)), np.arange(row, row + len(tile))] = np.inf
+        shortest_outgoing[row:row + len(tile)] = tile.min(axis=1)
+        np.minimum(shortest_incoming, tile.min(axis=0), out=shortest_incoming)
+    return float(max(np.sort(shortest_outgoing)[-2], np.sort(shortest_incoming)[-2]))
+
+
+def _search_within(song_adj_matrix: np.ndarray, threshold: float, initial_path: Optional[np.ndarray],
+                   deadline: Optional[float], candidates: "_ThresholdCandidateLists") -> Tuple[np.ndarray, int]:
+    """
+    Search a cheap path on the matrix with every transition above the threshold penalized
+    :return: tuple of (path, number of transitions above the threshold)
+    """
+    candidates.threshold = threshold
+    penalized = _PenalizedDistances(song_adj_matrix, threshold)
+    remaining = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+    path, _ = solve_shp_candidate_search(penalized, initial_path=initial_path, time_budget=remaining,
+                                         candidates=candidates)
+    exceeding = int(np.count_nonzero(song_adj_matrix[path[:-1], path[1:]] > threshold))
+    return path, exceeding
+
+
+class _ThresholdCandidateLists:
+    """
+    Candidate lists of the original matrix, built once and reused for every threshold,
+    only the candidates whose transition lies within the current threshold are handed out
+    """
+
+    def __init__(self, song_adj_matrix: np.ndarray):
+        self.candidates = build_candidate_lists(song_adj_matrix)
+        rows = np.arange(len(self.candidates))[:, np.newaxis]
+        self.distances = np.asarray(song_adj_matrix[rows, self.candidates], dtype=np.float64)
+        self.shape = self.candidates.shape
+        self.threshold = np.inf
+
+    def __getitem__(self, track: int) -> np.ndarray:
+        return self.candidates[track][self.distances[track] <= self.threshold]
+
+
+class _PenalizedDistances:
+    """
+    The entries of a song adjacency matrix with every transition above the threshold penalized, computed whenever
+    they are read so no copy of the matrix is made
+    """
+
+    def __init__(self, song_adj_matrix: np.ndarray, threshold: float):
+        self.matrix = song_adj_matrix
+        self.threshold = threshold
+        # Any path of transitions within the threshold is cheaper than a path using a single transition above it
+        self.penalty = song_adj_matrix.shape[0] * threshold + 1
+        self.shape = song_adj_matrix.shape
+        self.dtype = np.dtype(np.float64)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, index: Union[int, Tuple]) -> Union[np.ndarray, np.float64]:
+        distances = np.asarray(self.matrix[index], dtype=np.float64)
+        distances = np.where(distances > self.threshold, distances + self.penalty, distances)
+        return distances[()] if distances.ndim == 0 else distances
@@ -0,0 +1,296 @@
+"""
+Local search restricted to candidate lists, only moves creating a transition from a track to one of its k nearest
+successors are evaluated. Combined with don't-look bits, tracks whose surroundings did not change since they last failed
+to improve are skipped, so evaluating a pass over the path costs O(n*k) instead of the O(n^2) of the full neighbourhood
+search. Applying a move only reads the transitions of the rearranged part of the path from the matrix.
+"""
+import time
+from collections import deque
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from app.compute.graph.local_search import nearest_neighbour_path, path_cost, ProgressCallback, \
+    IMPROVEMENT_EPSILON, OR_OPT_SEGMENT_LENGTHS
+from app.compute.graph.tiled_matrix import iter_row_tiles
+
+DEFAULT_CANDIDATES = 10
+
+
+def build_candidate_lists(song_adj_matrix: np.ndarray, k: int = DEFAULT_CANDIDATES) -> np.ndarray:
+    """
+    Find the k nearest successors of every track, the matrix is read in row tiles
+    :param song_adj_matrix: the song adjacency matrix, may be memory mapped
+    :param k: number of candidates per track
+    :return: matrix of shape (n, k), row i holds the successors of track i ordered by distance
+    """
+    n = song_adj_matrix.shape[0]
+    k = min(k, n - 1)
+    candidates = np.empty((n, max(k, 0)), dtype=int)
+    if k <= 0:
+        return candidates
+    for row, tile in iter_row_tiles(song_adj_matrix):
+        tile = np.array(tile, dtype=np.float64)
+        tile[np.arange(len(tile)), np.arange(row, row + len(tile))] = np.inf
+        nearest = np.argpartition(tile, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(tile, nearest, axis=1), axis=1, kind="stable")
+        candidates[row:row + len(tile)] = np.take_along_axis(nearest, order, axis=1)
+    return candidates
+
+
+def repair_path(song_adj_matrix: np.ndarray, path: np.ndarray, tracks: Sequence[int], k: int = DEFAULT_CANDIDATES,
+                time_budget: Optional[float] = None) -> Tuple[np.ndarray, float]:
+    """
+    Improve a path only around the given tracks, e.g. after they were inserted.
+    Only the given tracks are queued initially and further tracks are only queued once a move touched them,
+    so the candidates are looked up lazily and the search never reads more of the matrix than the rows it looks at.
+    :param song_adj_matrix: the song adjacency matrix
+    :param path: the path to improve
+    :param tracks: the tracks to look at first
+    :param k: number of candidate successors per track
+    :param time_budget: wall clock time in seconds after which the repair stops
+    :return: tuple of (path as array of indices, cost of the path)
+    """
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    search = _CandidateSearch(song_adj_matrix, np.array(path, dtype=int), _LazyCandidateLists(song_adj_matrix, k),
+                              queue=tracks)
+    while search.queue and (deadline is None or time.monotonic() <= deadline):
+        search.improve(search.pop())
+    return search.path, path_cost(song_adj_matrix, search.path)
+
+
+class _LazyCandidateLists:
+    """
+    Candidate lists as returned by build_candidate_lists, but every row is only computed once it is accessed
+    """
+
+    def __init__(self, song_adj_matrix: np.ndarray, k: int):
+        self.matrix = song_adj_matrix
+        self.shape = (song_adj_matrix.shape[0], max(min(k, song_adj_matrix.shape[0] - 1), 0))
+        self.rows: Dict[int, np.ndarray] = {}
+
+    def __getitem__(self, track: int) -> np.ndarray:
+        track = int(track)
+        if track not in self.rows:
+            k = self.shape[1]
+            distances = np.array(self.matrix[track], dtype=np.float64)
+            distances[track] = np.inf
+            nearest = np.argpartition(distances, k - 1)[:k]
+            self.rows[track] = nearest[np.argsort(distances[nearest], kind="stable")]
+        return self.rows[track]
+
+
+class GraphCandidateLists:
+    """
+    Candidate lists taken from the edges of a sparse graph, e.g. a nearest neighbour graph, instead of the dense matrix
+    """
+
+    def __init__(self, graph: csr_matrix):
+        self.graph = csr_matrix(graph)
+        row_lengths = np.diff(self.graph.indptr)
+        self.shape = (self.graph.shape[0], int(row_lengths.max()) if len(row_lengths) > 0 else 0)
+
+    def __getitem__(self, track: int) -> np.ndarray:
+        row = slice(self.graph.indptr[track], self.graph.indptr[track + 1])
+        neighbours = self.graph.indices[row][np.argsort(self.graph.data[row], kind="stable")]
+        return neighbours[neighbours != track]
+
+
+def solve_shp_candidate_search(song_adj_matrix: np.ndarray, k: int = DEFAULT_CANDIDATES,
+                               initial_path: Optional[np.ndarray] = None, time_budget: Optional[float] = None,
+                               progress_callback: Optional[ProgressCallback] = None,
+                               candidates: Optional[Union[np.ndarray, GraphCandidateLists]] = None) \
+        -> Tuple[np.ndarray, float]:
+    """
+    Approximate the shortest hamiltonian path with 2-opt and Or-opt moves restricted to candidate lists.
+    Every track whose adjacent transitions changed is queued for another look, the search ends once the queue is empty.
+    :param song_adj_matrix: the song adjacency matrix, or TransitionDistances computing its entries on demand
+    :param k: number of candidate successors per track
+    :param initial_path: path to start from, if none a nearest neighbour path is constructed
+    :param time_budget: wall clock time in seconds after which the best path found so far is returned
+    :param progress_callback: called after every n looked at tracks with the iteration, the cost of the path and
+                              the cost reduction per second since the last call
+    :param candidates: the candidate successors of every track, if none the k nearest ones are taken from the matrix
+    :return: tuple of (path as array of indices, cost of the path)
+    """
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    path = nearest_neighbour_path(song_adj_matrix) if initial_path is None else np.array(initial_path, dtype=int)
+    candidates = build_candidate_lists(song_adj_matrix, k) if candidates is None else candidates
+    search = _CandidateSearch(song_adj_matrix, path, candidates)
+    n = len(path)
+
+    cost = path_cost(song_adj_matrix, search.path)
+    if progress_callback is not None:
+        progress_callback(0, cost, 0.0)
+    looked_at = 0
+    iteration_started = time.monotonic()
+    while search.queue and (deadline is None or time.monotonic() <= deadline):
+        search.improve(search.pop())
+        looked_at += 1
+        if progress_callback is not None and looked_at % n == 0:
+            previous_cost, cost = cost, path_cost(song_adj_matrix, search.path)
+            elapsed = max(time.monotonic() - iteration_started, 1e-9)
+            progress_callback(looked_at // n, cost, (previous_cost - cost) / elapsed)
+            iteration_started = time.monotonic()
+    return search.path, path_cost(song_adj_matrix, search.path)
+
+
+class _CandidateSearch:
+    """
+    State of a candidate list search, the path, the position of every track in it, prefix sums of the forward and
+    backward transition costs along it and the queue of tracks to look at, initially every track unless a queue is given
+    """
+
+    def __init__(self, song_adj_matrix: np.ndarray, path: np.ndarray, candidates: np.ndarray,
+                 queue: Optional[Sequence[int]] = None):
+        self.matrix = song_adj_matrix
+        self.path = path
+        self.candidates = candidates
+        self.n = len(path)
+        self.position = np.empty(self.n, dtype=int)
+        self.position[path] = np.arange(self.n)
+        self._update_prefix_costs()
+        self.queue = deque()
+        self.queued = np.zeros(self.n, dtype=bool)
+        self.push(*(path.tolist() if queue is None else queue))
+
+    def pop(self) -> int:
+        track = self.queue.popleft()
+        self.queued[track] = False
+        return track
+
+    def push(self, *tracks: int):
+        for track in tracks:
+            if not self.queued[track]:
+                self.queued[track] = True
+                self.queue.append(track)
+
+    def improve(self, track: int):
+        """
+        Apply the best improving move that creates a transition from track to one of its candidates, if there is one
+        """
+        if self.n < 3 or self.candidates.shape[1] == 0:
+            return
+        moves = [self._reversal_after(track), self._reversal_from(track)]
+        moves += [self._segment_move(track, length) for length in OR_OPT_SEGMENT_LENGTHS if length < self.n]
+        moves = [move for move in moves if move is not None]
+        if not moves:
+            return
+        delta, apply = min(moves, key=lambda move: move[0])
+        if delta < -IMPROVEMENT_EPSILON:
+            apply()
+
+    def _reversal_after(self, track: int):
+        """
+        2-opt move reversing path[s..j] with s right after track, creating track -> path[j]
+        """
+        path, matrix = self.path, self.matrix
+        i = self.position[track]
+        s = i + 1
+        if s >= self.n - 1:
+            return None
+        ends = self.position[self.candidates[track]]
+        ends = ends[ends > s]
+        if len(ends) == 0:
+            return None
+        delta = matrix[track, path[ends]] - matrix[track, path[s]] + self._reversed_inner_delta(s, ends)
+        inner = ends < self.n - 1
+        delta[inner] += matrix[path[s], path[ends[inner] + 1]] - matrix[path[ends[inner]], path[ends[inner] + 1]]
+        best = int(np.argmin(delta))
+        return delta[best], lambda: self._reverse(s, int(ends[best]))
+
+    def _reversal_from(self, track: int):
+        """
+        2-opt move reversing path[i..j] with track at i, creating track -> path[j + 1]
+        """
+        path, matrix = self.path, self.matrix
+        i = self.position[track]
+        ends = self.position[self.candidates[track]] - 1
+        ends = ends[ends > i]
+        if len(ends) == 0:
+            return None
+        delta = matrix[track, path[ends + 1]] - matrix[path[ends], path[ends + 1]] + self._reversed_inner_delta(i, ends)
+        if i > 0:
+            delta += matrix[path[i - 1], path[ends]] - matrix[path[i - 1], track]
+        best = int(np.argmin(delta))
+        return delta[best], lambda: self._reverse(i, int(ends[best]))
+
+    def _segment_move(self, track: int, length: int):
+        """
+        Or-opt move of the segment of the given length starting at track, placing it right before a candidate of its
+        last track
+        """
+        path, matrix = self.path, self.matrix
+        i = self.position[track]
+        if i + length > self.n:
+            return None
+        last = path[i + length - 1]
+        targets = self.position[self.candidates[last]]
+        targets = targets[((targets < i) | (targets >= i + length)) & (targets != i + length)]
+        if len(targets) == 0:
+            return None
+
+        removal_gain = 0.0
+        if i > 0:
+            removal_gain += matrix[path[i - 1], track]
+        if i + length < self.n:
+            removal_gain += matrix[last, path[i + length]]
+        if i > 0 and i + length < self.n:
+            removal_gain -= matrix[path[i - 1], path[i + length]]
+
+        delta = matrix[last, path[targets]] - removal_gain
+        has_predecessor = targets > 0
+        predecessors = path[targets[has_predecessor] - 1]
+        delta[has_predecessor] += matrix[predecessors, track] - matrix[predecessors, path[targets[has_predecessor]]]
+        best = int(np.argmin(delta))
+        return delta[best], lambda: self._move_segment(i, length, int(targets[best]))
+
+    def _reversed_inner_delta(self, i: int, ends: np.ndarray) -> np.ndarray:
+        return (self.backward[ends] - self.backward[i]) - (self.forward[ends] - self.forward[i])
+
+    def _reverse(self, i: int, j: int):
+        touched = self._neighbourhood(i, j)
+        self.path[i:j + 1] = self.path[i:j + 1][::-1]
+        self._update_span(i, j)
+        self.push(*touched)
+
+    def _move_segment(self, i: int, length: int, target: int):
+        touched = self._neighbourhood(i, i + length - 1) + self._neighbourhood(target - 1, target)
+        segment = self.path[i:i + length].copy()
+        if target < i:
+            self.path[target:i + length] = np.concatenate((segment, self.path[target:i]))
+            self._update_span(target, i + length - 1)
+        else:
+            self.path[i:target] = np.concatenate((self.path[i + length:target], segment))
+            self._update_span(i, target - 1)
+        self.push(*touched)
+
+    def _neighbourhood(self, i: int, j: int) -> list:
+        """
+        :return: the tracks at positions i - 1, i, j and j + 1, as far as they exist
+        """
+        return [int(self.path[p]) for p in (i - 1, i, j, j + 1) if 0 <= p < self.n]
+
+    def _update_prefix_costs(self):
+        self.forward = np.zeros(self.n)
+        self.backward = np.zeros(self.n)
+        np.cumsum(self.matrix[self.path[:-1], self.path[1:]], dtype=np.float64, out=self.forward[1:])
+        np.cumsum(self.matrix[self.path[1:], self.path[:-1]], dtype=np.float64, out=self.backward[1:])
+
+    def _update_span(self, start: int, end: int):
+        """
+        Update the positions and prefix costs after the tracks at positions start..end were rearranged.
+        Only the transitions into and within the span are read from the matrix, the prefix costs behind it are shifted
+        by the change of the cost up to its end.
+        """
+        self.position[self.path[start:end + 1]] = np.arange(start, end + 1)
+        first, last = max(start, 1), min(end + 1, self.n - 1)
+        if first > last:
+            return
+        predecessors, successors = self.path[first - 1:last], self.path[first:last + 1]
+        for prefix, costs in ((self.forward, self.matrix[predecessors, successors]),
+                              (self.backward, self.matrix[successors, predecessors])):
+            previous_end = prefix[last]
+            prefix[first:last + 1] = prefix[first - 1] + np.cumsum(costs, dtype=np.float64)
+            prefix[last + 1:] += prefix[last] - previous_end
@@ -1,31 +1,71 @@
-from typing import List, Optional
+from typing import List, Optional, Union
 
 import numpy as np
 
-from app.compute.features import create_feature_vector
+from app.compute.features import create_feature_vector, PlaylistFeatureMatrix
+from app.compute.graph.tiled_matrix import create_scratch_matrix, use_out_of_core
 from app.spotify.model import PlayList, Track
 
 DEFAULT_COMPONENT_WEIGHTS = np.array([1]*7)
+# Upper bound for the number of float64 elements of the (rows, n, dimensions) difference tensor held at once
+DISTANCE_TILE_ELEMENTS = 2 ** 22
 
 
-def build_song_adjacency_matrix(playlist: PlayList) -> np.ndarray:
+def build_song_adjacency_matrix(playlist: Union[PlayList, PlaylistFeatureMatrix],
+                                component_weights: Optional[List[float]] = None,
+                                out_of_core: Optional[bool] = None) -> np.ndarray:
     """
     Builds an adjacency matrix of a graph containing the distances between all tracks
 
-    :param playlist: Playlist to be made into a track
+    :param playlist: Playlist, or feature matrix of a playlist, to be made into a graph
+    :param component_weights: Weights for the different components of the distance calculation if none resorts to unweighted
+    :param out_of_core: Whether to compute the matrix into a memory mapped scratch file instead of memory,
+                        if none this is decided by the configured size threshold
     :return: adjacency matrix of the complete graph connecting all songs with their distance
     """
-    tracks: List[Track] = playlist.tracks
-    n: int = len(tracks)
-    song_adjacency: np.array = np.zeros((n, n), dtype=np.float32)
+    component_weights = DEFAULT_COMPONENT_WEIGHTS if component_weights is None else component_weights
+    feature_matrix = playlist if isinstance(playlist, PlaylistFeatureMatrix) \
+        else PlaylistFeatureMatrix.from_tracks(playlist.tracks)
+    n = len(feature_matrix)
+    out_of_core = use_out_of_core(n) if out_of_core is None else out_of_core
+
+    out = create_scratch_matrix((n, n)) if out_of_core else None
+    return calculate_distance_matrix(feature_matrix.end_vectors(), feature_matrix.start_vectors(), component_weights,
+                                     out=out)
+
+
+def calculate_distance_matrix(origin_vectors: np.ndarray, target_vectors: np.ndarray,
+                              component_weights: Optional[List[float]] = None,
+                              out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Calculates the weighted distances from every origin vector to every target vector.
+    Rows are computed in tiles, the per-component differences are taken in float32 and the weighted norm is
+    accumulated in float64 just like calculate_distance does, so both produce identical float32 results.
+
+    :param origin_vectors: matrix of shape (n, dimensions), usually the end vectors of the tracks
+    :param target_vectors: matrix of shape (m, dimensions), usually the start vectors of the tracks
+    :param component_weights: Weights for the different components of the distance calculation if none resorts to unweighted
+    :param out: float32 matrix of shape (n, m) to write the distances into, e.g. a memory mapped scratch matrix
+    :return: matrix of shape (n, m) where entry (i, j) is the distance from origin i to target j
+    """
+    component_weights = DEFAULT_COMPONENT_WEIGHTS if component_weights is None else component_weights
+    weights = np.asarray(component_weights, dtype=np.float64)
+    origin_vectors = np.asarray(origin_vectors, dtype=np.float32)
+    target_vectors = np.asarray(target_vectors, dtype=np.float32)
+
+    n, dimensions = origin_vectors.shape
+    m = target_vectors.shape[0]
+    distances = np.empty((n, m), dtype=np.float32) if out is None else out
+    tile_rows = max(1, DISTANCE_TILE_ELEMENTS // max(1, m * dimensions))
 
-    # outer iterator iterates over all tracks in playlist
-    for outer_track_iterator in range(0, len(tracks)):
-        for inner_track_iterator in range(0, len(tracks)):
-            distance = calculate_distance(tracks[outer_track_iterator], tracks[inner_track_iterator])
-            song_adjacency[outer_track_iterator][inner_track_iterator] = distance
+    for row in range(0, n, tile_rows):
+        tile = origin_vectors[row:row + tile_rows]
+        weighted_difference = (tile[:, np.newaxis, :] - target_vectors[np.newaxis, :, :]) * weights
+        distances[row:row + tile_rows] = np.sqrt(np.einsum("ijk,ijk->ij", weighted_difference, weighted_difference))
 
-    return song_adjacency
+    if isinstance(distances, np.memmap):
+        distances.flush()
+    return distances
 
 
 def calculate_distance(origin_track: Track, target_track: Track, component_weights: Optional[List[float]] = None) ->\
@@ -42,4 +82,4 @@ def calculate_distance(origin_track: Track, target_track: Track, component_weigh
     origin_track_vector = create_feature_vector(origin_track, start=False)
     target_track_vector = create_feature_vector(target_track, start=True)
 
-    return np.linalg.norm((origin_track_vector-target_track_vector)*component_weights)
\ No newline at end of file
+    return np.linalg.norm((origin_track_vector-target_track_vector)*component_weights)
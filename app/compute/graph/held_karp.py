@@ -0,0 +1,60 @@
+"""
+Exact solver for the shortest hamiltonian path of small playlists, Held-Karp dynamic programming over subsets of tracks.
+All subsets of the same size are extended at once with NumPy, time and memory grow with 2^n * n^2.
+"""
+from typing import Tuple
+
+import numpy as np
+
+# Beyond this the subset tables no longer fit comfortably into memory, at 18 tracks the cost table takes 38 MB and
+# extending the largest layer of subsets 126 MB, every further track multiplies both by more than two
+MAX_EXACT_TRACKS = 18
+
+
+def solve_shp_exact(song_adj_matrix: np.ndarray) -> Tuple[np.ndarray, float]:
+    """
+    Find the shortest hamiltonian path, the path may start and end at any track
+    :param song_adj_matrix: the song adjacency matrix of at most MAX_EXACT_TRACKS tracks
+    :return: tuple of (optimal path as array of indices, its cost)
+    """
+    n = song_adj_matrix.shape[0]
+    if n > MAX_EXACT_TRACKS:
+        raise ValueError(f"The exact solver supports at most {MAX_EXACT_TRACKS} tracks, got {n}")
+    if n <= 1:
+        return np.arange(n), 0.0
+
+    distances = np.asarray(song_adj_matrix, dtype=np.float64)
+    subsets = 1 << n
+    bits = 1 << np.arange(n)
+    # cost[s, j] is the cost of the cheapest path through the tracks in subset s that ends in track j
+    cost = np.full((subsets, n), np.inf)
+    predecessor = np.full((subsets, n), -1, dtype=np.int8)
+    cost[bits, np.arange(n)] = 0
+
+    all_subsets = np.arange(subsets)
+    subset_sizes = np.zeros(subsets, dtype=int)
+    for bit in bits:
+        subset_sizes += (all_subsets & bit) > 0
+
+    for size in range(1, n):
+        current = all_subsets[subset_sizes == size]
+        # extended[s, j, k] is the cost of appending k to the best path through s ending in j
+        extended = cost[current][:, :, np.newaxis] + distances[np.newaxis, :, :]
+        best_last = np.argmin(extended, axis=1)
+        best_cost = np.take_along_axis(extended, best_last[:, np.newaxis, :], axis=1)[:, 0, :]
+
+        # Every (subset, k) is reached from exactly one smaller subset, so the results can be assigned directly
+        appendable = (current[:, np.newaxis] & bits) == 0
+        rows, tracks = np.nonzero(appendable)
+        extended_subsets = current[rows] | bits[tracks]
+        cost[extended_subsets, tracks] = best_cost[rows, tracks]
+        predecessor[extended_subsets, tracks] = best_last[rows, tracks]
+
+    subset = subsets - 1
+    last = int(np.argmin(cost[subset]))
+    total = float(cost[subset, last])
+    path = [last]
+    while predecessor[subset, last] >= 0:
+        subset, last = subset & ~(1 << last), int(predecessor[subset, last])
+        path.append(last)
+    return np.array(path[::-1]), total
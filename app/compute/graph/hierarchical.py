@@ -0,0 +1,104 @@
+"""
+Hierarchical optimization, the playlist is partitioned into clusters, every cluster is solved on its own,
+the clusters are ordered by a path over their endpoints and the sub-paths are stitched together.
+"""
+from concurrent.futures import Executor
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from app.compute.graph.local_search import solve_shp_local_search, path_cost
+
+# Clusters up to this size are solved in the calling process, shipping them to a worker costs more than solving them
+INLINE_CLUSTER_SIZE = 8
+
+
+def solve_shp_hierarchical(song_adj_matrix: np.ndarray, labels: np.ndarray, pool: Optional[Executor] = None,
+                           time_budget: Optional[float] = None) -> Tuple[np.ndarray, float]:
+    """
+    Approximate the shortest hamiltonian path cluster by cluster.
+    1. the tracks are partitioned by the given cluster labels, noise (label -1) forms clusters of single tracks
+    2. the sub-path of every cluster is solved independently, in parallel if a pool is given
+    3. the clusters are ordered by a path over the matrix of distances from the end of one sub-path
+       to the start of another
+    4. the sub-paths are stitched, every sub-path may be rotated so that it starts with the track that follows best on
+       the end of its predecessor
+    :param song_adj_matrix: the song adjacency matrix
+    :param labels: cluster label of every track, e.g. from cluster_k_means or cluster_dbscan
+    :param pool: process pool to solve the clusters in, if none they are solved one after another
+    :param time_budget: wall clock time in seconds for solving all clusters sequentially,
+                        every cluster gets a share proportional to its size
+    :return: tuple of (path as array of indices, its cost)
+    """
+    labels = np.asarray(labels)
+    n = song_adj_matrix.shape[0]
+    clusters = _partition(labels)
+
+    def budget(members: np.ndarray) -> Optional[float]:
+        return None if time_budget is None else time_budget * len(members) / n
+
+    sub_paths: List[Optional[np.ndarray]] = [None] * len(clusters)
+    futures = {}
+    for c, members in enumerate(clusters):
+        submatrix = np.asarray(song_adj_matrix[np.ix_(members, members)])
+        if pool is None or len(members) <= INLINE_CLUSTER_SIZE:
+            sub_paths[c] = members[_solve_cluster(submatrix, budget(members))]
+        else:
+            futures[c] = pool.submit(_solve_cluster, submatrix, budget(members))
+    for c, future in futures.items():
+        sub_paths[c] = clusters[c][future.result()]
+
+    cluster_order = _order_clusters(song_adj_matrix, sub_paths)
+    path = _stitch(song_adj_matrix, [sub_paths[c] for c in cluster_order])
+    return path, path_cost(song_adj_matrix, path)
+
+
+def _partition(labels: np.ndarray) -> List[np.ndarray]:
+    """
+    :return: the member indices of every cluster, noise points each form their own cluster
+    """
+    clusters = [np.flatnonzero(labels == label) for label in np.unique(labels) if label != -1]
+    clusters += [np.array([i]) for i in np.flatnonzero(labels == -1)]
+    return clusters
+
+
+def _solve_cluster(submatrix: np.ndarray, time_budget: Optional[float]) -> np.ndarray:
+    """
+    Solve the sub-path of a single cluster, executed in a worker process if a pool is used
+    :return: the path as indices into the submatrix
+    """
+    path, _ = solve_shp_local_search(submatrix, time_budget=time_budget)
+    return path
+
+
+def _order_clusters(song_adj_matrix: np.ndarray, sub_paths: List[np.ndarray]) -> np.ndarray:
+    """
+    Order the clusters by solving the path over the distances from the last track of every sub-path to the first one
+    of every other sub-path
+    :return: the cluster indices in order
+    """
+    firsts = np.array([sub_path[0] for sub_path in sub_paths])
+    lasts = np.array([sub_path[-1] for sub_path in sub_paths])
+    cluster_matrix = np.asarray(song_adj_matrix[np.ix_(lasts, firsts)])
+    order, _ = solve_shp_local_search(cluster_matrix)
+    return order
+
+
+def _stitch(song_adj_matrix: np.ndarray, ordered_sub_paths: List[np.ndarray]) -> np.ndarray:
+    """
+    Concatenate the sub-paths, rotating every sub-path p to p[r:] + p[:r] if the better entry into it outweighs
+    trading the transition p[r-1] -> p[r] for p[-1] -> p[0]
+    :return: the complete path
+    """
+    path = [ordered_sub_paths[0]]
+    for sub_path in ordered_sub_paths[1:]:
+        previous_last = path[-1][-1]
+        if len(sub_path) > 1:
+            # cost of entering at r plus the transition closing the rotation minus the one it cuts, for every r
+            rotation_costs = np.asarray(song_adj_matrix[previous_last, sub_path], dtype=np.float64)
+            rotation_costs[1:] += song_adj_matrix[sub_path[-1], sub_path[0]] \
+                - song_adj_matrix[sub_path[:-1], sub_path[1:]]
+            r = int(np.argmin(rotation_costs))
+            sub_path = np.concatenate((sub_path[r:], sub_path[:r]))
+        path.append(sub_path)
+    return np.concatenate(path)
@@ -0,0 +1,73 @@
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.compute.config import COMPUTE_CONFIG
+from app.compute.features import PlaylistFeatureMatrix, StandardizationStatistics, standardize_feature_matrix
+from app.compute.graph.graph_builder import build_song_adjacency_matrix, calculate_distance_matrix
+from app.compute.graph.tiled_matrix import create_scratch_matrix, use_out_of_core
+
+# Largest drift of the playlist statistics (see StandardizationStatistics.drift) tolerated before rebuilding everything
+DEFAULT_DRIFT_TOLERANCE = 0.05
+
+
+def update_song_adjacency_matrix(previous_matrix: np.ndarray, previous_track_ids: Sequence[str],
+                                 previous_statistics: StandardizationStatistics,
+                                 feature_matrix: PlaylistFeatureMatrix,
+                                 component_weights: Optional[List[float]] = None,
+                                 drift_tolerance: float = DEFAULT_DRIFT_TOLERANCE) \
+        -> Tuple[np.ndarray, StandardizationStatistics, bool]:
+    """
+    Derives the song adjacency matrix of a changed playlist from the matrix of its previous version.
+    Distances between tracks present in both versions are copied, only the rows and columns of added tracks are
+    computed, which costs O(n*added) instead of O(n^2). Large matrices are built into a memory mapped scratch matrix
+    and are copied and computed in tiles of rows, like build_song_adjacency_matrix does.
+
+    The copied distances are only valid as long as every track is standardized with the same statistics, so the new
+    tracks are standardized with previous_statistics. Once the statistics of the new playlist drifted further than
+    drift_tolerance away from them, the whole matrix is rebuilt with the new statistics instead.
+
+    :param previous_matrix: song adjacency matrix of the previous version of the playlist
+    :param previous_track_ids: track ids of the previous version, in the order of previous_matrix
+    :param previous_statistics: statistics previous_matrix was standardized with
+    :param feature_matrix: unstandardized feature matrix of the new version of the playlist
+    :param component_weights: Weights for the different components of the distance calculation if none resorts to unweighted
+    :param drift_tolerance: largest tolerated drift of the statistics before a full rebuild
+    :return: tuple of (song adjacency matrix in the order of feature_matrix, statistics it was standardized with,
+             whether it was fully rebuilt)
+    """
+    statistics = StandardizationStatistics.of(feature_matrix)
+    if previous_statistics.drift(statistics) > drift_tolerance:
+        song_adj_matrix = build_song_adjacency_matrix(standardize_feature_matrix(feature_matrix, statistics),
+                                                      component_weights)
+        return song_adj_matrix, statistics, True
+
+    standardized = standardize_feature_matrix(feature_matrix, previous_statistics)
+    previous_index = {track_id: i for i, track_id in enumerate(previous_track_ids)}
+    kept_positions = np.array([i for i, track_id in enumerate(standardized.track_ids) if track_id in previous_index],
+                              dtype=int)
+    previous_positions = np.array([previous_index[standardized.track_ids[i]] for i in kept_positions], dtype=int)
+    added_positions = np.array([i for i, track_id in enumerate(standardized.track_ids)
+                                if track_id not in previous_index], dtype=int)
+
+    n = len(standardized)
+    song_adj_matrix = create_scratch_matrix((n, n)) if use_out_of_core(n) else np.empty((n, n), dtype=np.float32)
+    tile_rows = COMPUTE_CONFIG["tile_rows"]
+    for row in range(0, len(kept_positions), tile_rows):
+        rows = slice(row, row + tile_rows)
+        previous_rows = np.asarray(previous_matrix[previous_positions[rows]])
+        song_adj_matrix[np.ix_(kept_positions[rows], kept_positions)] = previous_rows[:, previous_positions]
+
+    start_vectors = standardized.start_vectors()
+    end_vectors = standardized.end_vectors()
+    for row in range(0, len(added_positions), tile_rows):
+        added = added_positions[row:row + tile_rows]
+        song_adj_matrix[added] = calculate_distance_matrix(end_vectors[added], start_vectors, component_weights)
+    for row in range(0, n if len(added_positions) > 0 else 0, tile_rows):
+        song_adj_matrix[row:row + tile_rows, added_positions] = \
+            calculate_distance_matrix(end_vectors[row:row + tile_rows], start_vectors[added_positions],
+                                      component_weights)
+
+    if isinstance(song_adj_matrix, np.memmap):
+        song_adj_matrix.flush()
+    return song_adj_matrix, previous_statistics, False
@@ -0,0 +1,55 @@
+"""
+Incremental ordering, tracks added to an already optimized playlist are inserted into its previous order instead of
+solving the whole path again. Every insertion only reads the row and column of the inserted track.
+"""
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.compute.graph.candidate_search import repair_path, DEFAULT_CANDIDATES
+
+
+def cheapest_insertion(song_adj_matrix: np.ndarray, path: np.ndarray, new_tracks: Sequence[int]) -> np.ndarray:
+    """
+    Insert the tracks one after another at the position where they add the least cost to the path
+    :param song_adj_matrix: the song adjacency matrix
+    :param path: the path to insert into, may be empty
+    :param new_tracks: the tracks to insert, must not be part of the path
+    :return: the extended path
+    """
+    path = np.asarray(path, dtype=int)
+    for track in new_tracks:
+        if len(path) == 0:
+            path = np.array([track])
+            continue
+        incoming = np.asarray(song_adj_matrix[path, track], dtype=np.float64)
+        outgoing = np.asarray(song_adj_matrix[track, path], dtype=np.float64)
+        # costs[q] is the added cost of inserting before path[q], costs[-1] of appending after the last track
+        costs = np.zeros(len(path) + 1)
+        costs[1:] += incoming
+        costs[:-1] += outgoing
+        costs[1:-1] -= song_adj_matrix[path[:-1], path[1:]]
+        position = int(np.argmin(costs))
+        path = np.insert(path, position, track)
+    return path
+
+
+def insert_tracks(song_adj_matrix: np.ndarray, path: np.ndarray, new_tracks: Sequence[int],
+                  k: int = DEFAULT_CANDIDATES, time_budget: Optional[float] = None) -> Tuple[np.ndarray, float]:
+    """
+    Insert tracks into an existing path by cheapest insertion and repair the path around them,
+    see cheapest_insertion and repair_path
+    :param song_adj_matrix: the song adjacency matrix
+    :param path: the previous path, together with new_tracks it has to contain every track of the matrix
+    :param new_tracks: the tracks to insert, must not be part of the path
+    :param k: number of candidate successors per track for the repair
+    :param time_budget: wall clock time in seconds for the repair
+    :return: tuple of (path as array of indices, cost of the path)
+    """
+    path = cheapest_insertion(song_adj_matrix, path, new_tracks)
+    position = np.empty(song_adj_matrix.shape[0], dtype=int)
+    position[path] = np.arange(len(path))
+    # The inserted tracks and their new neighbours
+    touched = [int(path[p]) for track in new_tracks for p in range(position[track] - 1, position[track] + 2)
+               if 0 <= p < len(path)]
+    return repair_path(song_adj_matrix, path, touched, k, time_budget)
@@ -0,0 +1,119 @@
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+from app.compute.features import PlaylistFeatureMatrix
+from app.compute.graph.graph_builder import DEFAULT_COMPONENT_WEIGHTS
+from app.spotify.model import PlayList
+
+DEFAULT_NEIGHBOURS = 16
+
+
+class TransitionDistances:
+    """
+    The distances of a song adjacency matrix, computed from the feature vectors whenever they are read.
+    Supports the indexing the solvers use on dense matrices, matrix[i] for a row and matrix[rows, columns] for
+    single entries, so a path over a sparse graph can be searched and reported with its true costs, including the
+    transitions the graph does not contain.
+    """
+
+    def __init__(self, feature_matrix: PlaylistFeatureMatrix, component_weights: Optional[List[float]] = None):
+        """
+        :param feature_matrix: the standardized feature matrix the graph was built from
+        :param component_weights: the weights the graph was built with
+        """
+        component_weights = DEFAULT_COMPONENT_WEIGHTS if component_weights is None else component_weights
+        self.weights = np.asarray(component_weights, dtype=np.float64)
+        self.end_vectors = np.asarray(feature_matrix.end_vectors(), dtype=np.float32)
+        self.start_vectors = np.asarray(feature_matrix.start_vectors(), dtype=np.float32)
+        self.shape = (len(feature_matrix), len(feature_matrix))
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, index: Union[int, Tuple]) -> Union[np.ndarray, np.float32]:
+        if isinstance(index, tuple):
+            rows, columns = np.broadcast_arrays(*index)
+        else:
+            columns = np.arange(self.shape[1])
+            rows = np.full(len(columns), index)
+        # Same precision as calculate_distance_matrix, so the values equal those of the dense matrix
+        weighted_difference = (self.end_vectors[rows] - self.start_vectors[columns]) * self.weights
+        distances = np.sqrt(np.einsum("...k,...k->...", weighted_difference, weighted_difference)).astype(np.float32)
+        return distances[()] if distances.ndim == 0 else distances
+
+
+def build_knn_song_graph(playlist: Union[PlayList, PlaylistFeatureMatrix], k: int = DEFAULT_NEIGHBOURS,
+                         component_weights: Optional[List[float]] = None) -> csr_matrix:
+    """
+    Builds a sparse transition graph that only connects every track to the k tracks it transitions to best.
+    The neighbours are found with a KD-tree over the weighted start vectors queried with the weighted end vectors,
+    so memory and build time scale with n*k instead of n^2.
+
+    :param playlist: Playlist, or feature matrix of a playlist, to be made into a graph
+    :param k: number of outgoing edges per track
+    :param component_weights: Weights for the different components of the distance calculation if none resorts to unweighted
+    :return: adjacency matrix in CSR format, entry (i, j) is the distance from the end of track i to the start of track j
+    """
+    component_weights = DEFAULT_COMPONENT_WEIGHTS if component_weights is None else component_weights
+    weights = np.asarray(component_weights, dtype=np.float64)
+    feature_matrix = playlist if isinstance(playlist, PlaylistFeatureMatrix) \
+        else PlaylistFeatureMatrix.from_tracks(playlist.tracks)
+    n = len(feature_matrix)
+    k = min(k, n - 1)
+    if k <= 0:
+        return csr_matrix((n, n), dtype=np.float32)
+
+    start_vectors = feature_matrix.start_vectors()
+    end_vectors = feature_matrix.end_vectors()
+    tree = cKDTree(start_vectors * weights)
+    distances, neighbours = tree.query(end_vectors * weights, k=k + 1)
+
+    # Drop the edge from every track to itself, and if a track is not among its own neighbours the farthest one
+    distances[neighbours == np.arange(n)[:, np.newaxis]] = np.inf
+    keep = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    neighbours = np.take_along_axis(neighbours, keep, axis=1)
+
+    # Recompute the kept distances exactly the way the dense graph builder does
+    rows = np.repeat(np.arange(n), k)
+    columns = neighbours.ravel()
+    weighted_difference = (end_vectors[rows] - start_vectors[columns]) * weights
+    data = np.sqrt(np.einsum("ij,ij->i", weighted_difference, weighted_difference)).astype(np.float32)
+
+    return csr_matrix((data, columns, np.arange(0, n * k + 1, k)), shape=(n, n))
+
+
+def build_radius_song_graph(playlist: Union[PlayList, PlaylistFeatureMatrix], eps: float,
+                            component_weights: Optional[List[float]] = None) -> csr_matrix:
+    """
+    Builds a sparse transition graph that connects every track to all tracks it transitions to with a distance below
+    eps, i.e. the eps-neighbourhoods DBSCAN works on. The neighbourhoods are found with a KD-tree like in
+    build_knn_song_graph, so the dense matrix is never built.
+
+    :param playlist: Playlist, or feature matrix of a playlist, to be made into a graph
+    :param eps: edges with a distance of at least eps are left out
+    :param component_weights: Weights for the different components of the distance calculation if none resorts to unweighted
+    :return: adjacency matrix in CSR format, entry (i, j) is the distance from the end of track i to the start of track j
+    """
+    component_weights = DEFAULT_COMPONENT_WEIGHTS if component_weights is None else component_weights
+    weights = np.asarray(component_weights, dtype=np.float64)
+    feature_matrix = playlist if isinstance(playlist, PlaylistFeatureMatrix) \
+        else PlaylistFeatureMatrix.from_tracks(playlist.tracks)
+    n = len(feature_matrix)
+
+    start_vectors = feature_matrix.start_vectors()
+    end_vectors = feature_matrix.end_vectors()
+    pairs = cKDTree(end_vectors * weights).query_ball_tree(cKDTree(start_vectors * weights), eps)
+    rows = np.repeat(np.arange(n), [len(columns) for columns in pairs])
+    columns = np.fromiter((column for row_columns in pairs for column in sorted(row_columns)), dtype=int,
+                          count=len(rows))
+
+    # Recompute the distances exactly the way the dense graph builder does, the tree includes distances equal to eps
+    weighted_difference = (end_vectors[rows] - start_vectors[columns]) * weights
+    data = np.sqrt(np.einsum("ij,ij->i", weighted_difference, weighted_difference)).astype(np.float32)
+    keep = data < eps
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows[keep], minlength=n))))
+    return csr_matrix((data[keep], columns[keep], indptr), shape=(n, n))
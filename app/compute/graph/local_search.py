@@ -0,0 +1,232 @@
+"""
+Local search for the shortest hamiltonian path on an asymmetric distance matrix.
+The path is built with a nearest neighbour construction and improved with 2-opt and Or-opt moves,
+the deltas of all moves sharing their first position are evaluated at once with NumPy.
+The open path is solved directly, so no dummy vertex and no copy of the matrix are needed.
+"""
+import time
+from typing import Optional, Protocol, Tuple
+
+import numpy as np
+
+# Minimal improvement for a move to be applied, guards against cycling on rounding noise
+IMPROVEMENT_EPSILON = 1e-6
+OR_OPT_SEGMENT_LENGTHS = (1, 2, 3)
+
+
+class ProgressCallback(Protocol):
+    def __call__(self, iteration: int, best_cost: float, improvement_rate: float) -> None: ...
+
+
+def solve_shp_local_search(song_adj_matrix: np.ndarray, initial_path: Optional[np.ndarray] = None,
+                           time_budget: Optional[float] = None,
+                           progress_callback: Optional[ProgressCallback] = None) -> Tuple[np.ndarray, float]:
+    """
+    Approximate the shortest hamiltonian path by alternating 2-opt and Or-opt passes until neither improves the path.
+    Moves are only ever applied if they improve the path, so once the time budget runs out the current path is the best
+    one found so far and is returned right away.
+    :param song_adj_matrix: the (asymmetric) song adjacency matrix, entry (i, j) is the cost of playing j after i
+    :param initial_path: path to start from, if none a nearest neighbour path is constructed
+    :param time_budget: wall clock time in seconds after which the search stops, if none it runs until convergence
+    :param progress_callback: called after the construction and after every pass with the iteration,
+                              the cost of the best path and the cost reduction per second during the last pass
+    :return: tuple of (path as array of indices, cost of the path)
+    """
+    started = time.monotonic()
+    deadline = None if time_budget is None else started + time_budget
+
+    path = nearest_neighbour_path(song_adj_matrix) if initial_path is None else np.array(initial_path, dtype=int)
+    cost = path_cost(song_adj_matrix, path)
+    if progress_callback is not None:
+        progress_callback(0, cost, 0.0)
+
+    iteration = 0
+    improved = True
+    while improved and not _expired(deadline):
+        iteration += 1
+        pass_started = time.monotonic()
+        improved = two_opt_pass(song_adj_matrix, path, deadline)
+        improved = or_opt_pass(song_adj_matrix, path, deadline) or improved
+
+        previous_cost, cost = cost, path_cost(song_adj_matrix, path)
+        if progress_callback is not None:
+            elapsed = max(time.monotonic() - pass_started, 1e-9)
+            progress_callback(iteration, cost, (previous_cost - cost) / elapsed)
+    return path, cost
+
+
+def path_cost(song_adj_matrix: np.ndarray, path: np.ndarray) -> float:
+    """
+    :return: the summed cost of all transitions along the path
+    """
+    path = np.asarray(path, dtype=int)
+    return float(np.sum(song_adj_matrix[path[:-1], path[1:]], dtype=np.float64))
+
+
+def nearest_neighbour_path(song_adj_matrix: np.ndarray, start: Optional[int] = None) -> np.ndarray:
+    """
+    Build a path by always continuing with the closest track not yet in the path
+    :param song_adj_matrix: the song adjacency matrix
+    :param start: first track of the path, if none the track whose closest predecessor is farthest away,
+                  as it is the most expensive one to reach from anywhere else
+    :return: the path as array of indices
+    """
+    n = song_adj_matrix.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    if start is None:
+        start = hardest_to_reach(song_adj_matrix)
+
+    path = np.empty(n, dtype=int)
+    visited = np.zeros(n, dtype=bool)
+    current = start
+    for position in range(n):
+        path[position] = current
+        visited[current] = True
+        if position < n - 1:
+            current = int(np.argmin(np.where(visited, np.inf, song_adj_matrix[current])))
+    return path
+
+
+def randomized_nearest_neighbour_path(song_adj_matrix: np.ndarray, rng: np.random.Generator,
+                                      choices: int = 3) -> np.ndarray:
+    """
+    Build a path from a random track by continuing with a random one of the closest tracks not yet in the path,
+    used to diversify the starting points of independent searches
+    :param song_adj_matrix: the song adjacency matrix
+    :param rng: random generator to draw from
+    :param choices: number of closest tracks to choose from in every step
+    :return: the path as array of indices
+    """
+    n = song_adj_matrix.shape[0]
+    path = np.empty(n, dtype=int)
+    visited = np.zeros(n, dtype=bool)
+    current = int(rng.integers(n)) if n > 0 else 0
+    for position in range(n):
+        path[position] = current
+        visited[current] = True
+        remaining = n - position - 1
+        if remaining > 0:
+            distances = np.where(visited, np.inf, song_adj_matrix[current])
+            closest = np.argpartition(distances, min(choices, remaining) - 1)[:min(choices, remaining)]
+            current = int(rng.choice(closest))
+    return path
+
+
+def hardest_to_reach(song_adj_matrix: np.ndarray) -> int:
+    """
+    :return: the track with the largest distance to its closest predecessor, self transitions not counted
+    """
+    n = song_adj_matrix.shape[0]
+    if n == 1:
+        return 0
+    closest_predecessor = np.full(n, np.inf)
+    for row in range(n):
+        distances = np.array(song_adj_matrix[row], dtype=np.float64)
+        distances[row] = np.inf
+        np.minimum(closest_predecessor, distances, out=closest_predecessor)
+    return int(np.argmax(closest_predecessor))
+
+
+def two_opt_pass(song_adj_matrix: np.ndarray, path: np.ndarray, deadline: Optional[float] = None) -> bool:
+    """
+    Improve the path in place by reversing segments path[i..j].
+    As the matrix is asymmetric, the cost of the reversed segment is taken from prefix sums of the backwards transitions.
+    :param deadline: time.monotonic() timestamp after which the pass stops early
+    :return: whether the path was improved
+    """
+    n = len(path)
+    improved = False
+    forward, backward = _prefix_costs(song_adj_matrix, path)
+    i = 0
+    while i < n - 1 and not _expired(deadline):
+        ends = np.arange(i + 1, n)
+        # Transitions inside the segment change direction
+        delta = (backward[ends] - backward[i]) - (forward[ends] - forward[i])
+        if i > 0:
+            delta += song_adj_matrix[path[i - 1], path[ends]] - song_adj_matrix[path[i - 1], path[i]]
+        # The segment's new last track path[i] is followed by path[j + 1]
+        inner_ends = ends[:-1]
+        delta[:-1] += song_adj_matrix[path[i], path[inner_ends + 1]] - song_adj_matrix[path[inner_ends],
+                                                                                        path[inner_ends + 1]]
+
+        best = int(np.argmin(delta))
+        if delta[best] < -IMPROVEMENT_EPSILON:
+            j = ends[best]
+            path[i:j + 1] = path[i:j + 1][::-1]
+            forward, backward = _prefix_costs(song_adj_matrix, path)
+            improved = True
+        else:
+            i += 1
+    return improved
+
+
+def or_opt_pass(song_adj_matrix: np.ndarray, path: np.ndarray, deadline: Optional[float] = None) -> bool:
+    """
+    Improve the path in place by moving segments of up to three tracks to the position where they fit best
+    :param deadline: time.monotonic() timestamp after which the pass stops early
+    :return: whether the path was improved
+    """
+    n = len(path)
+    improved = False
+    for length in OR_OPT_SEGMENT_LENGTHS:
+        if length >= n:
+            break
+        i = 0
+        while i + length <= n and not _expired(deadline):
+            segment = path[i:i + length].copy()
+            rest = np.concatenate((path[:i], path[i + length:]))
+            delta = _insertion_costs(song_adj_matrix, rest, segment[0], segment[-1]) \
+                - _removal_gain(song_adj_matrix, path, i, length)
+            # Reinserting at the original position is no move
+            delta[i] = np.inf
+
+            best = int(np.argmin(delta))
+            if delta[best] < -IMPROVEMENT_EPSILON:
+                path[:] = np.concatenate((rest[:best], segment, rest[best:]))
+                improved = True
+            else:
+                i += 1
+    return improved
+
+
+def _expired(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.monotonic() > deadline
+
+
+def _prefix_costs(song_adj_matrix: np.ndarray, path: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: prefix sums of the transition costs along the path, forwards and backwards
+    """
+    forward = np.zeros(len(path))
+    backward = np.zeros(len(path))
+    np.cumsum(song_adj_matrix[path[:-1], path[1:]], dtype=np.float64, out=forward[1:])
+    np.cumsum(song_adj_matrix[path[1:], path[:-1]], dtype=np.float64, out=backward[1:])
+    return forward, backward
+
+
+def _removal_gain(song_adj_matrix: np.ndarray, path: np.ndarray, i: int, length: int) -> float:
+    """
+    :return: how much cheaper the path gets by cutting out path[i..i + length - 1] and joining its neighbours
+    """
+    gain = 0.0
+    before = path[i - 1] if i > 0 else None
+    after = path[i + length] if i + length < len(path) else None
+    if before is not None:
+        gain += song_adj_matrix[before, path[i]]
+    if after is not None:
+        gain += song_adj_matrix[path[i + length - 1], after]
+    if before is not None and after is not None:
+        gain -= song_adj_matrix[before, after]
+    return gain
+
+
+def _insertion_costs(song_adj_matrix: np.ndarray, rest: np.ndarray, first: int, last: int) -> np.ndarray:
+    """
+    :return: for every position q in 0..len(rest) the added cost of inserting the segment first..last before rest[q]
+    """
+    costs = np.zeros(len(rest) + 1)
+    costs[1:] += song_adj_matrix[rest, first]
+    costs[:-1] += song_adj_matrix[last, rest]
+    costs[1:-1] -= song_adj_matrix[rest[:-1], rest[1:]]
+    return costs
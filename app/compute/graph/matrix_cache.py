@@ -0,0 +1,268 @@
+"""
+Persistent, content addressed cache for song adjacency matrices.
+Matrices are stored as .npy files named after a hash of everything they are computed from and are loaded memory mapped,
+the least recently used files are evicted once the cache exceeds its configured size.
+"""
+import hashlib
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from app.compute.config import COMPUTE_CONFIG
+from app.compute.features import PlaylistFeatureMatrix, StandardizationStatistics, standardize_feature_matrix, \
+    statistics_for_mode
+from app.compute.graph.graph_builder import DEFAULT_COMPONENT_WEIGHTS, build_song_adjacency_matrix
+from app.compute.graph.incremental import update_song_adjacency_matrix, DEFAULT_DRIFT_TOLERANCE
+from app.compute.persistence import atomic_save
+
+CACHE_FORMAT_VERSION = b"1"
+# Matrices, playlist states and playlist orders, temporary files of writes in progress are left alone
+CACHE_FILE_SUFFIXES = (".npy", ".state.npz")
+
+
+class DistanceMatrixCache:
+    directory: str
+    max_bytes: int
+    hits: int
+    misses: int
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.directory = COMPUTE_CONFIG["matrix_cache_dir"] if directory is None else directory
+        self.max_bytes = COMPUTE_CONFIG["matrix_cache_max_bytes"] if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    @staticmethod
+    def cache_key(feature_matrix: PlaylistFeatureMatrix, standardization_mode: str,
+                  component_weights: Optional[List[float]] = None,
+                  statistics: Optional[StandardizationStatistics] = None) -> str:
+        """
+        Hash everything a song adjacency matrix depends on
+        :param feature_matrix: the unstandardized feature matrix of the playlist
+        :param standardization_mode: the standardization applied before building the matrix
+        :param component_weights: weights for the components of the distance calculation
+        :param statistics: the statistics the matrix is standardized with, if they do not follow from the playlist
+        :return: hex digest identifying the matrix
+        """
+        component_weights = DEFAULT_COMPONENT_WEIGHTS if component_weights is None else component_weights
+        digest = hashlib.sha256(CACHE_FORMAT_VERSION)
+        digest.update(standardization_mode.encode())
+        digest.update(np.asarray(component_weights, dtype=np.float64).tobytes())
+        if statistics is not None:
+            for values in statistics.column_mean_and_std():
+                digest.update(values.tobytes())
+        digest.update(len(feature_matrix).to_bytes(8, "little"))
+        digest.update("\n".join(feature_matrix.track_ids).encode())
+        digest.update(feature_matrix.data.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        Load a cached matrix
+        :param key: key of the matrix
+        :return: the read only, memory mapped matrix, or None if it is not cached
+        """
+        matrix = self._load(key)
+        with self._lock:
+            if matrix is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return matrix
+
+    def put(self, key: str, matrix: np.ndarray):
+        """
+        Store a matrix and evict the least recently used matrices if the cache grew too large
+        :param key: key of the matrix
+        :param matrix: the matrix to store
+        """
+        atomic_save(self._path(key), lambda cache_file: np.save(cache_file, matrix))
+        self.evict()
+
+    def get_playlist_state(self, playlist_id: str) \
+            -> Optional[Tuple[np.ndarray, List[str], StandardizationStatistics]]:
+        """
+        Load the matrix last built for a playlist, so that it can be updated incrementally after the playlist changed
+        :param playlist_id: id of the playlist
+        :return: tuple of (matrix, its track ids, the statistics it was standardized with),
+                 or None if the playlist or its matrix are not cached
+        """
+        path = self._state_path(playlist_id)
+        try:
+            with np.load(path, allow_pickle=False) as state:
+                key = str(state["key"])
+                track_ids = state["track_ids"].tolist()
+                statistics = StandardizationStatistics.from_arrays(state)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+        matrix = self._load(key)
+        if matrix is None:
+            return None
+        return matrix, track_ids, statistics
+
+    def put_playlist_state(self, playlist_id: str, key: str, track_ids: List[str],
+                           statistics: StandardizationStatistics):
+        """
+        Remember which matrix was last built for a playlist
+        :param playlist_id: id of the playlist
+        :param key: cache key of the matrix
+        :param track_ids: track ids in the order of the matrix
+        :param statistics: the statistics the matrix was standardized with
+        """
+        atomic_save(self._state_path(playlist_id),
+                    lambda state_file: np.savez(state_file, key=np.array(key), track_ids=np.array(track_ids, dtype=str),
+                                                **statistics.as_arrays()))
+
+    def get_playlist_order(self, playlist_id: str) -> Optional[List[str]]:
+        """
+        :param playlist_id: id of the playlist
+        :return: the track ids of the order last optimized for the playlist, or None if there is none
+        """
+        path = self._order_path(playlist_id)
+        try:
+            order = np.load(path, allow_pickle=False).tolist()
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return order
+
+    def put_playlist_order(self, playlist_id: str, track_ids: List[str]):
+        """
+        Remember the optimized order of a playlist, so that added tracks can later be inserted into it
+        :param playlist_id: id of the playlist
+        :param track_ids: track ids in the optimized order
+        """
+        atomic_save(self._order_path(playlist_id),
+                    lambda order_file: np.save(order_file, np.array(track_ids, dtype=str)))
+
+    def evict(self):
+        """
+        Delete the least recently used files until the cache fits into max_bytes.
+        Playlist states and orders are evicted like matrices, a state whose matrix is gone is of no use anymore and an
+        order that has not been used for as long as the least recently used matrix is likely stale as well.
+        """
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(CACHE_FILE_SUFFIXES):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def stats(self) -> dict:
+        """
+        :return: the hit and miss counters of the cache and the number and size of the files it holds
+        """
+        files, total_bytes = 0, 0
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(CACHE_FILE_SUFFIXES):
+                try:
+                    total_bytes += os.stat(os.path.join(self.directory, file_name)).st_size
+                    files += 1
+                except FileNotFoundError:
+                    continue
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "files": files, "bytes": total_bytes, "max_bytes": self.max_bytes}
+
+    def _load(self, key: str) -> Optional[np.ndarray]:
+        path = self._path(key)
+        try:
+            matrix = np.load(path, mmap_mode="r")
+            # Mark as recently used for the eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return matrix
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npy")
+
+    def _state_path(self, playlist_id: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(playlist_id.encode()).hexdigest() + ".state.npz")
+
+    def _order_path(self, playlist_id: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(playlist_id.encode()).hexdigest() + ".order.npy")
+
+
+_default_cache: Optional[DistanceMatrixCache] = None
+
+
+def get_matrix_cache() -> DistanceMatrixCache:
+    """
+    :return: the process wide matrix cache in the configured directory
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DistanceMatrixCache()
+    return _default_cache
+
+
+def cached_song_adjacency_matrix(feature_matrix: PlaylistFeatureMatrix, standardization_mode: str = "playlist",
+                                 component_weights: Optional[List[float]] = None,
+                                 cache: Optional[DistanceMatrixCache] = None,
+                                 playlist_id: Optional[str] = None, database=None) -> np.ndarray:
+    """
+    Standardizes the feature matrix and builds its song adjacency matrix, unless the same matrix has been built before.
+    If the playlist id is given and a matrix of a previous version of the playlist is cached,
+    the new matrix is derived from it incrementally, see update_song_adjacency_matrix
+
+    :param feature_matrix: the unstandardized feature matrix of the playlist
+    :param standardization_mode: how the features are standardized, "playlist" with the statistics of the playlist,
+                                 "library" with the statistics of all cached tracks (see library_statistics),
+                                 so that matrices of different playlists and users agree on shared tracks
+    :param component_weights: Weights for the different components of the distance calculation if none resorts to unweighted
+    :param cache: the cache to use, defaults to the process wide cache
+    :param playlist_id: id of the playlist, enables incremental updates
+    :param database: the track cache, required by the library standardization mode
+    :return: the song adjacency matrix, memory mapped if it was read from the cache
+    """
+    fixed_statistics = statistics_for_mode(standardization_mode, database)
+    cache = get_matrix_cache() if cache is None else cache
+
+    key = DistanceMatrixCache.cache_key(feature_matrix, standardization_mode, component_weights, fixed_statistics)
+    song_adj_matrix = cache.get(key)
+    if song_adj_matrix is not None:
+        return song_adj_matrix
+
+    previous_state = cache.get_playlist_state(playlist_id) if playlist_id is not None else None
+    if previous_state is not None and fixed_statistics is not None \
+            and previous_state[2].drift(fixed_statistics) > 0:
+        # the previous matrix was standardized differently, none of its distances can be reused
+        previous_state = None
+    if previous_state is not None:
+        previous_matrix, previous_track_ids, previous_statistics = previous_state
+        # with fixed statistics the changed playlist statistics never force a rebuild
+        drift_tolerance = DEFAULT_DRIFT_TOLERANCE if fixed_statistics is None else np.inf
+        song_adj_matrix, statistics, _ = update_song_adjacency_matrix(previous_matrix, previous_track_ids,
+                                                                      previous_statistics, feature_matrix,
+                                                                      component_weights, drift_tolerance)
+    else:
+        statistics = StandardizationStatistics.of(feature_matrix) if fixed_statistics is None else fixed_statistics
+        song_adj_matrix = build_song_adjacency_matrix(standardize_feature_matrix(feature_matrix, statistics),
+                                                      component_weights)
+
+    cache.put(key, song_adj_matrix)
+    if playlist_id is not None:
+        cache.put_playlist_state(playlist_id, key, feature_matrix.track_ids, statistics)
+    return song_adj_matrix
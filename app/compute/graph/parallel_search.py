@@ -0,0 +1,70 @@
+"""
+Multi-start local search, independent randomized searches run in worker processes and the best path is kept.
+The distance matrix is placed in shared memory once instead of being pickled to every worker.
+"""
+import os
+from concurrent.futures import Executor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional, Tuple
+
+import numpy as np
+
+from app.compute.graph.local_search import solve_shp_local_search, randomized_nearest_neighbour_path, ProgressCallback
+from app.compute.graph.tiled_matrix import iter_row_tiles
+
+
+def solve_shp_multi_start(song_adj_matrix: np.ndarray, pool: Executor, starts: Optional[int] = None,
+                          time_budget: Optional[float] = None, seed: Optional[int] = None,
+                          progress_callback: Optional[ProgressCallback] = None) -> Tuple[np.ndarray, float]:
+    """
+    Run several local searches from different starting paths in parallel and return the best result.
+    The first search starts from the deterministic nearest neighbour path, all others from randomized ones.
+    :param song_adj_matrix: the song adjacency matrix, may be memory mapped
+    :param pool: process pool to run the searches in
+    :param starts: number of searches, defaults to the number of cores
+    :param time_budget: wall clock time in seconds every search may take
+    :param seed: seed for the randomized starting paths
+    :param progress_callback: called whenever a search finished, with the number of finished searches,
+                              the best cost so far and 0 as improvement rate
+    :return: tuple of (best path as array of indices, its cost)
+    """
+    starts = (os.cpu_count() or 1) if starts is None else starts
+    seeds = np.random.SeedSequence(seed).spawn(starts)
+
+    shared_matrix = SharedMemory(create=True, size=max(1, song_adj_matrix.nbytes))
+    try:
+        matrix = np.ndarray(song_adj_matrix.shape, dtype=song_adj_matrix.dtype, buffer=shared_matrix.buf)
+        for row, tile in iter_row_tiles(song_adj_matrix):
+            matrix[row:row + len(tile)] = tile
+        del matrix
+
+        futures = [pool.submit(_search_worker, shared_matrix.name, song_adj_matrix.shape, song_adj_matrix.dtype.str,
+                               seeds[i] if i > 0 else None, time_budget)
+                   for i in range(starts)]
+        best_path, best_cost = None, np.inf
+        for finished, future in enumerate(futures, start=1):
+            path, cost = future.result()
+            if cost < best_cost:
+                best_path, best_cost = path, cost
+            if progress_callback is not None:
+                progress_callback(finished, best_cost, 0.0)
+        return best_path, best_cost
+    finally:
+        shared_matrix.close()
+        shared_matrix.unlink()
+
+
+def _search_worker(shared_matrix_name: str, shape: Tuple[int, int], dtype: str,
+                   seed: Optional[np.random.SeedSequence], time_budget: Optional[float]) -> Tuple[np.ndarray, float]:
+    """
+    Runs a single local search on the matrix in shared memory, executed in a worker process
+    """
+    shared_matrix = SharedMemory(name=shared_matrix_name)
+    try:
+        matrix = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shared_matrix.buf)
+        initial_path = None if seed is None else randomized_nearest_neighbour_path(matrix, np.random.default_rng(seed))
+        path, cost = solve_shp_local_search(matrix, initial_path, time_budget)
+        del matrix
+        return path, cost
+    finally:
+        shared_matrix.close()
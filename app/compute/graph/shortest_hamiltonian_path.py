@@ -1,33 +1,216 @@
-from typing import List
+from concurrent.futures import Executor
+from typing import List, Optional, Sequence, Union
 
 import numpy as np
 from python_tsp.heuristics import solve_tsp_local_search
+from scipy.sparse import csr_matrix, issparse
+
+from app.compute.compute_queue import compute_queue
+from app.compute.config import COMPUTE_CONFIG
+from app.compute.graph.bottleneck import solve_shp_bottleneck
+from app.compute.graph.candidate_search import solve_shp_candidate_search, GraphCandidateLists
+from app.compute.graph.held_karp import solve_shp_exact, MAX_EXACT_TRACKS
+from app.compute.graph.hierarchical import solve_shp_hierarchical
+from app.compute.graph.insertion import insert_tracks
+from app.compute.graph.knn_graph import TransitionDistances
+from app.compute.graph.local_search import solve_shp_local_search, path_cost, ProgressCallback
+from app.compute.graph.parallel_search import solve_shp_multi_start
+from app.compute.graph.tiled_matrix import iter_row_tiles
+
+SOLVER_STRATEGIES = ("auto", "exact", "native", "candidates", "multi_start", "hierarchical", "bottleneck", "ps5")
+# Strategies that can solve a sparse nearest neighbour graph
+SPARSE_STRATEGIES = ("auto", "candidates")
 
 
 def add_zero_vertex(song_adj_matrix: np.array):
     """
     Add a fully connected 0 distance vertex to the graph
-    :param song_adj_matrix:
-    :return: copy of song_adj_matrix with the added vertex
+    :param song_adj_matrix: the song adjacency matrix, may be memory mapped
+    :return: copy of song_adj_matrix with the added vertex, in the dtype of song_adj_matrix
     """
     n = len(song_adj_matrix)
-    new_matrix = np.zeros((n + 1, n + 1))
-    new_matrix[:-1, :-1] = song_adj_matrix
+    new_matrix = np.zeros((n + 1, n + 1), dtype=song_adj_matrix.dtype)
+    for row, tile in iter_row_tiles(song_adj_matrix):
+        new_matrix[row:row + len(tile), :-1] = tile
     return new_matrix
 
 
-def approximate_shp(song_adj_matrix: np.array) -> List[int]:
+def select_strategy(n: int, labels: Optional[np.ndarray] = None) -> str:
+    """
+    Pick the solver strategy for a playlist of n tracks by the configured thresholds,
+    exact for tiny playlists (never beyond MAX_EXACT_TRACKS), the full local search for medium ones and for large ones
+    the hierarchical strategy if cluster labels are available or the candidate list search otherwise
+    :param n: number of tracks
+    :param labels: cluster labels of the tracks, if available
+    :return: the name of the strategy
+    """
+    if n <= min(COMPUTE_CONFIG["exact_max_tracks"], MAX_EXACT_TRACKS):
+        return "exact"
+    if n <= COMPUTE_CONFIG["local_search_max_tracks"]:
+        return "native"
+    return "candidates" if labels is None else "hierarchical"
+
+
+def approximate_shp(song_adj_matrix: Union[np.array, csr_matrix], strategy: str = "auto",
+                    time_budget: Optional[float] = None,
+                    progress_callback: Optional[ProgressCallback] = None,
+                    pool: Optional[Executor] = None,
+                    labels: Optional[np.ndarray] = None,
+                    distances: Optional[TransitionDistances] = None) -> List[int]:
+    """
+    Approximate the shortest hamiltonian path through all songs.
+    On a sparse nearest neighbour graph only the candidate list search is available: the graph's edges are the
+    candidates, the path starts from a greedy walk along them (see sparse_greedy_path) and all costs are the true
+    distances, including those of transitions the graph does not contain
+    :param song_adj_matrix: The song adjacency matrix, or a sparse nearest neighbour graph in CSR format
+    :param strategy: "auto" to pick one of the strategies below by the size of the playlist (see select_strategy),
+                     "exact" for the optimal path of small playlists (see held_karp),
+                     "native" for the in-project local search on the open path (see local_search),
+                     "candidates" for the native moves restricted to each track's nearest successors
+                     (see candidate_search),
+                     "multi_start" for independent native searches in parallel processes (see parallel_search),
+                     "hierarchical" for solving clusters given by labels separately and stitching them (see hierarchical),
+                     "bottleneck" for the cheapest path avoiding transitions above the configured bottleneck_sigma
+                     (see bottleneck),
+                     "ps5" for python_tsp's local search on the matrix with an added zero vertex
+    :param time_budget: wall clock time in seconds after which the best path found so far is returned
+    :param progress_callback: receives the iteration, the best cost so far and the improvement rate while solving
+    :param pool: process pool for the multi_start and hierarchical strategies, defaults to the pool of the compute queue
+    :param labels: cluster label of every track, required by the hierarchical strategy
+    :param distances: the distances between all tracks of a sparse graph, required for sparse graphs
+    :return: The approximate shortest hamiltonian path as a list of indices
+    """
+    if issparse(song_adj_matrix):
+        if distances is None:
+            raise ValueError("Sparse graphs require the transition distances of their tracks")
+        if strategy not in SPARSE_STRATEGIES:
+            raise ValueError(f"The {strategy} strategy requires the dense song adjacency matrix")
+        graph = csr_matrix(song_adj_matrix)
+        path, _ = solve_shp_candidate_search(distances, initial_path=np.array(sparse_greedy_path(graph, distances)),
+                                             time_budget=time_budget, progress_callback=progress_callback,
+                                             candidates=GraphCandidateLists(graph))
+        return path.tolist()
+    if strategy == "auto":
+        strategy = select_strategy(song_adj_matrix.shape[0], labels)
+        print(f"Solving {song_adj_matrix.shape[0]} tracks with the {strategy} strategy")
+    if strategy == "exact":
+        path, cost = solve_shp_exact(song_adj_matrix)
+        if progress_callback is not None:
+            progress_callback(1, cost, 0.0)
+        return path.tolist()
+    if strategy == "native":
+        path, _ = solve_shp_local_search(song_adj_matrix, time_budget=time_budget,
+                                         progress_callback=progress_callback)
+        return path.tolist()
+    if strategy == "candidates":
+        path, _ = solve_shp_candidate_search(song_adj_matrix, time_budget=time_budget,
+                                             progress_callback=progress_callback)
+        return path.tolist()
+    if strategy == "multi_start":
+        pool = compute_queue.pool if pool is None else pool
+        path, _ = solve_shp_multi_start(song_adj_matrix, pool, time_budget=time_budget,
+                                        progress_callback=progress_callback)
+        return path.tolist()
+    if strategy == "hierarchical":
+        if labels is None:
+            raise ValueError("The hierarchical strategy requires cluster labels")
+        pool = compute_queue.pool if pool is None else pool
+        path, cost = solve_shp_hierarchical(song_adj_matrix, labels, pool, time_budget)
+        if progress_callback is not None:
+            progress_callback(1, cost, 0.0)
+        return path.tolist()
+    if strategy == "bottleneck":
+        result = solve_shp_bottleneck(song_adj_matrix, time_budget=time_budget)
+        if progress_callback is not None:
+            progress_callback(1, result.cost, 0.0)
+        return result.path.tolist()
+    if strategy == "ps5":
+        path = approximate_shp_python_tsp(song_adj_matrix, time_budget)
+        if progress_callback is not None:
+            progress_callback(1, path_cost(song_adj_matrix, np.array(path, dtype=int)), 0.0)
+        return path
+    raise ValueError(f"Unknown solver strategy {strategy}, expected one of {SOLVER_STRATEGIES}")
+
+
+def extend_shp(song_adj_matrix: np.array, track_ids: Sequence[str], previous_order: Sequence[str],
+               time_budget: Optional[float] = None, max_change: Optional[float] = None) -> Optional[List[int]]:
+    """
+    Update a previously optimized order after tracks were added to or removed from the playlist.
+    Removed tracks are dropped from the previous order, added tracks are inserted at their cheapest position and
+    the path is repaired around them, see insert_tracks
+    :param song_adj_matrix: The song adjacency matrix of the current playlist
+    :param track_ids: the track ids of the current playlist, in the order of the matrix
+    :param previous_order: the track ids of the previous optimized order
+    :param time_budget: wall clock time in seconds for the repair
+    :param max_change: largest share of added and removed tracks, relative to the larger of the previous and the
+                       current playlist, for which the previous order is extended, defaults to the configured
+                       incremental_max_change
+    :return: The updated path as a list of indices, or None if the playlist changed too much and has to be solved anew
+    """
+    max_change = COMPUTE_CONFIG["incremental_max_change"] if max_change is None else max_change
+    # A track may be part of a playlist more than once, every occurrence is matched separately
+    positions = {}
+    for i, track_id in enumerate(track_ids):
+        positions.setdefault(track_id, []).append(i)
+    path = np.array([positions[track_id].pop(0) for track_id in previous_order if positions.get(track_id)], dtype=int)
+    new_tracks = [i for remaining in positions.values() for i in remaining]
+    changed = len(new_tracks) + len(previous_order) - len(path)
+    if changed > max_change * max(len(previous_order), len(track_ids)):
+        print(f"{changed} tracks were added or removed, optimizing the whole playlist")
+        return None
+    path, _ = insert_tracks(song_adj_matrix, path, new_tracks, time_budget=time_budget)
+    return path.tolist()
+
+
+def approximate_shp_python_tsp(song_adj_matrix: np.array, time_budget: Optional[float] = None) -> List[int]:
     """
     Approximate the shortest hamiltonian path by adding a fully connected 0 distance vertex to the graph
     and then solving the traveling salesman problem
     :param song_adj_matrix: The song adjacency matrix
+    :param time_budget: maximum processing time of the local search in seconds
     :return: The approximate shortest hamiltonian path as a list of indices
     """
     original_length = song_adj_matrix.shape[0]
 
     song_adj_matrix = add_zero_vertex(song_adj_matrix)
-    permutation, distance = solve_tsp_local_search(song_adj_matrix, perturbation_scheme="ps5")
+    permutation, distance = solve_tsp_local_search(song_adj_matrix, perturbation_scheme="ps5",
+                                                   max_processing_time=time_budget)
 
     # Remove the added vertex
     permutation = [i for i in permutation if i < original_length]
     return permutation
+
+
+def sparse_greedy_path(graph: csr_matrix, distances: TransitionDistances) -> List[int]:
+    """
+    Build a hamiltonian path through a sparse graph by always following the shortest edge to a track that is
+    not yet part of the path. If all neighbours of a track have been used, the path continues with the closest unused
+    track by its true distance, which is the only time a full row of distances is computed.
+    The path starts at the track that is hardest to reach, i.e. the one with the longest shortest incoming edge.
+    :param graph: sparse adjacency matrix in CSR format
+    :param distances: the distances between all tracks of the graph
+    :return: the path as a list of indices
+    """
+    n = graph.shape[0]
+    if n == 0:
+        return []
+
+    best_incoming = np.full(n, np.inf)
+    np.minimum.at(best_incoming, graph.indices, graph.data)
+    current = int(np.argmax(best_incoming))
+
+    visited = np.zeros(n, dtype=bool)
+    path = []
+    while True:
+        visited[current] = True
+        path.append(current)
+        if len(path) == n:
+            return path
+
+        row = slice(graph.indptr[current], graph.indptr[current + 1])
+        neighbours = graph.indices[row][np.argsort(graph.data[row], kind="stable")]
+        unvisited_neighbours = neighbours[~visited[neighbours]]
+        if len(unvisited_neighbours) > 0:
+            current = int(unvisited_neighbours[0])
+        else:
+            current = int(np.argmin(np.where(visited, np.inf, distances[current])))
@@ -0,0 +1,58 @@
+"""
+Helpers for distance matrices that are too large to be held in memory, the matrices are memory mapped .npy files
+in the scratch directory and are read and written in tiles of rows
+"""
+import os
+import tempfile
+import weakref
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+from app.compute.config import COMPUTE_CONFIG
+
+
+def create_scratch_matrix(shape: Tuple[int, int], dtype=np.float32, scratch_dir: Optional[str] = None) -> np.memmap:
+    """
+    Create a memory mapped matrix backed by a temporary .npy file,
+    the file is removed once the matrix (and every view of it) has been garbage collected
+    :param shape: shape of the matrix
+    :param dtype: data type of the matrix
+    :param scratch_dir: directory the file is created in, defaults to the configured scratch directory
+    :return: the writable memory mapped matrix
+    """
+    scratch_dir = COMPUTE_CONFIG["scratch_dir"] if scratch_dir is None else scratch_dir
+    if not os.path.exists(scratch_dir):
+        os.makedirs(scratch_dir)
+
+    file_descriptor, path = tempfile.mkstemp(suffix=".npy", prefix="distances_", dir=scratch_dir)
+    os.close(file_descriptor)
+    matrix = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    weakref.finalize(matrix, _remove_file, path)
+    return matrix
+
+
+def use_out_of_core(n: int) -> bool:
+    """
+    :param n: number of tracks
+    :return: whether a distance matrix of n tracks should be computed out of core
+    """
+    return n >= COMPUTE_CONFIG["out_of_core_threshold"]
+
+
+def iter_row_tiles(matrix: np.ndarray, tile_rows: Optional[int] = None) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Iterate over a (possibly memory mapped) matrix in tiles of consecutive rows,
+    so that only one tile has to be resident in memory at a time
+    :param matrix: the matrix to iterate over
+    :param tile_rows: number of rows per tile, defaults to the configured tile size
+    :return: iterator of (index of the first row in the tile, tile)
+    """
+    tile_rows = COMPUTE_CONFIG["tile_rows"] if tile_rows is None else tile_rows
+    for row in range(0, matrix.shape[0], tile_rows):
+        yield row, np.asarray(matrix[row:row + tile_rows])
+
+
+def _remove_file(path: str):
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,25 @@
+"""
+Saving of computed models and matrices, files are written next to their destination and moved into place atomically
+so concurrent readers never see a partially written file
+"""
+import os
+import tempfile
+from typing import BinaryIO, Callable
+
+
+def atomic_save(path: str, write: Callable[[BinaryIO], None]):
+    """
+    Write a file into a temporary file in the same directory and replace the destination with it
+    :param path: the file to save to, missing directories are created
+    :param write: writes the content into the given binary file, e.g. by np.save or np.savez
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            write(file)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
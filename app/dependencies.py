@@ -2,6 +2,8 @@ from typing import Annotated, Optional, Union
 
 from app.exceptions import NotLoggedInException
 from app.session import find_session, Session
+from app.spotify.async_spotify import AsyncSpotify
+from app.spotify.model import PlayList
 from fastapi import Cookie, Depends
 
 
@@ -43,3 +45,16 @@ async def get_session_validated(session: Annotated[Union[str, None], Cookie()] =
 UnvalidatedSession = Annotated[Session, Depends(get_session_unvalidated)]
 ValidatedSession = Annotated[Session, Depends(get_session_validated)]
 OptionalSession = Annotated[Optional[Session], Depends(get_session_optional)]
+
+
+async def get_initialized_playlist(playlist_id: str, session: ValidatedSession) -> PlayList:
+    """
+    Fetched on the event loop before the route runs, so synchronous routes do not hold a threadpool worker while the
+    playlist is fetched
+    :return: the playlist of the playlist_id path parameter, with the audio features and the first and last section
+            analysis of all its tracks
+    """
+    return await AsyncSpotify(session.auth).fetch_and_initialize_playlist(playlist_id)
+
+
+InitializedPlaylist = Annotated[PlayList, Depends(get_initialized_playlist)]
@@ -1,42 +1,64 @@
+from typing import Optional
+
 from fastapi import APIRouter, Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 
 import numpy as np
 
-from app.compute import standardize, create_feature_vector, cluster_k_means, build_song_adjacency_matrix, \
-    cluster_dbscan, principal_component_analysis
+from app.compute import standardize_feature_matrix, cluster_k_means, build_radius_song_graph, \
+    build_knn_song_graph, cluster_dbscan, PlaylistFeatureMatrix
+from app.compute.cluster import fit_library_clusters, LibraryClusterModel
+from app.compute.config import COMPUTE_CONFIG
+from app.compute.features import PCAModel, fit_library_pca, statistics_for_mode
 
-from app.dependencies import ValidatedSession
+from app.dependencies import ValidatedSession, InitializedPlaylist
 from app.spotify import Spotify
-from app.spotify.model import PlayList
 
 router = APIRouter(prefix="/playlist_cluster")
 templates = Jinja2Templates(directory="templates/")
 
 
 @router.get("/k_means/{playlist_id}", response_class=HTMLResponse)
-def playlist_k_means(playlist_id: str, session: ValidatedSession, request: Request):
-    # Fetch audio features
-    print("Fetching playlist")
+def playlist_k_means(playlist_id: str, session: ValidatedSession, playlist: InitializedPlaylist, request: Request,
+                     library: bool = False):
+    """
+    Cluster a playlist with k-means, or label its tracks with the clusters of the whole track library if library is set
+    """
     spf: Spotify = Spotify(session.auth)
-    playlist: PlayList = spf.fetch_and_initialize_playlist(playlist_id)
 
     # Check for empty playlists:
     if len(playlist.tracks) == 0:
         return f"<h1>Empty playlist: {playlist.name}</h1>"
 
-    # standardize the playlist
-    standardize(playlist.tracks)
-
-    # build vector for each track
-    song_vectors = [create_feature_vector(track) for track in playlist.tracks]
-    song_vectors = np.array(song_vectors)
-    song_vectors = principal_component_analysis(song_vectors, 6)
-
-    # cluster the playlist
-    print("Clustering playlist")
-    centroids, labels = cluster_k_means(song_vectors, len(playlist.tracks) // 8)
+    if library:
+        # label the playlist with the library model, fitting it first if there is none yet
+        model = LibraryClusterModel.load()
+        if model is None:
+            print("Clustering library")
+            model = fit_library_clusters(spf.database)
+            model.save()
+        track_ids = [track.id for track in playlist.tracks]
+        feature_matrix = PlaylistFeatureMatrix.from_database(spf.database, track_ids)
+        song_vectors = standardize_feature_matrix(feature_matrix, model.statistics).end_vectors()
+        centroids, labels = model.centroids, model.label(feature_matrix)
+    else:
+        # the principal components of the library, fitted on tracks standardized with the library statistics
+        pca_model = PCAModel.load()
+        if pca_model is None or pca_model.statistics is None:
+            print("Fitting principal components of the library")
+            pca_model = fit_library_pca(spf.database)
+            pca_model.save()
+
+        # standardize the playlist the same way and build vector for each track, projected onto the components
+        track_ids = [track.id for track in playlist.tracks]
+        feature_matrix = standardize_feature_matrix(PlaylistFeatureMatrix.from_database(spf.database, track_ids),
+                                                    pca_model.statistics)
+        song_vectors = pca_model.transform(feature_matrix.end_vectors())
+
+        # cluster the playlist
+        print("Clustering playlist")
+        centroids, labels = cluster_k_means(song_vectors, len(playlist.tracks) // 8)
 
     # create a list of song indices for each cluster
     song_indices_by_cluster = {label: list() for label in np.unique(labels)}
@@ -59,21 +81,24 @@ def playlist_k_means(playlist_id: str, session: ValidatedSession, request: Reque
 
 # endpoint to cluster a playlist with dbscan
 @router.get("/dbscan/{playlist_id}", response_class=HTMLResponse)
-def dbscan_playlist(playlist_id: str, session: ValidatedSession, request: Request, eps: float, min_pts: int):
-    # Fetch audio features
-    print("Fetching playlist")
+def dbscan_playlist(playlist_id: str, session: ValidatedSession, playlist: InitializedPlaylist, request: Request,
+                    eps: float, min_pts: int, neighbours: Optional[int] = None):
     spf: Spotify = Spotify(session.auth)
-    playlist: PlayList = spf.fetch_and_initialize_playlist(playlist_id)
 
     # Check for empty playlists:
     if len(playlist.tracks) == 0:
         return f"<h1>Empty playlist: {playlist.name}</h1>"
 
-    # standardize the playlist
-    standardize(playlist.tracks)
-
-    # build adjacency matrix
-    song_adj_matrix = build_song_adjacency_matrix(playlist)
+    # build the graph of all transitions within eps, or only the nearest neighbour graph if the number of neighbours
+    # is given
+    track_ids = [track.id for track in playlist.tracks]
+    statistics = statistics_for_mode(COMPUTE_CONFIG["standardization_mode"], spf.database)
+    feature_matrix = standardize_feature_matrix(PlaylistFeatureMatrix.from_database(spf.database, track_ids),
+                                                statistics)
+    if neighbours is None:
+        song_adj_matrix = build_radius_song_graph(feature_matrix, eps)
+    else:
+        song_adj_matrix = build_knn_song_graph(feature_matrix, neighbours)
 
     # cluster the playlist
     print("Clustering playlist")
@@ -4,32 +4,45 @@ from fastapi.templating import Jinja2Templates
 
 import numpy as np
 
-from app.compute import standardize, build_song_adjacency_matrix
-from app.dependencies import ValidatedSession
+from app.compute import cached_song_adjacency_matrix, PlaylistFeatureMatrix
+from app.compute.config import COMPUTE_CONFIG
+from app.compute.graph import iter_row_tiles
+from app.dependencies import ValidatedSession, InitializedPlaylist
 from app.spotify import Spotify
-from app.spotify.model import PlayList
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates/")
 
 
 @router.get("/playlist_select/{playlist_id}", response_class=HTMLResponse)
-def playlist_select(playlist_id: str, session: ValidatedSession, request: Request):
-    # Fetch audio features
+def playlist_select(playlist_id: str, session: ValidatedSession, playlist: InitializedPlaylist, request: Request,
+                    row: int = 0, column: int = 0):
+    """
+    Show the transition distances of a playlist as a heatmap, one block of heatmap_page_size rows and columns at a time
+    starting at the given row and column
+    """
     spf: Spotify = Spotify(session.auth)
-    playlist: PlayList = spf.fetch_and_initialize_playlist(playlist_id)
 
     # Check for empty playlists:
     if len(playlist.tracks) == 0:
         return f"<h1>Empty playlist: {playlist.name}</h1>"
 
     # Compute song adjacency matrix
-    standardize(playlist.tracks)
-    song_adj_matrix: np.ndarray = build_song_adjacency_matrix(playlist)
-
-    # Prepare data for the template
-    song_adj_data = song_adj_matrix.tolist()  # Convert np.ndarray to list
-    max_val: float = float(np.max(song_adj_matrix))
+    track_ids = [track.id for track in playlist.tracks]
+    feature_matrix = PlaylistFeatureMatrix.from_database(spf.database, track_ids)
+    song_adj_matrix: np.ndarray = cached_song_adjacency_matrix(feature_matrix, COMPUTE_CONFIG["standardization_mode"],
+                                                               playlist_id=playlist.id, database=spf.database)
+
+    # Prepare data for the template, only the shown block is converted to a list
+    # and the matrix is read in tiles for the color scale, so large memory mapped matrices are never loaded as a whole
+    n = len(playlist.tracks)
+    page_size = COMPUTE_CONFIG["heatmap_page_size"]
+    row = min(max(row, 0), n - 1)
+    column = min(max(column, 0), n - 1)
+    song_adj_data = np.asarray(song_adj_matrix[row:row + page_size, column:column + page_size]).tolist()
+    max_val: float = 0.0
+    for _, tile in iter_row_tiles(song_adj_matrix):
+        max_val = max(max_val, float(np.max(tile)))
     song_names = [track.name for track in playlist.tracks]
 
     return templates.TemplateResponse("PlaylistDetail.html", {
@@ -37,5 +50,10 @@ def playlist_select(playlist_id: str, session: ValidatedSession, request: Reques
         "playlist": playlist,
         "song_adj_data": song_adj_data,
         "max_val": max_val,
-        "song_names": song_names,
+        "row_names": song_names[row:row + page_size],
+        "column_names": song_names[column:column + page_size],
+        "row": row,
+        "column": column,
+        "page_size": page_size,
+        "track_count": n,
     })
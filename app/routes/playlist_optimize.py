@@ -1,34 +1,101 @@
-import time
+import asyncio
+from typing import Optional
 
 import numpy as np
 
-from fastapi import APIRouter, WebSocket
+from fastapi import APIRouter, HTTPException, WebSocket
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 
-from app.compute import build_song_adjacency_matrix, approximate_shp, standardize
-from app.dependencies import ValidatedSession
+from app.compute import cached_song_adjacency_matrix, build_knn_song_graph, approximate_shp, extend_shp, \
+    standardize_feature_matrix, PlaylistFeatureMatrix, TransitionDistances
+from app.compute.cluster import k_means
+from app.compute.graph import get_matrix_cache
+from app.compute.graph.bottleneck import solve_shp_bottleneck
+from app.compute.graph.shortest_hamiltonian_path import SOLVER_STRATEGIES, SPARSE_STRATEGIES
+from app.compute.compute_queue import compute_queue, ComputeTask
+from app.compute.config import COMPUTE_CONFIG
+from app.compute.features import statistics_for_mode
+from app.dependencies import ValidatedSession, InitializedPlaylist
 from app.spotify import Spotify
-from app.spotify.model import PlayList
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates/")
 
 
 @router.get("/optimize/{playlist_id}")
-def optimize(playlist_id: str, session: ValidatedSession):
-    # Fetch audio features
-    spf: Spotify = Spotify(session.auth)
-    playlist: PlayList = spf.fetch_and_initialize_playlist(playlist_id)
+def optimize(playlist_id: str, session: ValidatedSession, playlist: InitializedPlaylist,
+             neighbours: Optional[int] = None, process_id: Optional[str] = None, time_budget: Optional[float] = None,
+             strategy: str = "auto", max_transition: Optional[float] = None, incremental: bool = True):
+    """
+    Creates an optimized copy of a playlist.
+    The progress of the optimization can be followed on the progress websocket with the same process_id.
+    With the bottleneck strategy, max_transition overrides the configured largest acceptable transition.
+    If the playlist was optimized before and incremental is set, added tracks are inserted into the previous order
+    instead of optimizing the whole playlist again, unless more than the configured incremental_max_change of the
+    playlist was added or removed.
+    """
+    # Reject what the solvers would refuse before anything is queued
+    if strategy not in SOLVER_STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"Unknown solver strategy {strategy}, "
+                                                    f"expected one of {', '.join(SOLVER_STRATEGIES)}")
+    if neighbours is not None and strategy not in SPARSE_STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"The {strategy} strategy requires the dense song adjacency "
+                                                    f"matrix, it can not be combined with neighbours")
+    task = ComputeTask(time_budget=COMPUTE_CONFIG["solver_time_budget"] if time_budget is None else time_budget)
+    compute_queue.queue_task(task, process_id)
 
-    # Check for empty playlists:
-    if len(playlist.tracks) == 0:
-        return f"<h1>Empty playlist: {playlist.name}</h1>"
+    try:
+        spf: Spotify = Spotify(session.auth)
 
-    # Compute song adjacency matrix
-    standardize(playlist.tracks)
-    song_adj_matrix: np.array = build_song_adjacency_matrix(playlist)
-    shp = approximate_shp(song_adj_matrix)
+        # Check for empty playlists:
+        if len(playlist.tracks) == 0:
+            task.progress.finish()
+            return f"<h1>Empty playlist: {playlist.name}</h1>"
+
+        # Compute song adjacency matrix, or only the nearest neighbour graph if the number of neighbours is given,
+        # together with the distances of all transitions the graph leaves out
+        track_ids = [track.id for track in playlist.tracks]
+        feature_matrix = PlaylistFeatureMatrix.from_database(spf.database, track_ids)
+        statistics = statistics_for_mode(COMPUTE_CONFIG["standardization_mode"], spf.database)
+        distances = None
+        if neighbours is None:
+            song_adj_matrix: np.array = cached_song_adjacency_matrix(feature_matrix,
+                                                                     COMPUTE_CONFIG["standardization_mode"],
+                                                                     playlist_id=playlist.id, database=spf.database)
+        else:
+            standardized = standardize_feature_matrix(feature_matrix, statistics)
+            song_adj_matrix = build_knn_song_graph(standardized, neighbours)
+            distances = TransitionDistances(standardized)
+        # The hierarchical strategy optimizes within clusters of similar tracks, the automatic selection picks it for
+        # playlists too large for the full local search. The tracks are clustered in the coordinates the matrix was
+        # built in.
+        labels = None
+        if strategy == "hierarchical" or (strategy == "auto" and neighbours is None
+                                          and len(playlist.tracks) > COMPUTE_CONFIG["local_search_max_tracks"]):
+            k = max(1, len(playlist.tracks) // COMPUTE_CONFIG["hierarchical_cluster_size"])
+            _, labels = k_means(standardize_feature_matrix(feature_matrix, statistics).end_vectors(), k)
+
+        task.progress.start()
+        bottleneck = None
+        previous_order = get_matrix_cache().get_playlist_order(playlist.id) \
+            if incremental and neighbours is None and strategy == "auto" else None
+        # extending the previous order gives up once too much of the playlist changed
+        shp = None if previous_order is None else extend_shp(song_adj_matrix, feature_matrix.track_ids, previous_order,
+                                                             time_budget=task.progress.time_budget)
+        if shp is None and strategy == "bottleneck" and neighbours is None:
+            bottleneck = solve_shp_bottleneck(song_adj_matrix, max_transition, time_budget=task.progress.time_budget)
+            task.progress.update(1, bottleneck.cost, 0.0)
+            shp = bottleneck.path.tolist()
+        elif shp is None:
+            shp = approximate_shp(song_adj_matrix, strategy, time_budget=task.progress.time_budget,
+                                  progress_callback=task.progress.update, labels=labels, distances=distances)
+        task.progress.finish()
+    finally:
+        # the progress websocket only stops polling once the task reached a final status
+        if not task.progress.is_final:
+            task.progress.fail()
+    get_matrix_cache().put_playlist_order(playlist.id, [feature_matrix.track_ids[i] for i in shp])
 
     tracks = [playlist.tracks[i] for i in shp]
     optimized_playlist = spf.create_playlist(playlist.name + " (optimized)", tracks)
@@ -37,19 +104,34 @@ def optimize(playlist_id: str, session: ValidatedSession):
     ret += f"<a href='/playlist_overview'>Back to playlist overview</a><br><br>\n"
     ret += f"<h1>Optimized playlist: {playlist.name}</h1>\n"
     ret += f"<a href='https://open.spotify.com/playlist/{optimized_playlist.id}'>optimized playlist</a><br><br>\n"
+    if bottleneck is not None:
+        if bottleneck.feasible:
+            ret += f"<p>No transition is longer than {bottleneck.threshold:.3f}</p>\n"
+        else:
+            ret += f"<p>{bottleneck.exceeding_transitions} transitions are longer than the target of " \
+                   f"{bottleneck.target:.3f}</p>\n"
     ret += "</div>\n"
+    transition_costs = song_adj_matrix if distances is None else distances
     ret += "<table>\n<tr>\n<th>Track number</th>\n<th>Track name</th>\n<th>Distance to predecessor</th>\n</tr>\n"
     for i in range(0, len(tracks)):
         if i == 0:
             pred_dist = 0
         else:
-            pred_dist = song_adj_matrix[i - 1, i]
+            pred_dist = transition_costs[shp[i - 1], shp[i]]
         name = tracks[i].name
         ret += f"<tr>\n<td>{i + 1}</td>\n<td>{name}</td>\n<td>{pred_dist}</td>\n</tr>\n"
     ret += "</table>"
     return HTMLResponse(ret)
 
 
+@router.get("/matrix_cache/stats")
+def matrix_cache_stats(session: ValidatedSession):
+    """
+    Hit and miss counters and size of the song adjacency matrix cache
+    """
+    return get_matrix_cache().stats()
+
+
 @router.get("/optimize/{playlist_id}/progress")
 def get_progress_page(process_id: str, session: ValidatedSession):
     pass
@@ -59,5 +141,13 @@ def get_progress_page(process_id: str, session: ValidatedSession):
 async def get_progress(process_id: str, session: ValidatedSession, websocket: WebSocket):
     await websocket.accept()
     while True:
-        time.sleep(1)
-        await websocket.send_json({"progress": 0.5})
+        task = compute_queue.get_task(process_id)
+        if task is None:
+            await websocket.send_json({"status": "unknown", "progress": 0.0})
+        else:
+            await websocket.send_json(task.progress.as_dict())
+            if task.progress.is_final:
+                compute_queue.remove_task(process_id)
+                break
+        await asyncio.sleep(1)
+    await websocket.close()
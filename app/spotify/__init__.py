@@ -1 +1,2 @@
 from app.spotify.spotify import Spotify
+from app.spotify.async_spotify import AsyncSpotify
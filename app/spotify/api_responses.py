@@ -0,0 +1,77 @@
+"""
+Conversion of Spotify API response bodies into the model, shared by the blocking and the asyncio client
+"""
+from typing import List, Tuple
+
+from app.spotify.model import PlayList, Track, TrackFeatures
+from app.spotify.model.track import TrackSection
+
+# Largest number of ids the audio-features endpoint and the playlist tracks pages accept
+PAGE_SIZE = 100
+TRACK_FIELDS = "fields=items(added_at, added_by, track(name, href, id)),next,total"
+
+
+def parse_playlist(body: dict) -> PlayList:
+    """
+    :return: the playlist of a playlist object, without contained tracks
+    """
+    return PlayList(name=body["name"], p_id=body["id"], tracks_ref=body["tracks"]["href"])
+
+
+def parse_tracks_page(body: dict) -> List[Track]:
+    """
+    :return: the tracks of a page of playlist items, without tracks that have since been deleted
+    """
+    tracks: List[Track] = []
+    for api_track in body["items"]:
+        track: Track = Track()
+
+        api_track = api_track["track"]
+        track.id = api_track["id"]
+        track.name = api_track["name"]
+        track.href = api_track["href"]
+        # filter out tracks that have since been deleted
+        if track.id:
+            tracks.append(track)
+    return tracks
+
+
+def feature_batches(tracks: List[Track]) -> List[List[Track]]:
+    """
+    :return: the tracks without features, in batches of at most PAGE_SIZE
+    """
+    uninitialized_tracks = [track for track in tracks if track.features is None]
+    return [uninitialized_tracks[i:i + PAGE_SIZE] for i in range(0, len(uninitialized_tracks), PAGE_SIZE)]
+
+
+def assign_audio_features(features: List[dict], tracks: List[Track]):
+    """
+    Initialize the tracks with the audio features of an audio-features response
+    :param features: the audio features objects
+    :param tracks: the tracks the features were requested for, a track may appear more than once
+    """
+    tracks_by_id = {}
+    for track in tracks:
+        tracks_by_id.setdefault(track.id, []).append(track)
+    for feature in features:
+        track_id = feature["id"]
+        if track_id not in tracks_by_id:
+            raise Exception(f"Track with id {track_id} not found in feature responses")
+        feature_object = TrackFeatures(acousticness=feature["acousticness"],
+                                       danceability=feature["danceability"],
+                                       energy=feature["energy"],
+                                       instrumentalness=feature["instrumentalness"],
+                                       valence=feature["valence"])
+        for track in tracks_by_id[track_id]:
+            track.features = feature_object
+
+
+def parse_first_and_last_section(body: dict) -> Tuple[TrackSection, TrackSection]:
+    """
+    :return: the first and last section of an audio-analysis response
+    """
+    sections = body["sections"]
+    first_section = sections[0]
+    last_section = sections[-1]
+    return (TrackSection(loudness=first_section["loudness"], tempo=first_section["tempo"]),
+            TrackSection(loudness=last_section["loudness"], tempo=last_section["tempo"]))
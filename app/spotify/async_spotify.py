@@ -0,0 +1,276 @@
+"""
+asyncio variant of the Spotify client for fetching and initializing playlists. The requests of a playlist fan out
+concurrently, bounded by max_concurrent_requests: the pages of the playlist after the first one, the audio-features
+batches and the per track audio analysis, and a playlist is ingested as a pipeline of these stages.
+Retries and rate limits follow the same policy as the blocking client.
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Awaitable, Dict, List, Optional, Protocol, Tuple
+
+import httpx
+
+from app.session import SpotifyAuth
+from app.spotify.api_responses import parse_playlist, parse_tracks_page, feature_batches, assign_audio_features, \
+    parse_first_and_last_section, TRACK_FIELDS, PAGE_SIZE
+from app.spotify.config import SPOTIFY_CONFIG
+from app.spotify.database import Database, DatabaseThread, database_thread
+from app.spotify.http_session import AsyncPooledClient, async_http_client, report_request
+from app.spotify.model import PlayList, Track
+from app.spotify.rate_limiter import RequestPriority
+from app.spotify.retry_policy import RetryPolicy, RetryAction, SPOTIFY_RETRY_POLICY
+
+
+class AsyncSpotify:
+    auth: SpotifyAuth
+    # all database calls run on the shared database thread, off the event loop
+    database: DatabaseThread
+    # httpx client shared by everything on the event loop
+    http: AsyncPooledClient
+    retry_policy: RetryPolicy = SPOTIFY_RETRY_POLICY
+    priority: RequestPriority
+    max_concurrent_requests: int
+
+    # API URIs
+    api_base_uri = "https://api.spotify.com/v1/"
+
+    def __init__(self, auth: SpotifyAuth, max_concurrent_requests: Optional[int] = None,
+                 priority: RequestPriority = RequestPriority.INTERACTIVE):
+        """
+        Has to be created on the event loop it is used on
+        :param auth: the authorization of the user
+        :param max_concurrent_requests: number of requests in flight at once,
+                                        defaults to the configured max_concurrent_requests
+        :param priority: priority of the requests of this client at the rate limiter
+        """
+        self.auth = auth
+        self.priority = priority
+        self.database = database_thread("spotify.db")
+        self.http = async_http_client()
+        max_concurrent_requests = SPOTIFY_CONFIG["max_concurrent_requests"] if max_concurrent_requests is None \
+            else max_concurrent_requests
+        self.max_concurrent_requests = max_concurrent_requests
+        self.request_slots = asyncio.Semaphore(max_concurrent_requests)
+        self.authorization_lock = asyncio.Lock()
+
+    async def get_playlist(self, playlist_id: str) -> PlayList:
+        """
+        Fetches a single playlist by id
+        :return: Playlist that has id playlist_id, without contained tracks
+        """
+        uri = f"{self.api_base_uri}playlists/{playlist_id}"
+        error_message = "Something went wrong trying to read the playlists"
+        response = await self.__execute_api_request(lambda headers: self.http.get(uri, headers=headers),
+                                                    error_message=error_message)
+        return parse_playlist(response.json())
+
+    async def get_tracks(self, playlist_id: str) -> List[Track]:
+        """
+        Get all tracks of a playlist, once the first page told the number of tracks all other pages are fetched at once
+
+        :param playlist_id: id of the playlist
+        :return: List of all playlist tracks
+        """
+        first_page = await self._get_tracks_page(playlist_id, 0)
+        pages = [first_page] + await asyncio.gather(*[self._get_tracks_page(playlist_id, offset)
+                                                      for offset in range(PAGE_SIZE, first_page["total"], PAGE_SIZE)])
+        tracks: List[Track] = [track for page in pages for track in parse_tracks_page(page)]
+
+        # Initialize tracks with data from database
+        await self.database.run(Database.bulk_initialize_tracks, tracks)
+        return tracks
+
+    async def get_audio_features(self, tracks: List[Track]):
+        """
+        Fetch and initialize the audio features for a given list of tracks, all batches at once
+        """
+        await asyncio.gather(*[self._get_audio_features_batch(batch) for batch in feature_batches(tracks)])
+
+    async def get_first_and_last_section_analysis(self, tracks: List[Track]):
+        """
+        Get the first and last section analysis of all tracks without one at once, the tracks are cached together once
+        all analyses arrived. The tracks need their audio features to be cached.
+        """
+        # A track that appears more than once in a playlist is only fetched once
+        uninitialized_tracks = {track.id: track for track in tracks if track.section_analysis is None}
+        await asyncio.gather(*[self._get_section_analysis(track) for track in uninitialized_tracks.values()])
+        await self.database.run(Database.insert_tracks, list(uninitialized_tracks.values()))
+        for track in tracks:
+            if track.section_analysis is None:
+                track.section_analysis = uninitialized_tracks[track.id].section_analysis
+
+    async def fetch_and_initialize_playlist(self, playlist_id: str, queue_pages: Optional[int] = None) -> PlayList:
+        """
+        Fetches all songs in a playlist, and initializes their audio features and first and last section analysis.
+        Every page of tracks streams through the database lookup, its audio-features batch and the analysis of its
+        tracks as soon as it arrived, the tracks of a page are cached together once all of them are analysed.
+        The stages are connected by bounded queues, so their network waits overlap and the whole fetch takes about as
+        long as the slowest stage, while a slow stage holds back the ones before it.
+
+        :param playlist_id: id of the playlist
+        :param queue_pages: number of pages each queue holds, defaults to the configured ingestion_queue_pages
+        :return: the playlist with all its tracks
+        """
+        queue_pages = SPOTIFY_CONFIG["ingestion_queue_pages"] if queue_pages is None else queue_pages
+        analysis_workers = self.max_concurrent_requests
+        fetched_pages: asyncio.Queue[Optional[Tuple[int, List[Track]]]] = asyncio.Queue(queue_pages)
+        uncached_tracks: asyncio.Queue[Optional[List[Track]]] = asyncio.Queue(queue_pages)
+        # Tracks to analyse together with the number of the batch of tracks they are cached with
+        unanalysed_tracks: asyncio.Queue[Optional[Tuple[int, Track]]] = asyncio.Queue(queue_pages * PAGE_SIZE)
+        pages: Dict[int, List[Track]] = {}
+        unanalysed_batches: Dict[int, List[Track]] = {}
+        remaining_analyses: Dict[int, int] = {}
+        # The first track of every id, a track that appears more than once in a playlist is only fetched once
+        fetched_tracks: Dict[str, Track] = {}
+
+        async def fetch_pages():
+            async def fetch_page(offset: int, body: Optional[dict] = None):
+                body = await self._get_tracks_page(playlist_id, offset) if body is None else body
+                await fetched_pages.put((offset, parse_tracks_page(body)))
+
+            first_page = await self._get_tracks_page(playlist_id, 0)
+            await asyncio.gather(fetch_page(0, first_page),
+                                 *[fetch_page(offset) for offset in range(PAGE_SIZE, first_page["total"], PAGE_SIZE)])
+            await fetched_pages.put(None)
+
+        async def look_up_tracks():
+            while (page := await fetched_pages.get()) is not None:
+                offset, tracks = page
+                pages[offset] = tracks
+                # Initialize tracks with data from database
+                await self.database.run(Database.bulk_initialize_tracks, tracks)
+                uncached = [track for track in tracks if track.features is None and track.id not in fetched_tracks]
+                for track in uncached:
+                    fetched_tracks.setdefault(track.id, track)
+                if len(uncached) > 0:
+                    await uncached_tracks.put(uncached)
+            await uncached_tracks.put(None)
+
+        async def fetch_features():
+            batch = 0
+            while (tracks := await uncached_tracks.get()) is not None:
+                await self._get_audio_features_batch(tracks)
+                tracks = [track for track in tracks if fetched_tracks[track.id] is track]
+                if len(tracks) == 0:
+                    continue
+                unanalysed_batches[batch], remaining_analyses[batch] = tracks, len(tracks)
+                for track in tracks:
+                    await unanalysed_tracks.put((batch, track))
+                batch += 1
+            for _ in range(analysis_workers):
+                await unanalysed_tracks.put(None)
+
+        async def fetch_analysis():
+            while (item := await unanalysed_tracks.get()) is not None:
+                batch, track = item
+                await self._get_section_analysis(track)
+                remaining_analyses[batch] -= 1
+                if remaining_analyses[batch] == 0:
+                    del remaining_analyses[batch]
+                    await self.database.run(Database.insert_tracks, unanalysed_batches.pop(batch))
+
+        stages = [asyncio.ensure_future(stage) for stage in
+                  [fetch_pages(), look_up_tracks(), fetch_features()] + [fetch_analysis()
+                                                                         for _ in range(analysis_workers)]]
+        try:
+            playlist, _ = await asyncio.gather(self.get_playlist(playlist_id), asyncio.gather(*stages))
+        except BaseException:
+            # A failed stage would leave the others waiting on their queues forever
+            for stage in stages:
+                stage.cancel()
+            raise
+
+        playlist.tracks = [track for offset in sorted(pages) for track in pages[offset]]
+        for track in playlist.tracks:
+            if track.features is None or track.section_analysis is None:
+                track.features = fetched_tracks[track.id].features
+                track.section_analysis = fetched_tracks[track.id].section_analysis
+        print(f"Spotify API: {self.http.statistics}")
+        return playlist
+
+    async def _get_tracks_page(self, playlist_id: str, offset: int) -> dict:
+        """
+        :return: the page of playlist items starting at offset, with the total number of items
+        """
+        uri = f"{self.api_base_uri}playlists/{playlist_id}/tracks?{TRACK_FIELDS}&limit={PAGE_SIZE}&offset={offset}"
+        error_message = "Something went wrong trying to read the tracks from a playlist"
+        response = await self.__execute_api_request(lambda headers: self.http.get(uri, headers=headers),
+                                                    error_message=error_message)
+        return response.json()
+
+    async def _get_audio_features_batch(self, batch: List[Track]):
+        """
+        Fetch and initialize the audio features of at most PAGE_SIZE tracks with one request
+        """
+        uri = f"{self.api_base_uri}audio-features?ids={','.join([track.id for track in batch])}"
+        error_message = "Something went wrong trying to get audio features"
+        response = await self.__execute_api_request(lambda headers: self.http.get(uri, headers=headers),
+                                                    error_message=error_message)
+        assign_audio_features(response.json()["audio_features"], batch)
+
+    async def _get_section_analysis(self, track: Track):
+        """
+        Fetch and initialize the first and last section analysis of a track, caching it is left to the caller
+        """
+        uri = f"{self.api_base_uri}audio-analysis/{track.id}?fields=sections"
+        error_message = "Something went wrong trying to get the audio analysis of a track"
+        response = await self.__execute_api_request(lambda headers: self.http.get(uri, headers=headers),
+                                                    error_message=error_message)
+        track.section_analysis = parse_first_and_last_section(response.json())
+
+    async def __refresh_authorization(self, expired_header: Optional[dict[str, str]] = None):
+        """
+        Refresh the authorization once for all concurrent requests, the blocking token request runs in a thread
+        :param expired_header: the header that was rejected, no refresh happens if another request already replaced it
+        """
+        async with self.authorization_lock:
+            if expired_header is None and self.auth.auth_valid():
+                return
+            if expired_header is not None and expired_header["Authorization"] != f"Bearer {self.auth.access_token}":
+                return
+            await asyncio.to_thread(self.auth.refresh_authorization)
+
+    async def __execute_api_request(
+            self, request: AsyncSpotifyRequest, acceptable_codes=None, max_attempts: Optional[int] = None,
+            error_message: str = "Something went wrong trying to execute a Spotify API request") -> httpx.Response:
+        """
+        Executes a Spotify API request while capturing errors and retrying after being rate limited or unauthorized,
+        as decided by the retry policy. Every attempt waits for the rate limiter first and at most
+        max_concurrent_requests requests are in flight at once.
+
+        :param request: Function that sends an httpx request, returns the awaitable response and takes auth
+        :param acceptable_codes: The status codes that are acceptable
+        :param max_attempts: The maximum number of attempts to try, defaults to that of the retry policy
+        :param error_message: The error message to display if the request fails
+        :return: The response of the request
+        """
+        if acceptable_codes is None:
+            acceptable_codes = [200]
+        max_attempts = self.retry_policy.max_attempts if max_attempts is None else max_attempts
+        response = None
+        for attempt in range(1, max_attempts + 1):
+            await self.retry_policy.rate_limiter.acquire_async(self.priority)
+            if not self.auth.auth_valid():
+                await self.__refresh_authorization()
+            auth_header = self.auth.get_auth_header()
+
+            try:
+                async with self.request_slots:
+                    response = await request(auth_header)
+            except httpx.TransportError:
+                await asyncio.sleep(self.retry_policy.after_transport_error(attempt))
+                continue
+            report_request(response)
+
+            action = self.retry_policy.after_response(response, attempt, acceptable_codes, error_message, max_attempts)
+            if action is RetryAction.RETURN:
+                return response
+            elif action is RetryAction.REFRESH_AUTHORIZATION:
+                await self.__refresh_authorization(auth_header)
+
+        raise self.retry_policy.failure(response, error_message)
+
+
+class AsyncSpotifyRequest(Protocol):
+    def __call__(self, auth_header: dict[str, str]) -> Awaitable[httpx.Response]: ...
@@ -0,0 +1,52 @@
+"""
+Configuration of the Spotify client, values missing from conf/spotify_config.json fall back to the defaults below
+"""
+import json
+import os
+
+SPOTIFY_CONFIG_PATH = "conf/spotify_config.json"
+
+DEFAULT_SPOTIFY_CONFIG = {
+    # Number of hosts the shared HTTP session keeps a connection pool for and connections kept alive per host
+    "pool_connections": 4,
+    "pool_maxsize": 16,
+    # Wait for a free pooled connection instead of opening a throwaway one once pool_maxsize are in use
+    "pool_block": False,
+    # Keep connections open between requests, without it every request pays a new TCP and TLS handshake
+    "keep_alive": True,
+    # Seconds to wait for a connection to be established and for the response to a request
+    "connect_timeout": 5,
+    "read_timeout": 30,
+    # The asyncio client: number of requests it keeps in flight at once and whether it negotiates HTTP/2,
+    # which needs the h2 package (httpx[http2])
+    "max_concurrent_requests": 8,
+    "http2": False,
+    # Number of pages of tracks every queue between the stages of the playlist ingestion pipeline holds
+    "ingestion_queue_pages": 4,
+    # All requests of the process are paced by a token bucket: the sustained requests per second, the number of
+    # requests that may be sent at once after a quiet period and the fraction of those left to interactive requests
+    # by background requests. With a rate_limit_database, e.g. "../cache/rate_limit.db", all processes using the
+    # file share the bucket.
+    "requests_per_second": 10,
+    "request_burst": 20,
+    "background_reserve": 0.5,
+    "rate_limit_database": None,
+    # Print latency and connection reuse of every Spotify API request
+    "log_requests": False,
+}
+
+
+def load_spotify_config(path: str = SPOTIFY_CONFIG_PATH) -> dict:
+    """
+    Read the Spotify client configuration
+    :param path: path of the json config file
+    :return: the configuration, with defaults for every key not present in the file
+    """
+    config = dict(DEFAULT_SPOTIFY_CONFIG)
+    if os.path.exists(path):
+        with open(path, "r") as config_file:
+            config.update(json.load(config_file))
+    return config
+
+
+SPOTIFY_CONFIG = load_spotify_config()
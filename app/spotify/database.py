@@ -1,12 +1,28 @@
 """
 Sqlite database wrapper to cache Tracks, TrackFeatures and TrackSections
 """
+import asyncio
 import sqlite3
-from typing import Optional, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, Optional, List, Tuple
+
+import numpy as np
 
 from app.spotify.model import Track, TrackFeatures
 from app.spotify.model.track import TrackSection
 
+# Every track's analysis is also stored as one fixed width blob of float32 values laid out as
+# [features (5) | first section (2) | last section (2)], the start and end vectors are views into it
+TRACK_VECTOR_DTYPE = np.dtype("<f4")
+TRACK_VECTOR_LENGTH = 9
+# Columns of the running library statistics, first and last sections share the loudness and tempo statistics
+STATISTIC_COLUMNS = ("acousticness", "danceability", "energy", "instrumentalness", "valence", "loudness", "tempo")
+# Schema version stored in PRAGMA user_version, migrations of older databases only run once per database file
+# 1: the vectors column is filled for every track
+# 2: the running library statistics hold every cached track
+SCHEMA_VERSION = 2
+
 
 class Database:
     def __init__(self, file_name: str):
@@ -38,30 +54,194 @@ class Database:
                 fk_section_first int,
                 fk_section_last int,
                 fk_features int,
+                vectors BLOB,
                 FOREIGN KEY (fk_section_first) REFERENCES track_sections(id),
                 FOREIGN KEY (fk_section_last) REFERENCES track_sections(id),
                 FOREIGN KEY (fk_features) REFERENCES track_features(id)
             );            
         """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS library_statistics (
+                name TEXT PRIMARY KEY,
+                count INTEGER,
+                mean REAL,
+                m2 REAL,
+                snapshot_mean REAL,
+                snapshot_std REAL
+            );
+        """)
+        self.migrate()
+
+    def migrate(self):
+        """
+        Bring databases of an older schema version up to SCHEMA_VERSION, newly created databases only get their
+        version set
+        """
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        if version < 1:
+            self.migrate_track_vectors()
+        if version < 2:
+            self.migrate_library_statistics()
+        # PRAGMA does not take parameters, the version is a constant int
+        self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.commit()
+
+    def migrate_track_vectors(self):
+        """
+        Add the vectors column to databases created before it existed and fill it for all tracks that lack it
+        """
+        columns = [column[1] for column in self.db.execute("PRAGMA table_info(tracks)").fetchall()]
+        if "vectors" not in columns:
+            self.db.execute("ALTER TABLE tracks ADD COLUMN vectors BLOB")
+        cursor = self.db.execute("""
+            SELECT tracks.id,
+                   track_features.acousticness, track_features.danceability, track_features.energy,
+                   track_features.instrumentalness, track_features.valence,
+                   first_section.loudness, first_section.tempo,
+                   last_section.loudness, last_section.tempo
+            FROM tracks
+                JOIN track_features ON tracks.fk_features = track_features.id
+                JOIN track_sections AS first_section ON tracks.fk_section_first = first_section.id
+                JOIN track_sections AS last_section ON tracks.fk_section_last = last_section.id
+            WHERE tracks.vectors IS NULL
+        """)
+        updates = [(np.array(row[1:], dtype=TRACK_VECTOR_DTYPE).tobytes(), row[0]) for row in cursor.fetchall()]
+        if updates:
+            self.db.executemany("UPDATE tracks SET vectors = ? WHERE id = ?", updates)
+        self.db.commit()
+
+    def migrate_library_statistics(self):
+        """
+        Compute the running library statistics from all cached tracks if they have not been kept yet
+        """
+        if self.db.execute("SELECT COUNT(*) FROM library_statistics").fetchone()[0] > 0:
+            return
+        self.db.executemany("INSERT INTO library_statistics (name, count, mean, m2) VALUES (?, 0, 0, 0)",
+                            [(name,) for name in STATISTIC_COLUMNS])
+        for _, vectors in self.iter_track_vectors():
+            self._add_to_library_statistics(vectors)
+        self.db.commit()
+
+    def get_library_statistics(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: tuple of (number of values, mean, sum of squared deviations from the mean) for every column of
+                 STATISTIC_COLUMNS, over all cached tracks
+        """
+        cursor = self.db.execute("SELECT name, count, mean, m2 FROM library_statistics")
+        rows = {row[0]: row[1:] for row in cursor.fetchall()}
+        values = np.array([rows[name] for name in STATISTIC_COLUMNS], dtype=np.float64)
+        return values[:, 0], values[:, 1], values[:, 2]
+
+    def get_statistics_snapshot(self) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        :return: tuple of (mean, standard deviation) for every column of STATISTIC_COLUMNS as last stored with
+                 put_statistics_snapshot, or None if no snapshot was stored yet
+        """
+        cursor = self.db.execute("""
+            SELECT name, snapshot_mean, snapshot_std FROM library_statistics WHERE snapshot_mean IS NOT NULL
+        """)
+        rows = {row[0]: row[1:] for row in cursor.fetchall()}
+        if len(rows) < len(STATISTIC_COLUMNS):
+            return None
+        values = np.array([rows[name] for name in STATISTIC_COLUMNS], dtype=np.float64)
+        return values[:, 0], values[:, 1]
+
+    def put_statistics_snapshot(self, mean: np.ndarray, std: np.ndarray):
+        """
+        Store a fixed copy of the library statistics, vectors standardized with it stay valid while the running
+        statistics keep changing
+        """
+        self.db.executemany("UPDATE library_statistics SET snapshot_mean = ?, snapshot_std = ? WHERE name = ?",
+                            [(float(m), float(d), name) for m, d, name in zip(mean, std, STATISTIC_COLUMNS)])
+        self.db.commit()
+
+    def _add_to_library_statistics(self, vectors: np.ndarray):
+        """
+        Merge the values of the given tracks into the running statistics (Welford, merged per batch following Chan et
+        al.), without committing
+        :param vectors: array of shape (n, TRACK_VECTOR_LENGTH)
+        """
+        vectors = np.asarray(vectors, dtype=np.float64)
+        # the first and last section values of every track are both observations of the section columns
+        columns = [vectors[:, i] for i in range(5)] + [vectors[:, [5, 7]].ravel(), vectors[:, [6, 8]].ravel()]
+        batch_count = np.array([len(column) for column in columns], dtype=np.float64)
+        batch_mean = np.array([column.mean() for column in columns])
+        batch_m2 = np.array([np.square(column - column.mean()).sum() for column in columns])
+
+        count, mean, m2 = self.get_library_statistics()
+        total = count + batch_count
+        delta = batch_mean - mean
+        mean = mean + delta * batch_count / total
+        m2 = m2 + batch_m2 + delta ** 2 * count * batch_count / total
+        self.db.executemany("UPDATE library_statistics SET count = ?, mean = ?, m2 = ? WHERE name = ?",
+                            [(int(c), float(m), float(v), name) for c, m, v, name in zip(total, mean, m2,
+                                                                                       STATISTIC_COLUMNS)])
 
     def bulk_initialize_tracks(self, tracks: List[Track]):
         """
-        Initialize all tracks from the given list with data from the database (if available)
+        Initialize all tracks from the given list with data from the database (if available), with a single query
         :param tracks: List of tracks with at least their id initialized
         """
-        track_ids = [track.id for track in tracks]
+        track_ids = list(dict.fromkeys(track.id for track in tracks))
+        if len(track_ids) == 0:
+            return
         cursor = self.db.execute("""
-            SELECT * FROM tracks WHERE id IN (%s)
+            SELECT tracks.id, tracks.name, tracks.href,
+                   track_features.acousticness, track_features.danceability, track_features.energy,
+                   track_features.instrumentalness, track_features.valence,
+                   first_section.loudness, first_section.tempo,
+                   last_section.loudness, last_section.tempo
+            FROM tracks
+                JOIN track_features ON tracks.fk_features = track_features.id
+                JOIN track_sections AS first_section ON tracks.fk_section_first = first_section.id
+                JOIN track_sections AS last_section ON tracks.fk_section_last = last_section.id
+            WHERE tracks.id IN (%s)
         """ % ','.join('?' * len(track_ids)), track_ids)
-        result = cursor.fetchall()
-        for track in result:
-            t_id = track[0]
-            for t in tracks:
-                if t.id == t_id:
-                    t.name = track[1]
-                    t.href = track[2]
-                    t.features = self.get_track_features(track[5])
-                    t.section_analysis = (self.get_track_section(track[3]), self.get_track_section(track[4]))
+        rows = {row[0]: row for row in cursor.fetchall()}
+        for track in tracks:
+            row = rows.get(track.id)
+            if row is not None:
+                track.name = row[1]
+                track.href = row[2]
+                track.features = TrackFeatures(*row[3:8])
+                track.section_analysis = (TrackSection(*row[8:10]), TrackSection(*row[10:12]))
+
+    def get_track_vectors(self, track_ids: List[str]) -> np.ndarray:
+        """
+        Load the analysis of the given tracks as one array, straight from the stored blobs
+        :param track_ids: ids of the tracks to load, may contain duplicates
+        :return: array of shape (len(track_ids), TRACK_VECTOR_LENGTH) in the order of track_ids
+        """
+        unique_ids = list(dict.fromkeys(track_ids))
+        cursor = self.db.execute("""
+            SELECT id, vectors FROM tracks WHERE vectors IS NOT NULL AND id IN (%s)
+        """ % ','.join('?' * len(unique_ids)), unique_ids)
+        blobs = dict(cursor.fetchall())
+        missing = [track_id for track_id in unique_ids if track_id not in blobs]
+        if missing:
+            raise ValueError(f"Tracks {', '.join(missing)} are not cached")
+        vectors = np.empty((len(track_ids), TRACK_VECTOR_LENGTH), dtype=TRACK_VECTOR_DTYPE)
+        for i, track_id in enumerate(track_ids):
+            vectors[i] = np.frombuffer(blobs[track_id], dtype=TRACK_VECTOR_DTYPE)
+        return vectors
+
+    def iter_track_vectors(self, chunk_size: int = 10000) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """
+        Stream the analysis of every cached track in chunks, so that the whole library never has to be held in memory
+        :param chunk_size: number of tracks per chunk
+        :return: iterator over tuples of (track ids, array of shape (len(track ids), TRACK_VECTOR_LENGTH))
+        """
+        cursor = self.db.execute("""
+            SELECT id, vectors FROM tracks WHERE vectors IS NOT NULL
+        """)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=TRACK_VECTOR_DTYPE)
+            yield [row[0] for row in rows], vectors.reshape(len(rows), TRACK_VECTOR_LENGTH)
 
     def get_track(self, track_id: str) -> Optional[Track]:
         cursor = self.db.execute("""
@@ -79,21 +259,52 @@ class Database:
             return track
 
     def insert_track(self, track: Track):
+        self.insert_tracks([track])
+
+    def insert_tracks(self, tracks: List[Track]):
+        """
+        Cache tracks with their features and section analysis in one transaction,
+        the library statistics are updated once for all of them
+        :param tracks: the tracks to cache, tracks that are already cached are skipped
+        """
+        added = []
         try:
-            self.db.execute("""
-                INSERT INTO tracks (id, name, href, fk_section_first, fk_section_last, fk_features)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (track.id,
-                  track.name,
-                  track.href,
-                  self.insert_track_section(track.section_analysis[0]),
-                  self.insert_track_section(track.section_analysis[1]),
-                  self.insert_track_features(track.features)))
+            for track in tracks:
+                vectors = self.track_vector_blob(track)
+                cursor = self.db.execute("""
+                    INSERT OR IGNORE INTO tracks (id, name, href, fk_section_first, fk_section_last, fk_features,
+                                                  vectors)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (track.id,
+                      track.name,
+                      track.href,
+                      self.insert_track_section(track.section_analysis[0]),
+                      self.insert_track_section(track.section_analysis[1]),
+                      self.insert_track_features(track.features),
+                      vectors))
+                # only tracks that were actually added count towards the statistics
+                if cursor.rowcount > 0:
+                    added.append(vectors)
+            if added:
+                self._add_to_library_statistics(
+                    np.frombuffer(b"".join(added), dtype=TRACK_VECTOR_DTYPE).reshape(len(added), -1))
             self.db.commit()
-        except sqlite3.IntegrityError:
+        except BaseException:
             self.db.rollback()
+            raise
+
+    @staticmethod
+    def track_vector_blob(track: Track) -> bytes:
+        """
+        :return: the analysis of the track packed into the layout of the vectors column
+        """
+        values = track.features.as_list() + track.section_analysis[0].as_list() + track.section_analysis[1].as_list()
+        return np.array(values, dtype=TRACK_VECTOR_DTYPE).tobytes()
 
     def insert_track_section(self, section: TrackSection) -> int:
+        """
+        :return: the id of the stored section with the same values, stored first if there is none, without committing
+        """
         cursor = self.db.execute("""
             SELECT id FROM track_sections WHERE loudness = ? AND tempo = ?
         """, (section.loudness, section.tempo))
@@ -102,12 +313,14 @@ class Database:
             cursor = self.db.execute("""
                 INSERT INTO track_sections (loudness, tempo) VALUES (?, ?)
             """, (section.loudness, section.tempo))
-            self.db.commit()
             return cursor.lastrowid
         else:
             return result[0]
 
     def insert_track_features(self, features: TrackFeatures) -> int:
+        """
+        :return: the id of the stored features with the same values, stored first if there are none, without committing
+        """
         cursor = self.db.execute("""
             SELECT id FROM track_features 
             WHERE acousticness = ? AND danceability = ? AND energy = ? AND instrumentalness = ? AND valence = ?
@@ -125,7 +338,6 @@ class Database:
                   features.energy,
                   features.instrumentalness,
                   features.valence))
-            self.db.commit()
             return cursor.lastrowid
         else:
             return result[0]
@@ -185,3 +397,45 @@ class Database:
             return None
         else:
             return TrackSection(result[1], result[2])
+
+
+class DatabaseThread:
+    """
+    Runs the calls to a database on one dedicated thread that owns its connection, so the event loop never waits for
+    SQLite and the connection is never shared between threads. The calls run one after another in the order they were
+    made.
+    """
+    file_name: str
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+        # Created on the database thread by its first call
+        self.database: Optional[Database] = None
+
+    async def run(self, method: Callable[..., Any], *args) -> Any:
+        """
+        :param method: function taking the Database as first argument, e.g. Database.insert_tracks
+        :param args: further arguments of the method
+        :return: the result of the method, computed on the database thread
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._call, method, args)
+
+    def _call(self, method: Callable[..., Any], args: tuple) -> Any:
+        if self.database is None:
+            self.database = Database(self.file_name)
+        return method(self.database, *args)
+
+
+_database_threads: Dict[str, DatabaseThread] = {}
+_database_threads_lock = threading.Lock()
+
+
+def database_thread(file_name: str) -> DatabaseThread:
+    """
+    :return: the process wide database thread of the given database file
+    """
+    with _database_threads_lock:
+        if file_name not in _database_threads:
+            _database_threads[file_name] = DatabaseThread(file_name)
+        return _database_threads[file_name]
@@ -0,0 +1,191 @@
+"""
+Process-wide HTTP sessions of the Spotify clients. Every Spotify instance, and with it every user session, sends its
+requests through the same pooled session, so connections to the API are kept alive and reused instead of paying a
+TCP and TLS handshake for each of the many per track requests. AsyncSpotify shares one httpx client per event loop.
+"""
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+import weakref
+from typing import Optional, Union
+
+import httpx
+import requests
+from requests import Response
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from app.spotify.config import SPOTIFY_CONFIG
+
+# Set by the connection pools whenever a request of the current thread had to open a new connection
+_connection_events = threading.local()
+
+
+class _TrackingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _connection_events.opened = True
+        return super()._new_conn()
+
+
+class _TrackingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _connection_events.opened = True
+        return super()._new_conn()
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    Transport adapter with a fixed size connection pool per host, a default timeout for every request and
+    connection pools that record when a new connection is opened
+    """
+    timeout: tuple[float, float]
+
+    def __init__(self, pool_connections: int, pool_maxsize: int, pool_block: bool, timeout: tuple[float, float]):
+        self.timeout = timeout
+        super().__init__(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TrackingHTTPConnectionPool,
+                                                   "https": _TrackingHTTPSConnectionPool}
+
+    def send(self, request, stream=False, timeout=None, **kwargs) -> Response:
+        return super().send(request, stream=stream, timeout=self.timeout if timeout is None else timeout, **kwargs)
+
+
+class RequestStatistics:
+    """
+    Number, latency and connection reuse of the requests sent through a session, safe to update from several threads
+    """
+    requests: int
+    reused: int
+    total_latency: float
+    max_latency: float
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.reused = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency: float, reused: bool):
+        with self.lock:
+            self.requests += 1
+            self.reused += reused
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def __str__(self) -> str:
+        with self.lock:
+            if self.requests == 0:
+                return "no requests"
+            return f"{self.requests} requests, {self.reused / self.requests:.0%} on reused connections, " \
+                   f"mean latency {1000 * self.total_latency / self.requests:.0f} ms, " \
+                   f"max {1000 * self.max_latency:.0f} ms"
+
+
+def report_request(response: Union[Response, httpx.Response]):
+    """
+    Print method, url, status, latency and connection reuse of a request sent through a pooled session or client,
+    if log_requests is configured
+    """
+    if SPOTIFY_CONFIG["log_requests"]:
+        connection = "reused" if response.connection_reused else "new"
+        print(f"{response.request.method} {response.url}: {response.status_code} "
+              f"in {1000 * response.latency:.0f} ms, {connection} connection")
+
+
+class PooledSession(requests.Session):
+    """
+    requests session that measures every request, the latency in seconds and whether the request was sent over an
+    already open connection are set as latency and connection_reused on the response
+    """
+    statistics: RequestStatistics
+
+    def __init__(self, adapter: PooledAdapter, keep_alive: bool = True):
+        super().__init__()
+        self.statistics = RequestStatistics()
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        if not keep_alive:
+            self.headers["Connection"] = "close"
+
+    def request(self, method, url, *args, **kwargs) -> Response:
+        _connection_events.opened = False
+        started = time.perf_counter()
+        response = super().request(method, url, *args, **kwargs)
+        response.latency = time.perf_counter() - started
+        response.connection_reused = not _connection_events.opened
+        self.statistics.record(response.latency, response.connection_reused)
+        return response
+
+
+_session: Optional[PooledSession] = None
+_session_lock = threading.Lock()
+
+
+def http_session() -> PooledSession:
+    """
+    :return: the HTTP session shared by the whole process, created from the Spotify config on first use
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = PooledAdapter(SPOTIFY_CONFIG["pool_connections"], SPOTIFY_CONFIG["pool_maxsize"],
+                                        SPOTIFY_CONFIG["pool_block"],
+                                        (SPOTIFY_CONFIG["connect_timeout"], SPOTIFY_CONFIG["read_timeout"]))
+                _session = PooledSession(adapter, SPOTIFY_CONFIG["keep_alive"])
+    return _session
+
+
+class AsyncPooledClient(httpx.AsyncClient):
+    """
+    httpx client that measures every request like PooledSession, a new connection is detected by tracing the
+    connection setup of the request
+    """
+    statistics: RequestStatistics
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statistics = RequestStatistics()
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        opened = False
+
+        async def trace(event_name: str, _):
+            nonlocal opened
+            if event_name.startswith("connection.connect_tcp."):
+                opened = True
+
+        request.extensions["trace"] = trace
+        started = time.perf_counter()
+        response = await super().send(request, **kwargs)
+        response.latency = time.perf_counter() - started
+        response.connection_reused = not opened
+        self.statistics.record(response.latency, response.connection_reused)
+        return response
+
+
+_async_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncPooledClient] = weakref.WeakKeyDictionary()
+
+
+def async_http_client() -> AsyncPooledClient:
+    """
+    httpx connections belong to the event loop they were opened on, so every loop gets its own client
+    :return: the client shared by everything running on the current event loop
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        keep_alive_connections = SPOTIFY_CONFIG["pool_maxsize"] if SPOTIFY_CONFIG["keep_alive"] else 0
+        limits = httpx.Limits(max_connections=SPOTIFY_CONFIG["pool_maxsize"],
+                              max_keepalive_connections=keep_alive_connections)
+        timeout = httpx.Timeout(SPOTIFY_CONFIG["read_timeout"], connect=SPOTIFY_CONFIG["connect_timeout"],
+                                pool=None)
+        client = AsyncPooledClient(http2=SPOTIFY_CONFIG["http2"], limits=limits, timeout=timeout)
+        _async_clients[loop] = client
+    return client
@@ -0,0 +1,218 @@
+"""
+Token bucket that paces all Spotify API requests of the process ahead of time, instead of only reacting once Spotify
+answered 429. Every interactive request reserves a token and waits until it is due, so concurrent requests of all user
+sessions queue up behind each other. Background requests never reserve ahead, they only take a token while the bucket
+holds more than the part kept for interactive requests, so they never delay one. A Retry-After empties the bucket until
+it has passed, which holds off every request. With a SQLite state file the bucket is shared by
+all processes using the same file.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from enum import IntEnum
+from typing import Any, Callable, Optional, Tuple
+
+from app.spotify.config import SPOTIFY_CONFIG
+
+
+class RequestPriority(IntEnum):
+    # Requests a user is waiting for, e.g. page loads
+    INTERACTIVE = 0
+    # Requests nobody waits for, e.g. warming the track cache
+    BACKGROUND = 1
+
+
+# Bucket update: (tokens, updated, now) -> (tokens, updated, result)
+BucketUpdate = Callable[[float, float, float], Tuple[float, float, Any]]
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket with reservations, the tokens may become negative to queue up requests that wait for future tokens.
+    updated lies in the future while a Retry-After pause lasts.
+    """
+    rate: float
+    capacity: float
+    background_reserve: float
+
+    def __init__(self, rate: float, capacity: float, background_reserve: float = 0.0):
+        """
+        :param rate: tokens added per second, the sustained number of requests per second
+        :param capacity: size of the bucket, the number of requests that may be sent at once after a quiet period
+        :param background_reserve: fraction of the bucket background requests leave to interactive ones
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.background_reserve = background_reserve
+        self.tokens = capacity
+        self.updated = self.clock()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def clock() -> float:
+        return time.monotonic()
+
+    def _transact(self, update: BucketUpdate) -> Any:
+        """
+        Apply an update to the bucket atomically
+        :return: the result of the update
+        """
+        with self.lock:
+            self.tokens, self.updated, result = update(self.tokens, self.updated, self.clock())
+        return result
+
+    async def _transact_async(self, update: BucketUpdate) -> Any:
+        """
+        Apply an update to the bucket atomically from the event loop, the in-memory bucket is only locked for the
+        update itself so it is applied right away
+        :return: the result of the update
+        """
+        return self._transact(update)
+
+    def _refill(self, tokens: float, updated: float, now: float) -> Tuple[float, float]:
+        if now > updated:
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            updated = now
+        return tokens, updated
+
+    def reserve(self, priority: RequestPriority = RequestPriority.INTERACTIVE) -> Tuple[bool, float]:
+        """
+        Take a token for a request. Interactive requests always get one, to be used once the returned delay has passed.
+        Background requests only get one that can be used right away, otherwise they have to try again after the delay.
+        :param priority: the priority of the request
+        :return: tuple of (whether a token was taken, seconds to wait)
+        """
+        return self._transact(self._reservation(priority))
+
+    def _reservation(self, priority: RequestPriority) -> BucketUpdate:
+        """
+        :return: the bucket update taking a token for a request of the given priority, see reserve
+        """
+        background = priority == RequestPriority.BACKGROUND
+        floor = self.background_reserve * self.capacity if background else 0.0
+
+        def update(tokens: float, updated: float, now: float) -> Tuple[float, float, Tuple[bool, float]]:
+            tokens, updated = self._refill(tokens, updated, now)
+            delay = max(0.0, updated - now) + max(0.0, floor + 1 - tokens) / self.rate
+            if background and delay > 0:
+                return tokens, updated, (False, delay)
+            return tokens - 1, updated, (True, delay)
+
+        return update
+
+    def pause(self, seconds: float):
+        """
+        Honour a Retry-After: no token is handed out for the given number of seconds,
+        and requests already waiting for a token stay queued behind the pause
+        """
+        def update(tokens: float, updated: float, now: float) -> Tuple[float, float, float]:
+            tokens, updated = self._refill(tokens, updated, now)
+            return min(tokens, 0.0), max(updated, now + seconds), 0.0
+
+        self._transact(update)
+
+    def pause_remaining(self) -> float:
+        """
+        :return: seconds until a Retry-After pause is over, 0 if there is none
+        """
+        return self._transact(self._remaining_pause)
+
+    @staticmethod
+    def _remaining_pause(tokens: float, updated: float, now: float) -> Tuple[float, float, float]:
+        return tokens, updated, max(0.0, updated - now)
+
+    def acquire(self, priority: RequestPriority = RequestPriority.INTERACTIVE):
+        """
+        Block until a request of the given priority may be sent
+        """
+        taken = False
+        while not taken:
+            taken, delay = self.reserve(priority)
+            time.sleep(delay)
+        # A pause that started while waiting for the token holds off this request as well
+        while (remaining := self.pause_remaining()) > 0:
+            time.sleep(remaining)
+
+    async def acquire_async(self, priority: RequestPriority = RequestPriority.INTERACTIVE):
+        """
+        Wait on the event loop until a request of the given priority may be sent
+        """
+        taken = False
+        while not taken:
+            taken, delay = await self._transact_async(self._reservation(priority))
+            await asyncio.sleep(delay)
+        while (remaining := await self._transact_async(self._remaining_pause)) > 0:
+            await asyncio.sleep(remaining)
+
+
+class SQLiteTokenBucketLimiter(TokenBucketLimiter):
+    """
+    Token bucket kept in a SQLite file, so that all processes using the file share the bucket. Every thread uses
+    its own connection and every update is an immediate transaction, from the event loop in a worker thread.
+    """
+    path: str
+
+    def __init__(self, path: str, rate: float, capacity: float, background_reserve: float = 0.0):
+        self.path = path
+        self.connections = threading.local()
+        super().__init__(rate, capacity, background_reserve)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS token_bucket (
+                id INTEGER PRIMARY KEY,
+                tokens REAL,
+                updated REAL
+            );
+        """)
+        connection.execute("INSERT OR IGNORE INTO token_bucket (id, tokens, updated) VALUES (0, ?, ?)",
+                           (self.capacity, self.clock()))
+
+    @staticmethod
+    def clock() -> float:
+        # Shared by processes, so it has to be the wall clock
+        return time.time()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection: Optional[sqlite3.Connection] = getattr(self.connections, "connection", None)
+        if connection is None:
+            # Autocommit mode, transactions are opened explicitly
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.connections.connection = connection
+        return connection
+
+    def _transact(self, update: BucketUpdate) -> Any:
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            tokens, updated = connection.execute("SELECT tokens, updated FROM token_bucket WHERE id = 0").fetchone()
+            tokens, updated, result = update(tokens, updated, self.clock())
+            connection.execute("UPDATE token_bucket SET tokens = ?, updated = ? WHERE id = 0", (tokens, updated))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return result
+
+    async def _transact_async(self, update: BucketUpdate) -> Any:
+        """
+        The transaction may wait for other processes holding the file, so it runs in a worker thread with its own
+        connection instead of blocking the event loop
+        """
+        return await asyncio.to_thread(self._transact, update)
+
+
+def create_rate_limiter() -> TokenBucketLimiter:
+    """
+    :return: a limiter as configured, shared through SQLite if a rate_limit_database is configured
+    """
+    rate, capacity = SPOTIFY_CONFIG["requests_per_second"], SPOTIFY_CONFIG["request_burst"]
+    background_reserve = SPOTIFY_CONFIG["background_reserve"]
+    if SPOTIFY_CONFIG["rate_limit_database"] is not None:
+        return SQLiteTokenBucketLimiter(SPOTIFY_CONFIG["rate_limit_database"], rate, capacity, background_reserve)
+    return TokenBucketLimiter(rate, capacity, background_reserve)
@@ -0,0 +1,91 @@
+"""
+Retry and rate limit policy shared by the blocking and the asyncio Spotify client. Both decide how a request continues
+after every attempt the same way and are paced by the same rate limiter: once Spotify answered 429, every request of
+the process holds off until the Retry-After has passed instead of running into the limit again.
+"""
+from __future__ import annotations
+
+from enum import Enum
+from typing import Collection, Optional
+
+from app.exceptions.custom_exceptions import NotLoggedInException, RateLimitedException
+from app.spotify.rate_limiter import TokenBucketLimiter, create_rate_limiter
+
+DEFAULT_MAX_ATTEMPTS = 10
+
+
+class RetryAction(Enum):
+    RETURN = "return"
+    RETRY = "retry"
+    REFRESH_AUTHORIZATION = "refresh_authorization"
+
+
+class RetryPolicy:
+    """
+    Decides whether a response is returned, retried or needs a new authorization, responses may be requests or
+    httpx responses
+    """
+    rate_limiter: TokenBucketLimiter
+    max_attempts: int
+
+    def __init__(self, rate_limiter: TokenBucketLimiter, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        """
+        :param rate_limiter: paces every attempt and is paused by a 429
+        :param max_attempts: the maximum number of attempts of a request
+        """
+        self.rate_limiter = rate_limiter
+        self.max_attempts = max_attempts
+
+    def after_transport_error(self, attempt: int) -> float:
+        """
+        :param attempt: the attempt that failed, starting at 1
+        :return: seconds to wait before retrying after a connection error or timeout
+        """
+        return 1.0 * attempt
+
+    def after_response(self, response, attempt: int, acceptable_codes: Collection[int], error_message: str,
+                       max_attempts: Optional[int] = None) -> RetryAction:
+        """
+        Decide how to continue after a response, a rate limit pauses all requests
+        :param response: the response of the attempt
+        :param attempt: the attempt, starting at 1
+        :param acceptable_codes: the status codes that are returned
+        :param error_message: the error message if the request fails
+        :param max_attempts: overrides the maximum number of attempts of the policy
+        :return: the action to take
+        :raises RateLimitedException: if the last attempt was rate limited
+        :raises NotLoggedInException: if the last attempt was unauthorized
+        :raises Exception: for every other unacceptable status code
+        """
+        max_attempts = self.max_attempts if max_attempts is None else max_attempts
+        status_code = response.status_code
+        if status_code in acceptable_codes:
+            return RetryAction.RETURN
+        elif status_code == 429:
+            if attempt >= max_attempts:
+                raise RateLimitedException(f"Rate limit exceeded: {response.status_code}\n{response.content}")
+            # Check if response even has retry-after header if so wait for that time
+            retry_after = int(response.headers["Retry-After"]) if "Retry-After" in response.headers else 5 * attempt
+            print(f"Ratelimited, waiting for {retry_after} seconds")
+            self.rate_limiter.pause(retry_after)
+            return RetryAction.RETRY
+        elif status_code == 401:
+            if attempt >= max_attempts:
+                raise NotLoggedInException(f"User is not logged in: {response.status_code}\n{response.content}")
+            return RetryAction.REFRESH_AUTHORIZATION
+        else:
+            raise Exception(f"{error_message}: {response.status_code}\n{response.content}")
+
+    @staticmethod
+    def failure(response, error_message: str) -> Exception:
+        """
+        :param response: the last response, None if no attempt got one
+        :return: the exception to raise once all attempts are used up
+        """
+        if response is not None:
+            return Exception(f"{error_message}: {response.status_code}\n{response.content}")
+        return Exception(error_message)
+
+
+# Policy of all Spotify clients of the process
+SPOTIFY_RETRY_POLICY = RetryPolicy(create_rate_limiter())
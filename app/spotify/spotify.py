@@ -6,11 +6,14 @@ from typing import List, Optional, Protocol
 import requests
 from requests import Response
 
-from app.exceptions.custom_exceptions import NotLoggedInException, RateLimitedException
 from app.session import SpotifyAuth
+from app.spotify.api_responses import parse_playlist, parse_tracks_page, feature_batches, assign_audio_features, \
+    parse_first_and_last_section, TRACK_FIELDS
 from app.spotify.database import Database
-from app.spotify.model import PlayList, Track, TrackFeatures
-from app.spotify.model.track import TrackSection
+from app.spotify.http_session import PooledSession, http_session, report_request
+from app.spotify.model import PlayList, Track
+from app.spotify.rate_limiter import RequestPriority
+from app.spotify.retry_policy import RetryPolicy, RetryAction, SPOTIFY_RETRY_POLICY
 
 
 class Spotify:
@@ -18,15 +21,25 @@ class Spotify:
     auth: SpotifyAuth
     user_id: Optional[str] = None
     db: Database
+    # HTTP session shared by all instances
+    http: PooledSession
+    retry_policy: RetryPolicy = SPOTIFY_RETRY_POLICY
+    priority: RequestPriority
 
     # API URIs
     api_base_uri = "https://api.spotify.com/v1/"
 
-    def __init__(self, auth: Optional[SpotifyAuth] = None):
+    def __init__(self, auth: Optional[SpotifyAuth] = None, priority: RequestPriority = RequestPriority.INTERACTIVE):
+        """
+        :param auth: the authorization of the user
+        :param priority: priority of the requests of this client at the rate limiter
+        """
         if auth is None:
             auth = SpotifyAuth()
         self.auth = auth
+        self.priority = priority
         self.database = Database("spotify.db")
+        self.http = http_session()
 
     def authorize(self, auth_code: str, redirect_to: str):
         self.auth.authorize(auth_code, redirect_to)
@@ -37,7 +50,7 @@ class Spotify:
         """
         if not self.user_id:
             def request(auth_header: dict[str, str]) -> Response:
-                return requests.get(self.api_base_uri + "me", headers=auth_header)
+                return self.http.get(self.api_base_uri + "me", headers=auth_header)
 
             error_message = "Something went wrong trying to get user_id"
             response = self.__execute_api_request(request, [200], error_message=error_message)
@@ -56,17 +69,12 @@ class Spotify:
             uri = f"{self.api_base_uri}audio-analysis/{track.id}?{fields}"
 
             def request(auth_header: dict[str, str]) -> Response:
-                return requests.get(uri, headers=auth_header)
+                return self.http.get(uri, headers=auth_header)
 
             error_message = "Something went wrong trying to get the audio analysis of a track"
             response: Response = self.__execute_api_request(request, [200], error_message=error_message)
 
-            body = response.json()
-            sections = body["sections"]
-            first_section = sections[0]
-            last_section = sections[-1]
-            track.section_analysis = (TrackSection(loudness=first_section["loudness"], tempo=first_section["tempo"]),
-                                      TrackSection(loudness=last_section["loudness"], tempo=last_section["tempo"]))
+            track.section_analysis = parse_first_and_last_section(response.json())
             self.database.insert_track(track)
 
     def get_playlists(self) -> List[PlayList]:
@@ -80,7 +88,7 @@ class Spotify:
         while next_uri is not None:
 
             def request(auth_header: dict[str, str]) -> Response:
-                return requests.get(next_uri, headers=auth_header)
+                return self.http.get(next_uri, headers=auth_header)
 
             error_message = "Something went wrong trying to read the playlists"
             response = self.__execute_api_request(request, error_message=error_message)
@@ -90,8 +98,7 @@ class Spotify:
             next_uri = body["next"]
 
             for item in items:
-                playlist = PlayList(name=item["name"], p_id=item["id"], tracks_ref=item["tracks"]["href"])
-                playlists.append(playlist)
+                playlists.append(parse_playlist(item))
 
         return playlists
 
@@ -103,12 +110,11 @@ class Spotify:
         :return: List of all playlist tracks
         """
         tracks: List[Track] = []
-        track_fields = "fields=items(added_at, added_by, track(name, href, id)),next"
-        next_uri = f"{self.api_base_uri}playlists/{playlist_id}/tracks?{track_fields}"
+        next_uri = f"{self.api_base_uri}playlists/{playlist_id}/tracks?{TRACK_FIELDS}"
         # Iterate over all pages of tracks
         while next_uri is not None:
             def request(auth_header: dict[str, str]) -> Response:
-                return requests.get(next_uri, headers=auth_header)
+                return self.http.get(next_uri, headers=auth_header)
 
             error_message = "Something went wrong trying to read the tracks from a playlist"
             response = self.__execute_api_request(request, error_message=error_message)
@@ -116,16 +122,7 @@ class Spotify:
             # Add each track in page to list
             body = response.json()
             next_uri = body["next"]
-            for api_track in body["items"]:
-                track: Track = Track()
-
-                api_track = api_track["track"]
-                track.id = api_track["id"]
-                track.name = api_track["name"]
-                track.href = api_track["href"]
-                # filter out tracks that have since been deleted
-                if track.id:
-                    tracks.append(track)
+            tracks += parse_tracks_page(body)
 
         # Initialize tracks with data from database
         self.database.bulk_initialize_tracks(tracks)
@@ -137,37 +134,18 @@ class Spotify:
         Fetch and initialize the audio features for a given list of tracks
         """
 
-        features: List = []
-        uninitialized_tracks = list(filter(lambda track: track.features is None, tracks))
-        i = 0
-        while i < len(uninitialized_tracks) - 1:
-            track_ids = ",".join([track.id for track in uninitialized_tracks[i:min(i + 100, len(uninitialized_tracks))]])
-            i += 100
+        for batch in feature_batches(tracks):
+            track_ids = ",".join([track.id for track in batch])
             uri = f"{self.api_base_uri}audio-features?ids={track_ids}"
 
             def request(auth_header: dict[str, str]) -> Response:
-                return requests.get(uri, headers=auth_header)
+                return self.http.get(uri, headers=auth_header)
 
             error_message = "Something went wrong trying to get audio features"
             response = self.__execute_api_request(request, error_message=error_message)
 
             # Process features into the corresponding tracks
-            body = response.json()
-            features += body["audio_features"]
-
-        for feature in features:
-            track_id = feature["id"]
-            filtered_tracks = list(filter(lambda track: track.id == track_id, uninitialized_tracks))
-            if len(filtered_tracks) == 0:
-                raise Exception(f"Track with id {track_id} not found in feature responses")
-            feature_object = TrackFeatures(acousticness=feature["acousticness"],
-                                           danceability=feature["danceability"],
-                                           energy=feature["energy"],
-                                           instrumentalness=feature["instrumentalness"],
-                                           valence=feature["valence"])
-
-            for track in filtered_tracks:
-                track.features = feature_object
+            assign_audio_features(response.json()["audio_features"], batch)
 
     def get_playlist(self, playlist_id) -> PlayList:
         """
@@ -177,15 +155,12 @@ class Spotify:
         uri = f"{self.api_base_uri}playlists/{playlist_id}"
 
         def request(auth_header: dict[str, str]) -> Response:
-            return requests.get(uri, headers=auth_header)
+            return self.http.get(uri, headers=auth_header)
 
         error_message = "Something went wrong trying to read the playlists"
         response = self.__execute_api_request(request, error_message=error_message)
 
-        playlist_response = response.json()
-        playlist: PlayList = PlayList(name=playlist_response["name"], p_id=playlist_response["id"],
-                                      tracks_ref=playlist_response["tracks"]["href"])
-        return playlist
+        return parse_playlist(response.json())
 
     def queue_tracks_in_order(self, tracks: List[Track]):
         """
@@ -196,7 +171,7 @@ class Spotify:
             uri = uri + track.href
 
             def request(auth_header: dict[str, str]) -> Response:
-                return requests.post(uri, headers=auth_header)
+                return self.http.post(uri, headers=auth_header)
 
             error_message = "Something went wrong trying to queue a track"
             _ = self.__execute_api_request(request, [204], error_message=error_message)
@@ -226,14 +201,12 @@ class Spotify:
         }
 
         def request(auth_header: dict[str, str]) -> Response:
-            return requests.post(uri, headers=auth_header, json=body)
+            return self.http.post(uri, headers=auth_header, json=body)
 
         error_message = "Something went wrong trying to create a playlist"
         response = self.__execute_api_request(request, [201], error_message=error_message)
 
-        playlist_response = response.json()
-        playlist: PlayList = PlayList(name=playlist_response["name"], p_id=playlist_response["id"],
-                                      tracks_ref=playlist_response["tracks"]["href"])
+        playlist: PlayList = parse_playlist(response.json())
 
         playlist.tracks = tracks
         self.add_tracks_to_playlist(playlist, tracks)
@@ -256,7 +229,7 @@ class Spotify:
             }
 
             def request(auth_header: dict[str, str]) -> Response:
-                return requests.post(uri, headers=auth_header, json=body)
+                return self.http.post(uri, headers=auth_header, json=body)
 
             error_message = "Something went wrong trying to add tracks to a playlist"
             _ = self.__execute_api_request(request, [201], error_message=error_message)
@@ -270,68 +243,46 @@ class Spotify:
         playlist.tracks = tracks
         self.get_audio_features(tracks)
         self.get_first_and_last_section_analysis(tracks)
+        print(f"Spotify API: {self.http.statistics}")
         return playlist
 
     def __execute_api_request(self, request: SpotifyRequest,
                               acceptable_codes=None,
-                              max_attempts: int = 10,
+                              max_attempts: Optional[int] = None,
                               error_message: str = "Something went wrong trying to execute a Spotify API request") \
             -> Response:
         """
-        Executes a Spotify API request while capturing errors and retrying after being rate limited or unauthorized
+        Executes a Spotify API request while capturing errors and retrying after being rate limited or unauthorized,
+        as decided by the retry policy. Every attempt waits for the rate limiter first.
 
         :param request: Function that executes a requests request, returns the requests response and takes auth
         :param acceptable_codes: The status codes that are acceptable
-        :param max_attempts: The maximum number of attempts to try
+        :param max_attempts: The maximum number of attempts to try, defaults to that of the retry policy
         :param error_message: The error message to display if the request fails
         :return: The response of the request
         """
         if acceptable_codes is None:
             acceptable_codes = [200]
+        max_attempts = self.retry_policy.max_attempts if max_attempts is None else max_attempts
         response = None
-        attempt = 1
-        while attempt <= max_attempts:
+        for attempt in range(1, max_attempts + 1):
+            self.retry_policy.rate_limiter.acquire(self.priority)
             auth_header = self.auth.get_auth_header()
 
             try:
                 response = request(auth_header)
-            except requests.exceptions.ConnectionError:
-                time.sleep(1 * attempt)
-                continue
-            except requests.exceptions.HTTPError:
-                time.sleep(1 * attempt)
-                continue
-            except requests.exceptions.Timeout:
-                time.sleep(1 * attempt)
+            except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError, requests.exceptions.Timeout):
+                time.sleep(self.retry_policy.after_transport_error(attempt))
                 continue
-            finally:
-                attempt += 1
+            report_request(response)
 
-            status_code = response.status_code
-            if status_code in acceptable_codes:
+            action = self.retry_policy.after_response(response, attempt, acceptable_codes, error_message, max_attempts)
+            if action is RetryAction.RETURN:
                 return response
-            elif status_code == 429:
-                if attempt == max_attempts:
-                    raise RateLimitedException(f"Rate limit exceeded: {response.status_code}\n{response.content}")
-                # Check if response even has retry-after header if so wait for that time
-                if "Retry-After" in response.headers:
-                    retry_after = response.headers["Retry-After"]
-                    print(f"Ratelimited, waiting for {retry_after} seconds")
-                    time.sleep(int(retry_after))
-                else:
-                    print(f"Ratelimited, waiting for {5 * attempt} seconds")
-                    time.sleep(5 * attempt)
-            elif status_code == 401:
-                if attempt == max_attempts:
-                    raise NotLoggedInException(f"User is not logged in: {response.status_code}\n{response.content}")
+            elif action is RetryAction.REFRESH_AUTHORIZATION:
                 self.auth.refresh_authorization()
-            else:
-                raise Exception(f"{error_message}: {response.status_code}\n{response.content}")
 
-        if response is not None:
-            raise Exception(f"{error_message}: {response.status_code}\n{response.content}")
-        else:
-            raise Exception(error_message)
+        raise self.retry_policy.failure(response, error_message)
 
 
 class SpotifyRequest(Protocol):